@@ -29,12 +29,12 @@
 from binascii import hexlify, unhexlify
 from time import sleep
 import platform
-try:
-    import usb1
-    import libusb1
-except:
-    print('ERROR: cannot import python libusb1 wrapper.')
-    exit()
+from metrics import REGISTRY
+from lazy import lazy_module
+
+# python libusb1 wrapper, imported when a dongle is first looked for
+usb1 = lazy_module('usb1', 'python libusb1 wrapper')
+libusb1 = lazy_module('libusb1', 'python libusb1 wrapper')
 
 # export filtering
 __all__ = ['VID', 'PID', 'CHANNELS', 'get_CC2531', 'CC2531', 'test']
@@ -67,10 +67,23 @@ CHANNELS = {
 def LOG(msg=''):
     print('[CC2531]%s' % msg)
 
+# metrics, per dongle (USB bus:address)
+M_READS = REGISTRY.counter('cc2531_bulk_reads_total',
+          'USB bulk reads returning data', ('dongle', ))
+M_READ_BYTES = REGISTRY.counter('cc2531_read_bytes_total',
+               'bytes read from the USB data endpoint', ('dongle', ))
+M_TIMEOUTS = REGISTRY.counter('cc2531_read_timeouts_total',
+             'USB bulk reads returning no data', ('dongle', ))
+M_ERRORS = REGISTRY.counter('cc2531_transfer_errors_total',
+           'USB transfers failed, other than read timeouts', ('dongle', ))
+
 # returns the list of CC2531 plugged in
-def get_CC2531():
+# pass an existing USB context to get all dongles within it (e.g. for
+# servicing them with a single event loop)
+def get_CC2531(ctx=None):
     cc2531 = []
-    ctx = usb1.USBContext()
+    if ctx is None:
+        ctx = usb1.USBContext()
     #
     for dev in ctx.getDeviceList(skip_on_error=True):
         if dev.getVendorID() == VID and dev.getProductID() == PID:
@@ -104,6 +117,8 @@ class CC2531(object):
     .config(chan) : tune the 802.15.4 dongle to the given channel
     .start_capture() : prepare the dongle to receive radio frames
     .read_data() : returns 802.15.4 frames within TI PSD structure
+    .submit_read(callback) : asynchronous alternative to .read_data()
+    .cancel_read() : cancel transfers submitted with .submit_read()
     .stop_capture() : stop the reception of radio frames
     ---
     See the test() function at the end of the file for basic use 
@@ -144,9 +159,19 @@ class CC2531(object):
         self._log('driving %s @ USB bus %i & address %i, with serial %i' \
                   % (self._usb_desc, self._usb_bus, self._usb_addr, self._usb_serial))
         #
+        dongle = '%i:%i' % (self._usb_bus, self._usb_addr)
+        self._m_reads = M_READS.labels(dongle)
+        self._m_bytes = M_READ_BYTES.labels(dongle)
+        self._m_timeouts = M_TIMEOUTS.labels(dongle)
+        self._m_errors = M_ERRORS.labels(dongle)
+        #
         self.open()
         # init state
         self._sniffing = False
+        self._transfers = []
+        self._submitting = False
+        # status of the transfer error which stopped asynchronous reading
+        self.read_error = None
     
     def _log(self, msg=''):
         LOG('[%i] %s' % (self._usb_serial, msg))
@@ -277,14 +302,84 @@ class CC2531(object):
             self._log('(read_data) should start_capture() before read_data()')
         try:
             ret = self.com.bulkRead(self.DATA_EP, self.DATA_BUFLEN, self.READ_TO)
-        except libusb1.USBError:
+        except libusb1.USBError as err:
+            if getattr(err, 'value', None) not in (None,
+                                                   libusb1.LIBUSB_ERROR_TIMEOUT):
+                # the dongle is gone, or wedged: let the caller recover
+                self._m_errors.inc()
+                raise
             # read timeout
             ret = ''
+        if ret:
+            self._m_reads.inc()
+            self._m_bytes.inc(len(ret))
+        else:
+            self._m_timeouts.inc()
         if self.DEBUG > 1:
             info = ' - timeout' if not ret else ''
             self._log('(read_data) done%s' % info)
         return bytes(ret)
     
+    ###
+    # asynchronous reading, for running within a libusb event loop
+    ###
+    
+    def submit_read(self, callback, num=2):
+        '''
+        submit num asynchronous bulk transfers on the data endpoint:
+        callback(data) is called, from within the libusb events handling, 
+        for each USB buffer received, and transfers are resubmitted
+        until .cancel_read() is called, or a transfer fails: its status is
+        then set in .read_error, for the event loop to recover
+        '''
+        def read_done(transfer):
+            status = transfer.getStatus()
+            if status == libusb1.LIBUSB_TRANSFER_COMPLETED:
+                l = transfer.getActualLength()
+                if l:
+                    self._m_reads.inc()
+                    self._m_bytes.inc(l)
+                    callback(bytes(transfer.getBuffer()[:l]))
+            elif status == libusb1.LIBUSB_TRANSFER_TIMED_OUT:
+                self._m_timeouts.inc()
+            else:
+                # cancelled, or device error
+                if status != libusb1.LIBUSB_TRANSFER_CANCELLED:
+                    self._m_errors.inc()
+                    self.read_error = status
+                return
+            if self._submitting:
+                transfer.submit()
+        #
+        self._submitting = True
+        self.read_error = None
+        for i in range(num):
+            transfer = self.com.getTransfer()
+            # no timeout: the transfer completes only when data is available
+            transfer.setBulk(self.DATA_EP | libusb1.LIBUSB_ENDPOINT_IN,
+                             self.DATA_BUFLEN, callback=read_done, timeout=0)
+            transfer.submit()
+            self._transfers.append(transfer)
+        if self.DEBUG > 1:
+            self._log('(submit_read) %i transfers submitted' % num)
+    
+    def cancel_read(self):
+        self._submitting = False
+        for transfer in self._transfers:
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except libusb1.USBError:
+                    pass
+    
+    def reading(self):
+        # True while some transfers are still pending
+        for transfer in self._transfers:
+            if transfer.isSubmitted():
+                return True
+        self._transfers = []
+        return False
+    
 
 def test(cc=None, chan=0x0b):
     if cc is None:
@@ -0,0 +1,376 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : aiointerpreter.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python3
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is an asyncio-based interpreter, for a central collector receiving
+# the feeds of many remote receiver() instances, over datagram (UDP or UNIX
+# file) and stream (TCP or UNIX file) sockets.
+# Decoding is offloaded to a thread pool, the event loop only splits
+# messages and outputs decoded frames, in order, for each peer. Metrics
+# updated while decoding are applied by the event loop, with the frames.
+# It requires python 3.4 or later: frames are then decoded without libmich
+# (see interpreter.py).
+#
+
+import socket
+import argparse
+import threading
+from struct import unpack
+from time import time
+from collections import deque
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+from interpreter import *
+from interpreter import M_RECV
+from metrics import *
+from latency import mono
+from output import RENDERERS
+
+# export filtering
+__all__ = ['aio_interpreter']
+
+def LOG(msg=''):
+    print('[aio_interpreter] %s' % msg)
+
+if asyncio is not None:
+    _DatagramProtocol = asyncio.DatagramProtocol
+    _Protocol = asyncio.Protocol
+else:
+    _DatagramProtocol = _Protocol = object
+
+
+class _peer(object):
+    '''
+    State kept for each remote receiver's host (or stream connection)
+    '''
+    __slots__ = ('addr', 'buf', 'pending', 'msgs', 'frames', 'drops',
+                 'errors', 'last_seen', 'transport', 'paused')
+
+    def __init__(self, addr, transport=None):
+        self.addr = addr
+        # incomplete message, for stream connections
+        self.buf = b''
+        # decoding futures, in reception order
+        self.pending = deque()
+        self.msgs = 0
+        self.frames = 0
+        self.drops = 0
+        self.errors = 0
+        self.last_seen = time()
+        self.transport = transport
+        self.paused = False
+
+    def __repr__(self):
+        return '%r: %i msgs, %i frames, %i drops, %i errors' \
+               % (self.addr, self.msgs, self.frames, self.drops, self.errors)
+
+
+class _dgram_proto(_DatagramProtocol):
+
+    def __init__(self, interp):
+        self._interp = interp
+
+    def datagram_received(self, data, addr):
+        peer = self._interp._get_peer(addr)
+        peer.msgs += 1
+        M_RECV.inc()
+        # each datagram holds complete messages, each one can be a batch
+        while len(data) >= 4:
+            frame_len = unpack('!I', data[:4])[0]
+            self._interp._submit(peer, data[4:4+frame_len])
+            data = data[4+frame_len:]
+
+
+class _stream_proto(_Protocol):
+
+    def __init__(self, interp):
+        self._interp = interp
+        self._peer = None
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info('peername')
+        self._peer = self._interp._get_peer(addr, transport)
+        if self._interp.DEBUG:
+            self._interp._log('stream connection from %r' % (addr, ))
+
+    def connection_lost(self, exc):
+        if self._interp.DEBUG:
+            self._interp._log('stream connection closed: %r' % self._peer)
+        self._peer.transport = None
+
+    def data_received(self, data):
+        peer = self._peer
+        peer.msgs += 1
+        M_RECV.inc()
+        buf = peer.buf + data
+        # messages are split over the stream
+        while len(buf) >= 4:
+            frame_len = unpack('!I', buf[:4])[0]
+            if len(buf) < 4+frame_len:
+                break
+            self._interp._submit(peer, buf[4:4+frame_len])
+            buf = buf[4+frame_len:]
+        peer.buf = buf
+
+
+class aio_interpreter(interpreter):
+    '''
+    Same as interpreter(), but running on an asyncio event loop:
+    ---
+    .SOCK_ADDR is the datagram server address (str -> file socket,
+    tuple -> udp socket), or None
+    .STREAM_ADDR is the stream server address (str -> file socket,
+    tuple -> tcp socket), or None
+    ---
+    Each remote peer gets its own state (stream buffer, counters and
+    decoding queue), frames are decoded in a pool of .DECODE_WORKERS threads
+    and output in their reception order, per peer.
+    When more than .PEER_PENDING frames of a peer are waiting for decoding,
+    new datagrams from it are dropped, and stream connections are paused.
+    '''
+    #
+    STREAM_ADDR = None
+    #
+    # decoding threads
+    DECODE_WORKERS = 4
+    # maximum number of frames waiting for decoding, per peer
+    PEER_PENDING = 256
+    # forget peers after some time (in second) without receiving anything
+    PEER_TIMEOUT = 300
+
+    def _init_serv(self):
+        if asyncio is None:
+            raise(Exception('asyncio not available, use interpreter instead'))
+        self._peers = {}
+        self._loop = None
+        self._tls = threading.local()
+        if self.SOCK_STREAM and self.STREAM_ADDR is None:
+            # single stream server at SOCK_ADDR
+            self.STREAM_ADDR = self.SOCK_ADDR
+            self._sk = None
+        # create the datagram socket server
+        elif self.SOCK_ADDR is not None:
+            interpreter._init_serv(self)
+        else:
+            self._sk = None
+
+    def _log(self, msg=''):
+        LOG(msg)
+
+    def _m_update(self, fn, v):
+        # within a decoding thread, metrics updates are returned with the
+        # frames, and applied from the event loop (metrics are not locked)
+        updates = getattr(self._tls, 'updates', None)
+        if updates is None:
+            fn(v)
+        else:
+            updates.append((fn, v))
+
+    def _decode(self, frame, t_recv=None):
+        # runs within a decoding thread, returns the frame records and the
+        # metrics updates
+        self._tls.updates = updates = []
+        try:
+            if t_recv is not None:
+                recs = self.decode_traced(frame, t_recv)
+            else:
+                recs = self.decode_all(frame)
+        finally:
+            self._tls.updates = None
+        return recs, updates
+
+    def stop(self):
+        self._processing = False
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def process(self):
+        self._processing = True
+        self._loop = loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(self.DECODE_WORKERS)
+        #
+        if self._sk is not None:
+            dgram_tr, _ = loop.run_until_complete(
+                loop.create_datagram_endpoint(lambda: _dgram_proto(self),
+                                              sock=self._sk))
+        else:
+            dgram_tr = None
+        if isinstance(self.STREAM_ADDR, str):
+            serv = loop.run_until_complete(
+                loop.create_unix_server(lambda: _stream_proto(self),
+                                        self.STREAM_ADDR))
+        elif self.STREAM_ADDR is not None:
+            serv = loop.run_until_complete(
+                loop.create_server(lambda: _stream_proto(self),
+                                   self.STREAM_ADDR[0], self.STREAM_ADDR[1],
+                                   reuse_address=True,
+                                   reuse_port=self.REUSE_PORT or None))
+        else:
+            serv = None
+        if serv is not None and self.DEBUG:
+            self._log('stream server listening on %s' % repr(self.STREAM_ADDR))
+        #
+        loop.call_later(self.SELECT_TO, self._housekeeping)
+        try:
+            loop.run_forever()
+        finally:
+            # no more reception
+            if serv is not None:
+                serv.close()
+            if dgram_tr is not None:
+                dgram_tr.close()
+            for peer in list(self._peers.values()):
+                if peer.transport is not None:
+                    peer.transport.close()
+            if serv is not None:
+                loop.run_until_complete(serv.wait_closed())
+            # frames already received are decoded and output, in order
+            self._drain()
+            self._executor.shutdown(wait=True)
+            loop.close()
+            self._loop = None
+            self.close_output()
+        if self.DEBUG:
+            for peer in self._peers.values():
+                self._log('peer %r' % peer)
+
+    def _drain(self):
+        # runs the loop until the decoding of every pending frame is output
+        while True:
+            pending = [fut for peer in self._peers.values()
+                           for fut in peer.pending]
+            if not pending:
+                return
+            self._loop.run_until_complete(asyncio.wait(pending))
+            for peer in self._peers.values():
+                self._flush(peer)
+
+    def _housekeeping(self):
+        if not self.looping():
+            self._loop.stop()
+            return
+        self.poll()
+        now = time()
+        for addr in list(self._peers):
+            peer = self._peers[addr]
+            if peer.transport is None and not peer.pending \
+            and now - peer.last_seen > self.PEER_TIMEOUT:
+                del self._peers[addr]
+        self._loop.call_later(self.SELECT_TO, self._housekeeping)
+
+    def _get_peer(self, addr, transport=None):
+        if transport is not None:
+            # a new state for each stream connection
+            peer = _peer(addr, transport)
+            self._peers[(addr, id(transport))] = peer
+            return peer
+        try:
+            peer = self._peers[addr]
+        except KeyError:
+            peer = self._peers[addr] = _peer(addr)
+            if self.DEBUG:
+                self._log('new datagram peer %r' % (addr, ))
+        peer.last_seen = time()
+        return peer
+
+    def _submit(self, peer, frame):
+        if len(peer.pending) >= self.PEER_PENDING:
+            if peer.transport is None:
+                peer.drops += 1
+                return
+            elif not peer.paused:
+                peer.transport.pause_reading()
+                peer.paused = True
+        if self.TRACER is not None:
+            fut = self._loop.run_in_executor(self._executor, self._decode,
+                                             frame, mono())
+        else:
+            fut = self._loop.run_in_executor(self._executor, self._decode,
+                                             frame)
+        fut.add_done_callback(lambda f: self._flush(peer))
+        peer.pending.append(fut)
+
+    def _flush(self, peer):
+        # output decoded frames in their reception order
+        pending = peer.pending
+        while pending and pending[0].done():
+            fut = pending.popleft()
+            try:
+                recs, updates = fut.result()
+            except Exception:
+                peer.errors += 1
+                continue
+            for fn, v in updates:
+                fn(v)
+            for rec in recs:
+                peer.frames += 1
+                self._cur_msg = rec
+                self.dispatch(rec)
+        if peer.paused and len(pending) < self.PEER_PENDING // 2:
+            peer.paused = False
+            if peer.transport is not None:
+                peer.transport.resume_reading()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+             description='Collect and interpret IEEE 802.15.4 frames forwarded '\
+             'by remote receivers, over UDP and TCP.')
+    parser.add_argument('--ip', type=str, default='0.0.0.0',
+        help='local address to listen on')
+    parser.add_argument('--port', type=int, default=2154,
+        help='UDP and TCP port to listen on')
+    parser.add_argument('--notcp', action='store_true', default=False,
+        help='only listen on UDP')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+        help='number of decoding threads')
+    parser.add_argument('-f', '--file', type=str, default=None,
+        help='output (append) frame information to a file')
+    parser.add_argument('-s', '--silent', action='store_true', default=False,
+        help='do not print frame information on stdout')
+    parser.add_argument('-n', '--nofcschk', action='store_true', default=False,
+        help='displays all frames, even those with failed FCS check')
+    parser.add_argument('-r', '--render', type=str, default='full',
+        choices=RENDERERS, help='frame output: one line summary (compact), '\
+        'decoded tree (full) or hex frame (hex)')
+    parser.add_argument('--rate', type=int, default=50,
+        help='maximum number of frames printed per second on stdout, the '\
+        'others are counted (0: no limit)')
+    parser.add_argument('--metrics', type=int, default=0,
+        help='serve Prometheus metrics over HTTP on this local port (0: none)')
+    args = parser.parse_args()
+    #
+    aio_interpreter.SOCK_ADDR = (args.ip, args.port)
+    if not args.notcp:
+        aio_interpreter.STREAM_ADDR = (args.ip, args.port)
+    aio_interpreter.DECODE_WORKERS = max(1, args.workers)
+    aio_interpreter.OUTPUT_FILE = args.file
+    aio_interpreter.OUTPUT_STDOUT = not args.silent
+    aio_interpreter.FCS_IGNORE = args.nofcschk
+    aio_interpreter.RENDER = args.render
+    aio_interpreter.CONSOLE_RATE = max(0, args.rate)
+    if args.metrics:
+        metrics_server(('127.0.0.1', args.metrics)).start()
+    aio_interpreter().process()
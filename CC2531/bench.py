@@ -0,0 +1,464 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : bench.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the benchmark suite of the capture pipeline, run on synthetic TI PSD
+# traffic, without any dongle:
+# - split: splitting USB buffers into frames, and building their TLVs
+# - tlv: parsing TLVs into the frame record
+# - libmich: decoding 802.15.4 MAC frames with libmich
+# - interpret: the whole interpreter.interpret(), without output
+# - render: rendering decoded frames into compact one-line outputs
+# - pcap: decoder.py reading and printing a pcap file
+# - scan: selecting the datagrams of a channel in a pcap file, before decoding
+# - e2e: receiver.read_frames() to interpreter output, over a UDP socket
+# - import: start time of python, decoder.py and sniffer.py, each in a new
+#   process (frames are process starts here)
+#
+# Each benchmark reports frames/s, CPU time per frame and latency percentiles,
+# and results can be stored into a JSON file, and compared to a previous one:
+# python ./bench.py -o baseline.json
+# python ./bench.py -c baseline.json
+#
+
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+from struct import pack
+from time import time, sleep
+from threading import Thread, Event
+from CC2531 import *
+from receiver import *
+from interpreter import *
+from interpreter import load_decoder
+from latency import tracer
+from capture import pcap_writer, scan_pcap
+from output import renderer
+
+# export filtering
+__all__ = ['BENCHMARKS', 'run', 'compare']
+
+def LOG(msg=''):
+    print('[bench] %s' % msg)
+
+# UDP port for benchmarks going through the interpreter socket
+BENCH_ADDR = ('127.0.0.1', 21540)
+
+###
+# synthetic traffic
+###
+
+def mac_frame(seq=0, payload=20):
+    # 802.15.4 data frame, intra-PAN, short addresses
+    return b''.join((pack('<HBHHH', 0x8861, seq & 0xff, 0x1a2b, 0x0000,
+                          0x0100 + seq % 64), b'x' * payload))
+
+def psd_frame(seq=0, payload=20):
+    # TI PSD structure, as read from the CC2531: info, length, timestamp,
+    # MAC frame length, MAC frame, RSSI and FCS / correlation
+    mac = mac_frame(seq, payload)
+    body = b''.join((pack('<IB', seq * 1000, len(mac) + 2), mac, b'\xd8\x80'))
+    return b''.join((pack('<BH', 0, len(body)), body))
+
+def usb_buffer(seq=0, frames=4, payload=20):
+    # several frames concatenated within a single USB buffer
+    return b''.join(psd_frame(seq + i, payload) for i in range(frames))
+
+def tlv_msg(seq=0, payload=20, chan=11):
+    # message as forwarded by a receiver, without its length prefix
+    t = str(1384300800.0 + seq / 100.0).encode('ascii')
+    psd = psd_frame(seq, payload)
+    return b''.join((b'\x01\x00\x01', pack('B', chan),
+                     b'\x02', pack('!H', len(t)), t,
+                     b'\x10', pack('!H', len(psd)), psd))
+
+
+class _bench_CC2531(CC2531):
+    '''
+    CC2531 look-alike, returning prebuilt USB buffers from .read_data()
+    '''
+
+    def __init__(self, bufs):
+        self._usb_desc = 'bench'
+        self._usb_bus, self._usb_addr, self._usb_serial = 0, 0, 0
+        self._bufs = bufs
+        self._i = 0
+        self._sniffing = True
+        self._transfers = []
+        self._submitting = False
+        self.read_error = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def init(self):
+        pass
+
+    def config(self, chan=0xb):
+        pass
+
+    def start_capture(self):
+        pass
+
+    def stop_capture(self):
+        pass
+
+    def read_data(self):
+        buf = self._bufs[self._i % len(self._bufs)]
+        self._i += 1
+        return buf
+
+
+class _bench_receiver(receiver):
+    _THREADED = True
+    DEBUG = 0
+    SOCK_ADDR = BENCH_ADDR
+    POSITION = False
+
+
+class _null_receiver(_bench_receiver):
+    # counts messages instead of sending them
+
+    def send(self, data=b''):
+        self.sent += 1
+        return len(data)
+
+
+class _bench_interpreter(interpreter):
+    _THREADED = True
+    DEBUG = 0
+    SOCK_ADDR = BENCH_ADDR
+    OUTPUT_STDOUT = False
+    OUTPUT_FILE = None
+
+###
+# measurement
+###
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+def _pct(vals, q):
+    vals = sorted(vals)
+    return vals[min(len(vals)-1, int(q * len(vals) / 100.0))]
+
+def _measure(fn, frames, rounds):
+    '''
+    runs fn() rounds times, each call handling frames frames, and returns
+    throughput, CPU time per frame and per frame latency percentiles
+    (from each round's mean)
+    '''
+    lat = []
+    t0, c0 = time(), _cpu()
+    for r in range(rounds):
+        t = time()
+        fn()
+        lat.append((time() - t) / frames)
+    dur, cpu = time() - t0, _cpu() - c0
+    n = frames * rounds
+    return {'frames': n,
+            'frames_per_s': n / dur if dur else 0.0,
+            'cpu_us_per_frame': 1e6 * cpu / n,
+            'lat_p50_us': 1e6 * _pct(lat, 50),
+            'lat_p99_us': 1e6 * _pct(lat, 99),
+            'lat_max_us': 1e6 * max(lat)}
+
+###
+# benchmarks
+###
+
+def bench_split(rounds=200, frames=1000):
+    # receiver.read_frames(): USB buffer split and TLVs, without sending
+    bufs = [usb_buffer(i*4, 4) for i in range(16)]
+    rcv = _null_receiver(_bench_CC2531(bufs))
+    rcv.sent, rcv._chan = 0, 11
+    reads = frames // 4
+    def fn():
+        for i in range(reads):
+            rcv.read_frames()
+    res = _measure(fn, reads * 4, rounds)
+    rcv._sk.close()
+    return res
+
+def bench_tlv(rounds=200, frames=1000):
+    # TLV parsing, without the TI PSD and MAC decoding
+    interp = _bench_interpreter()
+    msgs = [tlv_msg(i)[:-(3+len(psd_frame(i)))] for i in range(frames)]
+    def fn():
+        for msg in msgs:
+            interp.decode(msg)
+    res = _measure(fn, frames, rounds)
+    interp._sk.close()
+    return res
+
+def bench_libmich(rounds=50, frames=200):
+    # 802.15.4 MAC decoding with libmich
+    macs = [mac_frame(i) for i in range(frames)]
+    decoder = load_decoder()
+    def fn():
+        for mac in macs:
+            decoder().parse(mac)
+    return _measure(fn, frames, rounds)
+
+def bench_interpret(rounds=50, frames=200):
+    # the whole interpreter.interpret(), with output disabled
+    interp = _bench_interpreter()
+    msgs = [tlv_msg(i) for i in range(frames)]
+    def fn():
+        for msg in msgs:
+            interp.interpret(msg)
+    res = _measure(fn, frames, rounds)
+    interp._sk.close()
+    return res
+
+def bench_render(rounds=50, frames=200, mode='compact'):
+    # rendering of decoded frames into text, as output by the interpreter
+    interp = _bench_interpreter()
+    recs = [interp.decode(tlv_msg(i)) for i in range(frames)]
+    render = renderer(mode).render
+    def fn():
+        for rec in recs:
+            render(rec)
+    res = _measure(fn, frames, rounds)
+    interp._sk.close()
+    return res
+
+def bench_pcap(rounds=5, frames=1000, path='/tmp/cc2531_bench.pcap'):
+    # decoder.py processing a pcap file, printing into /dev/null
+    import decoder
+    wr = pcap_writer(path)
+    for i in range(frames):
+        msg = tlv_msg(i)
+        wr.write(b''.join((pack('!I', len(msg)), msg)), 1384300800.0 + i / 100.0)
+    wr.close()
+    def fn():
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            decoder.process_pcap(path)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    res = _measure(fn, frames, rounds)
+    os.unlink(path)
+    return res
+
+def bench_scan(rounds=5, frames=100000, path='/tmp/cc2531_bench.pcap'):
+    # capture.scan_pcap() selecting a channel out of 4 in a pcap file,
+    # frames are the records scanned
+    wr = pcap_writer(path)
+    for i in range(frames):
+        msg = tlv_msg(i, chan=11 + i % 4)
+        wr.write(b''.join((pack('!I', len(msg)), msg)), 1384300800.0 + i / 100.0)
+    wr.close()
+    def fn():
+        for ts, data in scan_pcap(path, chans=(11, )):
+            pass
+    res = _measure(fn, frames, rounds)
+    os.unlink(path)
+    return res
+
+def bench_e2e(rounds=1, frames=20000, rate=0):
+    '''
+    receiver.read_frames() to interpreter output, over a UDP socket, with
+    latency tracing: frames are read as fast as possible (or at rate
+    frames/s), and lost frames are counted
+    '''
+    stop = Event()
+    _bench_interpreter._STOP_EVENT = stop
+    _bench_interpreter.TRACER = tracer()
+    _bench_receiver.TRACE = True
+    try:
+        interp = _bench_interpreter()
+        th = Thread(target=interp.process)
+        th.daemon = True
+        th.start()
+        bufs = [usb_buffer(i*4, 4) for i in range(16)]
+        rcv = _bench_receiver(_bench_CC2531(bufs))
+        rcv._chan = 11
+        reads = frames // 4
+        # tracer histograms are shared metrics: count from their current state
+        trc = interp.TRACER
+        recv0 = trc._hist[-1].count
+        t0, c0 = time(), _cpu()
+        for r in range(rounds):
+            for i in range(reads):
+                rcv.read_frames()
+                if rate:
+                    # pace the reads
+                    ahead = t0 + (r * reads + i + 1) * 4.0 / rate - time()
+                    if ahead > 0:
+                        sleep(ahead)
+        # wait for the interpreter to drain its socket
+        n = reads * 4 * rounds
+        last, cnt = time(), -1
+        while time() - last < 0.5:
+            if trc._hist[0].count != cnt:
+                cnt, last = trc._hist[0].count, time()
+            sleep(0.05)
+        dur, cpu = last - t0, _cpu() - c0
+        stop.set()
+        th.join()
+        interp._sk.close()
+        rcv._sk.close()
+        recv = trc._hist[-1].count - recv0
+        res = {'frames': n,
+               'frames_per_s': recv / dur if dur else 0.0,
+               'cpu_us_per_frame': 1e6 * cpu / max(1, recv),
+               'loss': 1.0 - float(recv) / n}
+        if recv:
+            res['lat_p50_us'] = 1e6 * trc.percentile('total', 50)
+            res['lat_p99_us'] = 1e6 * trc.percentile('total', 99)
+            res['lat_max_us'] = 1e6 * trc.max[-1]
+        return res
+    finally:
+        _bench_interpreter.TRACER = None
+        _bench_receiver.TRACE = False
+
+# entry points timed by the import benchmark, run as python -c statements
+IMPORTS = [
+    ('python', 'pass'),
+    ('decoder', 'import decoder'),
+    ('sniffer', 'import sniffer'),
+    ]
+# dependencies none of these entry points should import
+HEAVY = ('usb1', 'libusb1', 'libmich', 'numpy', 'serial')
+
+def bench_import(rounds=20):
+    '''
+    start time of the entry points in IMPORTS, each in a new python process,
+    and number of HEAVY modules they import
+    '''
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    null = open(os.devnull, 'w')
+    def start(stmt):
+        t = time()
+        if subprocess.call([sys.executable, '-c', stmt], cwd=cwd,
+                           stdout=null, stderr=null) != 0:
+            raise(Exception('%r failed' % stmt))
+        return time() - t
+    res = {}
+    try:
+        t0, c0 = time(), _cpu()
+        for name, stmt in IMPORTS:
+            res['%s_ms' % name] = 1000 * min(start(stmt) for r in range(rounds))
+        dur, cpu = time() - t0, _cpu() - c0
+        out = subprocess.check_output([sys.executable, '-c',
+              'import sys, decoder, sniffer; print(len([m for m in %r '\
+              'if m in sys.modules]))' % (HEAVY, )], cwd=cwd, stderr=null)
+    finally:
+        null.close()
+    n = len(IMPORTS) * rounds
+    res.update({'frames': n,
+                'frames_per_s': n / dur if dur else 0.0,
+                'heavy_modules': int(out.strip())})
+    return res
+
+BENCHMARKS = [
+    ('split', bench_split),
+    ('tlv', bench_tlv),
+    ('libmich', bench_libmich),
+    ('interpret', bench_interpret),
+    ('render', bench_render),
+    ('pcap', bench_pcap),
+    ('scan', bench_scan),
+    ('e2e', bench_e2e),
+    ('import', bench_import),
+    ]
+
+def run(names=None, rate=0):
+    results = {}
+    for name, fn in BENCHMARKS:
+        if names and name not in names:
+            continue
+        LOG('running %s...' % name)
+        try:
+            if fn is bench_e2e:
+                results[name] = fn(rate=rate)
+            else:
+                results[name] = fn()
+        except Exception as err:
+            LOG('%s failed: %s' % (name, err))
+            continue
+        LOG('%s: %s' % (name, ', '.join(('%s %i' if isinstance(v, int) \
+                                         else '%s %.3f') % (k, v) \
+                                        for k, v in sorted(results[name].items()))))
+    return {'time': time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results}
+
+def compare(report, baseline, tolerance=0.1):
+    '''
+    logs the throughput of each benchmark against the baseline, and returns
+    the list of benchmarks slower by more than tolerance
+    '''
+    slower = []
+    for name, res in sorted(report['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or not base.get('frames_per_s'):
+            continue
+        ratio = res['frames_per_s'] / base['frames_per_s']
+        LOG('%-10s %10.0f frames/s, baseline %10.0f frames/s: %+.1f%%' \
+            % (name, res['frames_per_s'], base['frames_per_s'],
+               100 * (ratio - 1)))
+        if ratio < 1 - tolerance:
+            slower.append(name)
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+             description='Benchmark the CC2531 capture pipeline on synthetic '\
+             'traffic.')
+    parser.add_argument('names', nargs='*',
+        help='benchmarks to run, among %s (default: all)' \
+             % ', '.join(n for n, f in BENCHMARKS))
+    parser.add_argument('-r', '--rate', type=int, default=0,
+        help='frames/s read by the receiver in the e2e benchmark '\
+             '(0: as fast as possible)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+        help='write results into a JSON file')
+    parser.add_argument('-c', '--compare', type=str, default=None,
+        help='compare results with a previous JSON file, and exit with 1 '\
+             'when a benchmark is slower')
+    parser.add_argument('-t', '--tolerance', type=float, default=10,
+        help='throughput loss (in percent) tolerated when comparing')
+    args = parser.parse_args()
+    #
+    report = run(args.names, args.rate)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            slower = compare(report, json.load(fd), args.tolerance / 100.0)
+        if slower:
+            LOG('slower: %s' % ', '.join(slower))
+            sys.exit(1)
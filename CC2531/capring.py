@@ -0,0 +1,256 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : capring.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the raw capture ring: a memory-mapped circular file per dongle,
+# where receiver() instances record every USB buffer (concatenated TI PSD
+# frames) as soon as it is read, whatever happens to the forwarding.
+#
+# The file is a header followed by fixed size slots:
+# header : magic (8 bytes), version : uint16, slot size : uint16,
+#          number of slots : uint32, next sequence number : uint64, all BE
+# slot : sequence number : uint64, epoch time : double, channel : uint8,
+#        flags : uint8 (0x01: first fragment, 0x02: last fragment),
+#        buffer length : uint16, fragment length : uint16, padding : 2 bytes,
+#        and the fragment of the USB buffer
+# A USB buffer larger than a slot spans consecutive slots, each with its own
+# sequence number (the next one), its first and last fragments being
+# flagged. The oldest slots are overwritten when the ring is full.
+# An existing file of another geometry (e.g. another ring size) is renamed
+# aside, never overwritten.
+#
+# Run as a program, it extracts a time range of a capture ring into a pcap
+# file, with each frame as forwarded to the interpreter (see capture.py and
+# decoder.py).
+#
+
+import os
+import mmap
+import argparse
+from struct import pack, unpack, unpack_from, pack_into, calcsize
+from time import strftime, localtime
+from capture import pcap_writer
+
+# export filtering
+__all__ = ['capture_ring', 'read_ring', 'split_psd']
+
+def LOG(msg=''):
+    print('[capring] %s' % msg)
+
+MAGIC = 'CC2531CR'
+VERSION = 1
+
+_HDR = '!8sHHIQ'
+_HDR_LEN = 64
+_SEQ_OFF = calcsize('!8sHHI')
+_SLOT = '!QdBBHH2x'
+_SLOT_LEN = calcsize(_SLOT)
+
+F_FIRST = 0x01
+F_LAST = 0x02
+
+
+class capture_ring(object):
+    '''
+    Memory-mapped circular file of .count slots of .slot bytes, .write()
+    records a USB buffer with its channel and reception time
+    ---
+    An existing file with the same geometry is continued, otherwise it is
+    renamed aside (with its modification time), and a new one is created.
+    '''
+    # debug level
+    DEBUG = 1
+
+    def __init__(self, path, size=64*1024*1024, slot=256):
+        self.path = path
+        self.slot = slot
+        self.count = max(1, (size - _HDR_LEN) // slot)
+        # payload per slot
+        self._frag = slot - _SLOT_LEN
+        flen = _HDR_LEN + self.count * slot
+        self._seq = 0
+        fd = None
+        if os.path.exists(path) and os.path.getsize(path) == flen:
+            fd = open(path, 'r+b')
+            magic, ver, sl, cnt, seq = unpack(_HDR, fd.read(calcsize(_HDR)))
+            if (magic, ver, sl, cnt) == (MAGIC, VERSION, slot, self.count):
+                self._seq = seq
+            else:
+                fd.close()
+                fd = None
+                self._set_aside()
+        elif os.path.exists(path) and os.path.getsize(path):
+            self._set_aside()
+        if fd is None:
+            fd = open(path, 'w+b')
+            fd.truncate(flen)
+        self._fd = fd
+        self._mm = mmap.mmap(fd.fileno(), flen)
+        self._mm[0:calcsize(_HDR)] = pack(_HDR, MAGIC, VERSION, slot,
+                                          self.count, self._seq)
+        # counters
+        self.written = 0
+        if self.DEBUG:
+            LOG('recording to %s: %i slots of %i bytes%s' % (path, self.count,
+                slot, ', continuing at %i' % self._seq if self._seq else ''))
+
+    def _set_aside(self):
+        # keeps the recorded buffers of an existing file which cannot be
+        # continued
+        old = '%s.%s' % (self.path, strftime('%Y%m%d-%H%M%S',
+                         localtime(os.path.getmtime(self.path))))
+        n, new = 0, old
+        while os.path.exists(new):
+            n += 1
+            new = '%s.%i' % (old, n)
+        os.rename(self.path, new)
+        LOG('%s has another geometry, renamed to %s' % (self.path, new))
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._fd.close()
+
+    def write(self, data, chan, ts):
+        mm, seq, frag, l = self._mm, self._seq, self._frag, len(data)
+        off = _HDR_LEN + (seq % self.count) * self.slot
+        if l <= frag:
+            # single slot: a header and a copy of the buffer into the map
+            pack_into(_SLOT, mm, off, seq, ts, chan, F_FIRST|F_LAST, l, l)
+            mm[off+_SLOT_LEN:off+_SLOT_LEN+l] = data
+            self._seq = seq + 1
+        else:
+            i = 0
+            while i < l:
+                n = min(frag, l - i)
+                flags = (F_FIRST if i == 0 else 0) | \
+                        (F_LAST if i + n == l else 0)
+                pack_into(_SLOT, mm, off, seq, ts, chan, flags, l, n)
+                mm[off+_SLOT_LEN:off+_SLOT_LEN+n] = data[i:i+n]
+                i += n
+                seq += 1
+                off = _HDR_LEN + (seq % self.count) * self.slot
+            self._seq = seq
+        pack_into('!Q', mm, _SEQ_OFF, self._seq)
+        self.written += 1
+
+
+def read_ring(path, start=None, end=None):
+    '''
+    yields (timestamp, channel, USB buffer) for each complete buffer recorded
+    in a capture ring, oldest first, within [start, end] when given
+    '''
+    fd = open(path, 'rb')
+    try:
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+    try:
+        magic, ver, slot, count, nxt = unpack_from(_HDR, mm, 0)
+        if magic != MAGIC or ver != VERSION:
+            raise(Exception('not a capture ring: %s' % path))
+        frags = []
+        for seq in range(max(0, nxt - count), nxt):
+            off = _HDR_LEN + (seq % count) * slot
+            s, ts, chan, flags, l, n = unpack_from(_SLOT, mm, off)
+            if s != seq:
+                # overwritten meanwhile
+                frags = []
+                continue
+            if flags & F_FIRST:
+                frags = []
+            frags.append(mm[off+_SLOT_LEN:off+_SLOT_LEN+n])
+            if not flags & F_LAST:
+                continue
+            data, frags = ''.join(frags), []
+            if len(data) != l:
+                # the first fragments were overwritten
+                continue
+            if (start is None or ts >= start) and (end is None or ts <= end):
+                yield ts, chan, data
+    finally:
+        mm.close()
+
+def split_psd(data):
+    # yields the TI PSD frames of a USB buffer, as receiver.split_frames()
+    while len(data) > 7:
+        l = unpack('<H', data[1:3])[0]
+        yield data[:l+3]
+        data = data[l+3:]
+
+def _message(chan, ts, psd):
+    # a frame as forwarded by receivers, with its length prefix
+    t = str(ts)
+    msg = ''.join(('\x01\x00\x01%s' % chr(chan),
+                   '\x02%s%s' % (pack('!H', len(t)), t),
+                   '\x10%s%s' % (pack('!H', len(psd)), psd)))
+    return ''.join((pack('!I', len(msg)), msg))
+
+def extract(path, out, start=None, end=None):
+    '''
+    writes the frames of a capture ring within [start, end] into the pcap
+    file out, and returns the number of frames
+    '''
+    wr = pcap_writer(out)
+    n = 0
+    try:
+        for ts, chan, data in read_ring(path, start, end):
+            for psd in split_psd(data):
+                wr.write(_message(chan, ts, psd), ts)
+                n += 1
+    finally:
+        wr.close()
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+             description='Extract the frames of a receiver capture ring into a '\
+             'pcap file.')
+    parser.add_argument('file', type=str,
+        help='capture ring file (e.g. /tmp/cc2531_capture_1_4)')
+    parser.add_argument('-o', '--output', type=str, default='capture.pcap',
+        help='pcap file to write')
+    parser.add_argument('--start', type=float, default=None,
+        help='first epoch time to extract')
+    parser.add_argument('--end', type=float, default=None,
+        help='last epoch time to extract')
+    parser.add_argument('-l', '--list', action='store_true', default=False,
+        help='only print the time range and number of buffers in the ring')
+    args = parser.parse_args()
+    #
+    if args.list:
+        cnt, first, last = 0, None, None
+        for ts, chan, data in read_ring(args.file):
+            cnt += 1
+            if first is None:
+                first = ts
+            last = ts
+        if cnt:
+            LOG('%i buffers, from %s (%f) to %s (%f)' % (cnt,
+                strftime('%Y-%m-%d %H:%M:%S', localtime(first)), first,
+                strftime('%Y-%m-%d %H:%M:%S', localtime(last)), last))
+        else:
+            LOG('empty ring')
+    else:
+        n = extract(args.file, args.output, args.start, args.end)
+        LOG('%i frames written to %s' % (n, args.output))
@@ -0,0 +1,330 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : capture.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the reading and writing of pcap files holding the UDP datagrams
+# sent by receiver() instances to the interpreter (port 2154 by default).
+# It does not depend on libmich, and only decodes what is needed to get
+# the UDP payloads: Ethernet, Linux cooked, loopback and raw IP link types,
+# IPv4 and IPv6.
+#
+# scan_pcap() selects datagrams (port, channel, capture time and length)
+# before they are handed to a decoder: after a single pass over the record
+# headers, the link, IP and UDP headers and the first TLV of all records are
+# parsed at once with NumPy arrays over the memory-mapped file, and only the
+# selected payloads are copied. Without NumPy, it filters read_pcap().
+#
+
+import mmap
+import socket
+from array import array
+from struct import Struct, pack, unpack, calcsize, error as struct_error
+from lazy import lazy_module, available
+
+# export filtering
+__all__ = ['UDP_PORT', 'pcap_writer', 'read_pcap', 'scan_pcap', 'udp_payload']
+
+# imported with the first scan
+np = lazy_module('numpy', 'NumPy')
+
+UDP_PORT = 2154
+
+# link types
+LINK_NULL = 0
+LINK_ETHERNET = 1
+LINK_RAW = 101
+LINK_LINUX_SLL = 113
+LINK_IPV4 = 228
+LINK_IPV6 = 229
+
+_MAGIC_US = 0xa1b2c3d4
+_MAGIC_NS = 0xa1b23c4d
+
+_GLOBAL = 'IHHiIII'
+_GLOBAL_LEN = calcsize('<' + _GLOBAL)
+_RECORD = 'IIII'
+_RECORD_LEN = calcsize('<' + _RECORD)
+
+
+class pcap_writer(object):
+    '''
+    Write UDP datagrams into a pcap file (Ethernet link type), as captured
+    on the loopback interface
+    '''
+
+    def __init__(self, path, src=('127.0.0.1', 2155), dst=('127.0.0.1', UDP_PORT)):
+        self._fd = open(path, 'wb')
+        self._fd.write(pack('<' + _GLOBAL, _MAGIC_US, 2, 4, 0, 0, 65535,
+                            LINK_ETHERNET))
+        self._src = (socket.inet_aton(src[0]), src[1])
+        self._dst = (socket.inet_aton(dst[0]), dst[1])
+        self.cnt = 0
+
+    def close(self):
+        self._fd.close()
+
+    def write(self, data, ts):
+        ip_len = 28 + len(data)
+        udp = pack('!HHHH', self._src[1], self._dst[1], 8 + len(data), 0)
+        # IPv4 header, checksum left to 0
+        ip = b''.join((pack('!BBHHHBBH', 0x45, 0, ip_len, self.cnt & 0xffff,
+                           0x4000, 64, 17, 0), self._src[0], self._dst[0]))
+        eth = 12*b'\0' + b'\x08\x00'
+        pkt = b''.join((eth, ip, udp, data))
+        sec = int(ts)
+        self._fd.write(pack('<' + _RECORD, sec, int((ts - sec) * 1000000),
+                            len(pkt), len(pkt)))
+        self._fd.write(pkt)
+        self.cnt += 1
+
+
+def udp_payload(pkt, link, port=UDP_PORT):
+    '''
+    returns the payload of the UDP datagram to port within a packet of the
+    given link type, or None
+    '''
+    try:
+        if link == LINK_ETHERNET:
+            off, etype = 14, unpack('!H', pkt[12:14])[0]
+            if etype == 0x8100:
+                # 802.1Q tag
+                off, etype = 18, unpack('!H', pkt[16:18])[0]
+            ver = {0x0800: 4, 0x86dd: 6}.get(etype)
+        elif link == LINK_LINUX_SLL:
+            off, etype = 16, unpack('!H', pkt[14:16])[0]
+            ver = {0x0800: 4, 0x86dd: 6}.get(etype)
+        elif link == LINK_NULL:
+            # host byte order address family: AF_INET is 2, AF_INET6 varies
+            off, fam = 4, unpack('<I', pkt[0:4])[0]
+            if fam > 0xffff:
+                fam = unpack('>I', pkt[0:4])[0]
+            ver = 4 if fam == 2 else 6 if fam in (10, 24, 28, 30) else None
+        elif link in (LINK_RAW, LINK_IPV4, LINK_IPV6):
+            off, ver = 0, unpack('!B', pkt[0:1])[0] >> 4 if pkt else None
+        else:
+            return None
+    except struct_error:
+        # truncated link header
+        return None
+    if ver == 4:
+        if len(pkt) < off + 20:
+            return None
+        ihl, proto = (unpack('!B', pkt[off:off+1])[0] & 0xf) * 4, \
+                     unpack('!B', pkt[off+9:off+10])[0]
+        off += ihl
+    elif ver == 6:
+        if len(pkt) < off + 40:
+            return None
+        # extension headers are not supported
+        proto = unpack('!B', pkt[off+6:off+7])[0]
+        off += 40
+    else:
+        return None
+    if proto != 17 or len(pkt) < off + 8:
+        return None
+    dport, ulen = unpack('!HH', pkt[off+2:off+6])
+    if port is not None and dport != port:
+        return None
+    return pkt[off+8:off+ulen]
+
+def read_pcap(path, port=UDP_PORT):
+    '''
+    yields (timestamp, UDP payload) for each datagram to port in a pcap
+    file, or to any port if port is None; raises ValueError when not a pcap
+    file
+    '''
+    fd = open(path, 'rb')
+    try:
+        hdr = fd.read(_GLOBAL_LEN)
+        if len(hdr) < _GLOBAL_LEN:
+            return
+        magic = unpack('<I', hdr[:4])[0]
+        if magic in (_MAGIC_US, _MAGIC_NS):
+            end = '<'
+        else:
+            end = '>'
+            magic = unpack('>I', hdr[:4])[0]
+            if magic not in (_MAGIC_US, _MAGIC_NS):
+                raise(ValueError('not a pcap file: %s' % path))
+        div = 1e9 if magic == _MAGIC_NS else 1e6
+        link = unpack(end + _GLOBAL, hdr)[6]
+        rec = end + _RECORD
+        while True:
+            hdr = fd.read(_RECORD_LEN)
+            if len(hdr) < _RECORD_LEN:
+                return
+            sec, frac, incl, orig = unpack(rec, hdr)
+            pkt = fd.read(incl)
+            data = udp_payload(pkt, link, port)
+            if data is not None:
+                yield sec + frac / div, data
+    finally:
+        fd.close()
+
+def _pcap_header(buf, path):
+    # returns the byte order, timestamp fraction divisor and link type of a
+    # pcap file from its global header
+    magic = unpack('<I', buf[:4])[0]
+    if magic in (_MAGIC_US, _MAGIC_NS):
+        end = '<'
+    else:
+        end = '>'
+        magic = unpack('>I', buf[:4])[0]
+        if magic not in (_MAGIC_US, _MAGIC_NS):
+            raise(ValueError('not a pcap file: %s' % path))
+    return end, 1e9 if magic == _MAGIC_NS else 1e6, \
+           unpack(end + _GLOBAL, buf[:_GLOBAL_LEN])[6]
+
+def _selected(ts, data, chans, start, end, lmin, lmax):
+    # scan_pcap() selection of a single datagram
+    if (start is not None and ts < start) or (end is not None and ts > end):
+        return False
+    if (lmin is not None and len(data) < lmin) \
+    or (lmax is not None and len(data) > lmax):
+        return False
+    if chans is not None and len(data) >= 8 \
+    and data[4:7] == b'\x01\x00\x01' and unpack('!B', data[7:8])[0] not in chans:
+        return False
+    return True
+
+def scan_pcap(path, port=UDP_PORT, chans=None, start=None, end=None,
+              lmin=None, lmax=None):
+    '''
+    yields (timestamp, UDP payload) as read_pcap(), only for the datagrams:
+    - to port (any port if None),
+    - whose first message is on one of the channels chans (if not None):
+      datagrams starting with another TLV than the channel (e.g. batches) are
+      all yielded,
+    - captured within [start, end] (epoch times, when not None),
+    - with a UDP payload length within [lmin, lmax] (when not None).
+    A truncated last record is parsed up to the end of the file, as with
+    read_pcap().
+    '''
+    if not available(np):
+        for ts, data in read_pcap(path, port):
+            if _selected(ts, data, chans, start, end, lmin, lmax):
+                yield ts, data
+        return
+    fd = open(path, 'rb')
+    try:
+        if len(fd.read(_GLOBAL_LEN)) < _GLOBAL_LEN:
+            return
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+    try:
+        ts, off, ln = _scan(mm, path, port, chans, start, end, lmin, lmax)
+        for k in range(len(ts)):
+            o = int(off[k])
+            yield float(ts[k]), mm[o:o+int(ln[k])]
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # still mapped by the arrays of a failed scan
+            pass
+
+def _u16(b, idx):
+    # big endian uint16 at each index of idx
+    return (b[idx].astype(np.int64) << 8) | b[idx+1]
+
+def _u32(b, idx, end='>'):
+    # big or little endian uint32 at each index of idx
+    if end == '>':
+        return (_u16(b, idx) << 16) | _u16(b, idx+2)
+    return (b[idx+3].astype(np.int64) << 24) \
+           | (b[idx+2].astype(np.int64) << 16) \
+           | (b[idx+1].astype(np.int64) << 8) | b[idx]
+
+def _scan(mm, path, port, chans, start, end, lmin, lmax):
+    # returns the capture times, file offsets and lengths of the payloads
+    # selected by scan_pcap()
+    order, div, link = _pcap_header(mm[:_GLOBAL_LEN], path)
+    #
+    # record offsets: the only sequential pass
+    n, i, offs = len(mm), _GLOBAL_LEN, array('l')
+    incl, append = Struct(order + 'I').unpack_from, offs.append
+    lim = n - _RECORD_LEN
+    while i <= lim:
+        append(i)
+        i += _RECORD_LEN + incl(mm, i+8)[0]
+    rec = np.frombuffer(offs, 'i%i' % offs.itemsize).astype(np.int64)
+    b = np.frombuffer(mm, np.uint8)
+    # indexes beyond a record are clipped to the file, and their values
+    # discarded through the length checks
+    last = n - 1
+    def at(idx):
+        return np.minimum(idx, last - 3)
+    #
+    ts = _u32(b, rec, order) + _u32(b, rec+4, order) / div
+    incl = _u32(b, rec+8, order)
+    pkt = rec + _RECORD_LEN
+    # a truncated last record ends with the file, as read by read_pcap()
+    stop = np.minimum(pkt + incl, n)
+    # network layer offset and IP version, per link type
+    if link == LINK_ETHERNET:
+        etype = _u16(b, at(pkt+12))
+        vlan = etype == 0x8100
+        l3 = pkt + np.where(vlan, 18, 14)
+        etype = np.where(vlan, _u16(b, at(pkt+16)), etype)
+        ver = np.where(etype == 0x0800, 4, np.where(etype == 0x86dd, 6, 0))
+    elif link == LINK_LINUX_SLL:
+        l3 = pkt + 16
+        etype = _u16(b, at(pkt+14))
+        ver = np.where(etype == 0x0800, 4, np.where(etype == 0x86dd, 6, 0))
+    elif link == LINK_NULL:
+        l3 = pkt + 4
+        fam = _u32(b, at(pkt), '<')
+        fam = np.where(fam > 0xffff, _u32(b, at(pkt), '>'), fam)
+        ver = np.where(fam == 2, 4, np.where(np.isin(fam, (10, 24, 28, 30)),
+                                             6, 0))
+    elif link in (LINK_RAW, LINK_IPV4, LINK_IPV6):
+        l3 = pkt
+        ver = b[at(pkt)] >> 4
+    else:
+        return np.zeros(0), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    # transport layer
+    v4, v6 = ver == 4, ver == 6
+    ok = (v4 & (l3 + 20 <= stop)) | (v6 & (l3 + 40 <= stop))
+    proto = np.where(v4, b[at(l3+9)], b[at(l3+6)])
+    udp = l3 + np.where(v4, (b[at(l3)] & 0xf).astype(np.int64) * 4, 40)
+    ok &= (proto == 17) & (udp + 8 <= stop)
+    if port is not None:
+        ok &= _u16(b, at(udp+2)) == port
+    pay = udp + 8
+    # as the payload slice in udp_payload()
+    ln = np.maximum(0, np.minimum(_u16(b, at(udp+4)) - 8, stop - pay))
+    # selection
+    if start is not None:
+        ok &= ts >= start
+    if end is not None:
+        ok &= ts <= end
+    if lmin is not None:
+        ok &= ln >= lmin
+    if lmax is not None:
+        ok &= ln <= lmax
+    if chans is not None:
+        # channel TLV first: 0x01, length 1, channel
+        tagged = (ln >= 8) & (b[at(pay+4)] == 1) & (_u16(b, at(pay+5)) == 1)
+        ok &= ~tagged | np.isin(b[at(pay+7)], list(chans))
+    sel = np.nonzero(ok)[0]
+    return ts[sel], pay[sel], ln[sel]
@@ -0,0 +1,299 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : control.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the control socket of a running sniffer, to retune receivers and
+# change the interpreter output without restarting anything.
+#
+# Commands are text lines, each answered with a single JSON line, with
+# "ok" and either the result or an "error":
+# help
+# status
+# chans <dongle|all> <channel,...>   channels of a receiver (bus:address),
+#                                    or shared between all receivers
+# period <dongle|all> <seconds>      time spent on each channel
+# render <compact|full|hex>          frame output
+# rate <frames/s>                    console output rate (0: no limit)
+# fcs <check|ignore>                 output frames with a failed FCS check
+#                                    (ignore) or not (check)
+# filter chans <channel,...|none>    output only these channels
+# filter pans <pan,...|none>         output only frames from / to these PANs
+# profile [seconds]                  sample all threads (see profiler.py)
+# zigbee <layer,...|none>            Zigbee layers output (see zigbee.py)
+#
+# Receivers take new channels and period at their next channel hop, without
+# re-initialising the other dongles. With a supervisor, per dongle channels
+# and period are kept by the supervisor, across restarts and channels
+# sharing, until reset with "chans all" / "period all".
+# e.g. echo "chans all 15" | socat - UNIX-CONNECT:/tmp/cc2531_control
+#
+
+import os
+import json
+import socket
+from threading import Thread
+try:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, TCPServer, \
+                             StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingMixIn, UnixStreamServer, TCPServer, \
+                             StreamRequestHandler
+from CC2531 import CHANNELS
+from output import RENDERERS
+from zigbee import LAYERS
+
+# export filtering
+__all__ = ['control_server']
+
+def LOG(msg=''):
+    print('[control] %s' % msg)
+
+
+def _ints(arg, base=10):
+    # parses a comma-separated list of integers
+    return [int(v, base) for v in arg.split(',') if v]
+
+
+class _handler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            try:
+                res = self.server.control.command(line)
+                res['ok'] = True
+            except Exception as err:
+                res = {'ok': False, 'error': str(err)}
+            self.wfile.write((json.dumps(res, sort_keys=True) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _unix_server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class _tcp_server(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class control_server(object):
+    '''
+    Serve control commands on .SOCK_ADDR (str -> UNIX file socket,
+    tuple -> local TCP socket), from a daemon thread
+    ---
+    receivers : callable returning the current receiver() instances
+    interp : the interpreter() instance, or None
+    sup : the supervisor() sharing channels between receivers, or None
+    prof : the profiler() instance, or None
+    '''
+    # debug level
+    DEBUG = 1
+    #
+    SOCK_ADDR = '/tmp/cc2531_control'
+
+    def __init__(self, receivers, interp=None, sup=None, prof=None):
+        self._receivers = receivers
+        self._interp = interp
+        self._sup = sup
+        self._prof = prof
+        if isinstance(self.SOCK_ADDR, str):
+            try:
+                os.unlink(self.SOCK_ADDR)
+            except OSError:
+                if os.path.exists(self.SOCK_ADDR):
+                    raise(Exception('cannot clean %s' % self.SOCK_ADDR))
+            cls = _unix_server
+        else:
+            cls = _tcp_server
+        try:
+            self._serv = cls(self.SOCK_ADDR, _handler)
+        except socket.error:
+            raise(Exception('cannot bind control socket on %r' % (self.SOCK_ADDR, )))
+        self._serv.control = self
+        self._th = None
+
+    def start(self):
+        self._th = Thread(target=self._serv.serve_forever, name='control')
+        self._th.daemon = True
+        self._th.start()
+        if self.DEBUG:
+            LOG('control socket on %r' % (self.SOCK_ADDR, ))
+
+    def stop(self):
+        self._serv.shutdown()
+        self._serv.server_close()
+        if isinstance(self.SOCK_ADDR, str):
+            try:
+                os.unlink(self.SOCK_ADDR)
+            except OSError:
+                pass
+
+    ###
+    # commands
+    ###
+
+    def command(self, line):
+        '''
+        runs a command line, returns a dict, raises an Exception with an
+        explicit message for a bad command
+        '''
+        args = line.split()
+        fn = getattr(self, 'cmd_%s' % args[0].lower(), None)
+        if fn is None:
+            raise(Exception('unknown command %s, see help' % args[0]))
+        if self.DEBUG:
+            LOG(line)
+        return fn(*args[1:])
+
+    def cmd_help(self):
+        return {'commands': ['status', 'chans <dongle|all> <channel,...>',
+                             'period <dongle|all> <seconds>',
+                             'render <%s>' % '|'.join(RENDERERS),
+                             'rate <frames/s>', 'fcs <check|ignore>',
+                             'filter chans <channel,...|none>',
+                             'filter pans <pan,...|none>',
+                             'profile [seconds]',
+                             'zigbee <%s,...|none>' % '|'.join(LAYERS)]}
+
+    def cmd_status(self):
+        rcvs = []
+        for rcv in self._receivers():
+            rcvs.append({'dongle': rcv._dongle,
+                         'chans': list(rcv.CHAN_LIST),
+                         'period': rcv.CHAN_PERIOD,
+                         'channel': rcv._chan,
+                         'frames': rcv._m_frames.value,
+                         'error': repr(rcv.error) if rcv.error else None})
+        res = {'receivers': rcvs}
+        if self._sup is not None:
+            res['chans'] = list(self._sup.CHAN_LIST)
+            res['overrides'] = self._sup.overrides()
+        it = self._interp
+        if it is not None:
+            res['interpreter'] = {
+                'render': it.RENDER,
+                'rate': it.CONSOLE_RATE,
+                'fcs_ignore': it.FCS_IGNORE,
+                'filter_chans': sorted(it.OUTPUT_CHANS) \
+                                if it.OUTPUT_CHANS is not None else None,
+                'filter_pans': ['0x%04x' % p for p in sorted(it.OUTPUT_PANS)] \
+                               if it.OUTPUT_PANS is not None else None,
+                'zigbee': [l for l in LAYERS if l in it.ZIGBEE.layers] \
+                          if it.ZIGBEE is not None else None}
+        return res
+
+    def _select(self, dongle):
+        rcvs = self._receivers()
+        if dongle == 'all':
+            return rcvs
+        rcvs = [rcv for rcv in rcvs if rcv._dongle == dongle]
+        if not rcvs:
+            raise(Exception('no receiver running for dongle %s' % dongle))
+        return rcvs
+
+    def cmd_chans(self, dongle, chans):
+        chans = _ints(chans)
+        for c in chans:
+            if c not in CHANNELS:
+                raise(Exception('bad channel %i' % c))
+        if self._sup is not None:
+            # the supervisor shares channels between its receivers
+            if dongle == 'all':
+                self._sup.set_channels(chans)
+                return {'chans': chans}
+            self._sup.set_channels(chans, dongle)
+            return {'receivers': {dongle: chans}}
+        rcvs = self._select(dongle)
+        if dongle == 'all':
+            # without supervisor, the list is shared here
+            from supervisor import share_channels
+            for rcv, cl in zip(rcvs, share_channels(chans, len(rcvs))):
+                rcv.CHAN_LIST = cl
+        else:
+            # a new list object: taken at the next hop
+            rcvs[0].CHAN_LIST = list(chans)
+        return {'receivers': dict((rcv._dongle, rcv.CHAN_LIST) for rcv in rcvs)}
+
+    def cmd_period(self, dongle, period):
+        period = float(period)
+        if period <= 0:
+            raise(Exception('bad period %s' % period))
+        if self._sup is not None:
+            # kept by the supervisor for restarted receivers
+            names = self._sup.set_period(period,
+                                         None if dongle == 'all' else dongle)
+            return {'period': period, 'receivers': names}
+        rcvs = self._select(dongle)
+        for rcv in rcvs:
+            rcv.CHAN_PERIOD = period
+        return {'period': period, 'receivers': [rcv._dongle for rcv in rcvs]}
+
+    def _interpreter(self):
+        if self._interp is None:
+            raise(Exception('no interpreter'))
+        return self._interp
+
+    def cmd_render(self, mode):
+        self._interpreter().set_render(mode)
+        return {'render': mode}
+
+    def cmd_rate(self, rate):
+        rate = max(0, int(rate))
+        self._interpreter().set_console_rate(rate)
+        return {'rate': rate}
+
+    def cmd_fcs(self, state):
+        if state not in ('check', 'ignore'):
+            raise(Exception('fcs check or ignore'))
+        self._interpreter().FCS_IGNORE = (state == 'ignore')
+        return {'fcs_ignore': state == 'ignore'}
+
+    def cmd_filter(self, what, values):
+        it = self._interpreter()
+        if what == 'chans':
+            val = None if values == 'none' else frozenset(_ints(values))
+            it.OUTPUT_CHANS = val
+        elif what == 'pans':
+            val = None if values == 'none' else frozenset(_ints(values, 16))
+            it.OUTPUT_PANS = val
+        else:
+            raise(Exception('filter chans or pans'))
+        return {'filter_%s' % what: sorted(val) if val is not None else None}
+
+    def cmd_zigbee(self, layers):
+        layers = [] if layers == 'none' else [l for l in layers.split(',') if l]
+        self._interpreter().set_zigbee(layers)
+        return {'zigbee': [l for l in LAYERS if l in layers]}
+
+    def cmd_profile(self, duration=None):
+        if self._prof is None:
+            raise(Exception('no profiler'))
+        duration = float(duration) if duration is not None else None
+        if not self._prof.start(duration):
+            raise(Exception('already profiling'))
+        return {'profiling': duration or self._prof.DURATION}
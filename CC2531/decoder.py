@@ -29,124 +29,232 @@
 # This is a decoder that takes pcap file generated by receivers (see receiver.py)
 # as run by the sniffer.py program,
 # and prints the details of each 802.15.4 frame retrieved by CC2531 dongle.
-# It requires libmich and its IEEE802154 format descriptor.
+# It uses libmich and its IEEE802154 format descriptor, imported when the
+# first frame is printed, or only decodes MAC headers when libmich is not
+# available.
+# Datagrams can be selected by channel, capture time and length, before being
+# decoded (see capture.scan_pcap(), with NumPy): batch datagrams are not
+# selected by channel, and are printed with the frames of all channels.
 #
 
-import sys
-from struct import unpack
+import os
+import argparse
+from struct import unpack_from, error as struct_error
 from time import strftime, localtime
-from libmich.formats import pcap
-from libmich.formats import IEEE802154
-from libmich.core.element import Int
+from gps import gps_fix, gps_track
+from latency import TAG_TRACE, unpack_trace
+from uplink import TAG_BATCH, unpack_batch
+from tlv import TAG_CHANNEL, TAG_TIME, TAG_GPRMC, TAG_POSITION, TAG_TI_PSD, \
+                TAG_MAC, tlv_walk, unpack_ti_psd
+from mac import mac_decoder
+from capture import UDP_PORT, LINK_ETHERNET, scan_pcap, udp_payload
+from lazy import lazy_module, available
 
-# this is to customize another 802.15.4 frame decoder
-DECODER = IEEE802154.IEEE802154
-# this is the default CC2531 behavior
-DECODER.PHY_INCL = False
-DECODER.FCS_INCL = False
+# libmich, imported when the first frame is printed
+IEEE802154 = lazy_module('libmich.formats.IEEE802154', 'libmich')
+element = lazy_module('libmich.core.element', 'libmich')
+
+# this is to customize another 802.15.4 frame decoder, libmich's one is set
+# by load_decoder() when left to None (or mac_decoder without libmich)
+DECODER = None
+# TI PSD structure printer, set by load_decoder()
+PSD_PRINTER = None
+
+def load_decoder():
+    # returns DECODER, set to libmich's 802.15.4 decoder if not customized
+    global DECODER, PSD_PRINTER
+    if PSD_PRINTER is None:
+        if available(IEEE802154):
+            PSD_PRINTER = _print_libmich_psd
+            # libmich integers are big endian, as within TLVs
+            element.Int._endian = 'big'
+        else:
+            PSD_PRINTER = _print_plain_psd
+    if DECODER is None:
+        if PSD_PRINTER is _print_libmich_psd:
+            DECODER = IEEE802154.IEEE802154
+            # this is the default CC2531 behavior
+            DECODER.PHY_INCL = False
+            DECODER.FCS_INCL = False
+        else:
+            DECODER = mac_decoder
+    return DECODER
 
 
 Tags = {
     0x01 : 'channel',
     0x02 : 'time',
     0x03 : 'position',
+    0x04 : 'position',
     0x10 : 'TI_PSD with 802.15.4 frame',
     0x20 : '802.15.4 frame',
+    0x30 : 'batch of frames',
+    0x40 : 'latency trace',
     }
 
-def process_pcap(pcap_file='test.pcap'):
-    #
+# gps_track to geotag frames received without position, or None
+TRACK = None
+
+def process_pcap(pcap_file='test.pcap', port=UDP_PORT, chans=None,
+                 start=None, end=None, lmin=None, lmax=None):
+    # datagrams are selected (see capture.scan_pcap()) before being decoded
     try:
-        s = open(pcap_file, 'rb').read()
-    except IOError:
+        size = os.path.getsize(pcap_file)
+        datagrams = scan_pcap(pcap_file, port, chans, start, end, lmin, lmax)
+        print('pcap file length: %i bytes\n' % size)
+        for ts, buf in datagrams:
+            try:
+                process_datagram(buf)
+            except (ValueError, struct_error) as err:
+                # malformed datagram
+                print('ERROR: %s' % err)
+    except (IOError, OSError):
         print('ERROR: cannot open file')
-        return
-    print('pcap file length: %i bytes\n' % len(s))
-    #
-    Int._endian = 'little'
-    glob = pcap.Global()
-    glob.parse(s)
-    s = s[len(glob):]
-    print('pcap global header:\n%s\n' % glob.show())
-    #
-    while len(s) > 16:
-        s = chk_record(s)
+    except ValueError as err:
+        # not a pcap file
+        print('ERROR: %s' % err)
 
-def chk_record(s):
-    #
-    Int._endian = 'little'
-    rec = pcap.Record()
-    rec.parse(s)
-    l = rec.incl_len()
-    process_packet(s[16:16+l])
-    s = s[16+l:]
-    return s
-
-def process_packet(buf):
-    #
-    # go directly after the UDP header
-    # Ethernet: 14 bytes
-    # IPv4: 20 bytes
-    # UDP: 8 bytes
-    # after checking dest port is 2154
-    #
-    dstport = (ord(buf[36])<<8) + ord(buf[37])
-    if dstport != 2154:
-        return
-    #
-    buf = buf[42:]
+def process_packet(buf, link=LINK_ETHERNET, port=UDP_PORT):
+    # a packet as captured, of the given link type
+    buf = udp_payload(buf, link, port)
+    if buf is not None:
+        process_datagram(buf)
+
+def process_datagram(buf):
+    # a UDP datagram from a receiver
     if len(buf) > 40:
         print('[+] packet received:')
     else:
         print('[-] packet too short... strange')
         return
-    while len(buf) >= 4:
-        frame_len = unpack('!I', buf[:4])[0]
-        frame = msg[4:4+frame_len]
-        while len(frame) > 2:
-            frame = chk_tlv(buf)
-            print(30*'-')
-        msg = msg[4+frame_len:]
-
-def chk_tlv(buf):
-    #
-    Int._endian = 'big'
-    #
-    T, L = unpack('!BH', msg[0:3])
-    if L:
-        V = buf[3:3+L]
-        # TODO: most of the parsing below is done in an insecure way
-        if T == 1:
-            print('channel: %i' % ord(V[0]))
-        elif T == 2:
-            print('time: %s' % strftime('%Y-%m-%d %H:%M:%S', localtime(float(V))))
-        elif T == 3:
-            print('position (GPRMC): %s' % V)
-        elif T == 0x10:
-            psd = IEEE802154.TI_USB()
-            psd.parse(V)
-            print('TI USB structure:\n%s' % usb.show())
-            data = usb.TI_CC.Payload()
-            if len(data) >= 2:
-                frame = DECODER()
-                try:
-                    frame.parse(psd.Data())
-                    print('IEEE 802.15.4 frame:\n%s' % frame.show())
-                except:
-                    print('IEEE 802.15.4 frame: -decoder error-')
-        elif T == 0x20:
-            frame = DECODER()
-            try:
-                frame.parse(V)
-                print('IEEE 802.15.4 frame:\n%s' % frame.show())
-            except:
-                print('IEEE 802.15.4 frame: -decoder error-')
-    #
-    return buf[2+L:]
+    i = 0
+    while len(buf) - i >= 4:
+        frame_len = unpack_from('!I', buf, i)[0]
+        chk_tlv(buf, i+4, min(len(buf), i+4+frame_len))
+        print(30*'-')
+        i += 4+frame_len
+
+def _print_channel(buf, i, j):
+    print('channel: %i' % unpack_from('!B', buf, i)[0])
+
+def _print_time(buf, i, j):
+    _print_epoch(float(buf[i:j]))
+
+def _print_epoch(t):
+    print('time: %s' % strftime('%Y-%m-%d %H:%M:%S', localtime(t)))
+    if TRACK is not None:
+        print('position (track): %r' % TRACK.position(t))
+
+def _print_gprmc(buf, i, j):
+    print('position (GPRMC): %s' % buf[i:j])
+
+def _print_position(buf, i, j):
+    if j - i >= gps_fix.LEN:
+        print('position: %r' % gps_fix.unpack_from(buf, i))
+
+def _print_frame(data):
+    frame = load_decoder()()
+    try:
+        frame.parse(data)
+        print('IEEE 802.15.4 frame:\n%s' % frame.show())
+    except:
+        print('IEEE 802.15.4 frame: -decoder error-')
+
+def _print_ti_psd(buf, i, j):
+    _print_psd(buf[i:j])
+
+def _print_psd(V):
+    load_decoder()
+    PSD_PRINTER(V)
+
+def _print_libmich_psd(V):
+    psd = IEEE802154.TI_USB()
+    psd.parse(V)
+    print('TI USB structure:\n%s' % psd.show())
+    data = psd.TI_CC.Payload()
+    if len(data) >= 2:
+        _print_frame(data)
+
+def _print_plain_psd(V):
+    try:
+        ts, rssi, fcs_ok, data = unpack_ti_psd(V)
+    except ValueError as err:
+        print('TI USB structure: %s' % err)
+        return
+    print('TI USB structure: timestamp %i, RSSI %i dBm, FCS %s' \
+          % (ts, rssi, 'OK' if fcs_ok else 'error'))
+    if len(data) >= 2:
+        _print_frame(data)
+
+def _print_mac(buf, i, j):
+    _print_frame(buf[i:j])
+
+def _print_batch(buf, i, j):
+    # each frame of the batch, with its channel, time and position
+    try:
+        recs = list(unpack_batch(buf[i:j]))
+    except Exception as err:
+        print('corrupted batch: %s' % err)
+        return
+    print('batch of %i frame(s)' % len(recs))
+    for chan, ts, pos, data in recs:
+        print(15*'.')
+        print('channel: %i' % chan)
+        _print_epoch(ts)
+        if pos:
+            print('position: %r' % gps_fix.unpack(pos))
+        _print_psd(data)
+
+def _print_trace(buf, i, j):
+    print('trace (USB read, split, forward): %r' % (unpack_trace(buf, i, j), ))
+
+# TLV tag -> printer of its value
+Printers = {
+    TAG_CHANNEL : _print_channel,
+    TAG_TIME : _print_time,
+    TAG_GPRMC : _print_gprmc,
+    TAG_POSITION : _print_position,
+    TAG_TI_PSD : _print_ti_psd,
+    TAG_MAC : _print_mac,
+    TAG_BATCH : _print_batch,
+    TAG_TRACE : _print_trace,
+    }
+
+def chk_tlv(buf, off=0, end=None):
+    # prints each TLV of the message buf[off:end]
+    try:
+        for T, i, j in tlv_walk(buf, off, end):
+            # TODO: most of the parsing below is done in an insecure way
+            if j > i and T in Printers:
+                Printers[T](buf, i, j)
+    except ValueError as err:
+        print('corrupted message: %s' % err)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('%s:    please provide path to captured pcap file' % sys.argv[0])
-        exit()
-    process_pcap( sys.argv[1] )
+    parser = argparse.ArgumentParser(
+             description='Print the 802.15.4 frames of a pcap file of datagrams '\
+             'sent by receivers.')
+    parser.add_argument('file', type=str, help='pcap file')
+    parser.add_argument('track', type=str, nargs='?', default=None,
+        help='GPS track file recorded by the sniffer, to geotag frames')
+    parser.add_argument('--port', type=int, default=UDP_PORT,
+        help='UDP port of the datagrams')
+    parser.add_argument('-c', '--chans', type=int, nargs='*', default=None,
+        help='only datagrams on these channels (batch datagrams are not '\
+        'selected by channel: all their frames are printed)')
+    parser.add_argument('--start', type=float, default=None,
+        help='only datagrams captured from this epoch time')
+    parser.add_argument('--end', type=float, default=None,
+        help='only datagrams captured until this epoch time')
+    parser.add_argument('--min', type=int, default=None,
+        help='only datagrams of at least this length')
+    parser.add_argument('--max', type=int, default=None,
+        help='only datagrams of at most this length')
+    args = parser.parse_args()
+    #
+    if args.track:
+        TRACK = gps_track()
+        TRACK.load(args.track)
+    process_pcap(args.file, args.port, args.chans, args.start, args.end,
+                 args.min, args.max)
 
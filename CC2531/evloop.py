@@ -0,0 +1,257 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : evloop.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+#
+# uses libusb1
+# http://www.libusb.org/
+# and python-libusb1
+# https://github.com/vpelletier/python-libusb1/
+###
+#
+# This is an event-driven alternative to the receiver.listen() loops:
+# a single thread services all CC2531 dongles (through asynchronous
+# USB transfers and libusb's file descriptors) and the GPS serial port,
+# and only wakes up when data is available or a channel hop is due.
+# A dongle whose transfers fail is tuned again, and dropped from the loop
+# when this fails too, or when it fails again within RETRY_PERIOD.
+#
+
+import select
+from time import time
+from CC2531 import *
+from CC2531 import usb1
+
+# export filtering
+__all__ = ['event_loop']
+
+def LOG(msg=''):
+    print('[event_loop] %s' % msg)
+
+class _poll_sec(object):
+    # select.poll() wrapper taking its timeout in seconds, like epoll, 
+    # as expected by usb1.USBPoller
+    
+    def __init__(self):
+        self._p = select.poll()
+        self.register = self._p.register
+        self.unregister = self._p.unregister
+        self.modify = self._p.modify
+    
+    def poll(self, timeout=None):
+        if timeout is None or timeout < 0:
+            return self._p.poll()
+        return self._p.poll(int(timeout*1000))
+
+def _poller():
+    if hasattr(select, 'epoll'):
+        return select.epoll()
+    return _poll_sec()
+
+class event_loop(object):
+    '''
+    Service a list of receiver() instances, all built from CC2531 
+    dongles of the same USB context, and optionally a GPS_reader, 
+    from a single thread.
+    ---
+    USB bulk transfers are submitted asynchronously and completed within
+    libusb events handling, which is triggered by polling libusb's
+    file descriptors (through usb1.USBPoller). The GPS serial port is 
+    registered in the same poller. The poll timeout is set to the next
+    channel hop deadline, hence the loop sleeps as long as no data 
+    is received.
+    The GPS_reader source must have a file descriptor (see .fileno()),
+    otherwise it is not read: a replayed file needs its own thread.
+    '''
+    # debug level
+    DEBUG = 1
+    # for interrupt handler and looping control
+    _THREADED = False
+    _STOP_EVENT = None
+    #
+    # number of bulk transfers kept submitted for each dongle
+    TRANSFER_NUM = 2
+    # maximum time (in second) to sleep in poll(), to check the stop event
+    POLL_TO = 0.5
+    # a dongle failing twice within this time (in second) is dropped
+    RETRY_PERIOD = 10.0
+    
+    def __init__(self, ctx, receivers=[], gps=None):
+        self._ctx = ctx
+        self._rcvs = list(receivers)
+        self._gps = gps
+        self._poller = usb1.USBPoller(self._ctx, _poller())
+        self._gps_fd = -1
+        if self._gps is not None and self._gps.fileno() >= 0:
+            self._gps_fd = self._gps.fileno()
+            self._poller.register(self._gps_fd, select.POLLIN)
+        elif self._gps is not None:
+            self._log('GPS source %s cannot be polled, not read' % self._gps._src)
+        #
+        # channel index, hop deadline and channel list, for each receiver
+        self._hop = [0] * len(self._rcvs)
+        self._deadline = [0.0] * len(self._rcvs)
+        self._chans = [None] * len(self._rcvs)
+        # time of the last transfer error, for each receiver
+        self._error_t = [None] * len(self._rcvs)
+        self._running = False
+    
+    def _log(self, msg=''):
+        LOG(msg)
+    
+    def looping(self):
+        if not self._running:
+            return False
+        else:
+            if not self._THREADED:
+                return True
+            elif hasattr(self._STOP_EVENT, 'is_set') \
+            and not self._STOP_EVENT.is_set():
+                return True
+            return False
+    
+    def stop(self):
+        self._running = False
+    
+    def _cancel_reads(self, rcv):
+        # cancel the bulk transfers of a receiver, and let libusb complete
+        # the cancellations
+        rcv._cc.cancel_read()
+        while rcv._cc.reading():
+            self._ctx.handleEventsTimeout(self.POLL_TO)
+    
+    def _hop_receiver(self, i, now):
+        # tune the receiver to its next channel and set its next deadline
+        rcv = self._rcvs[i]
+        chans = rcv.CHAN_LIST
+        if chans is not self._chans[i]:
+            # the channel list was replaced (e.g. from the control socket)
+            self._chans[i] = chans
+            self._hop[i] = 0
+        # the dongle is deconfigured when its capture stops: no transfer 
+        # must be pending then, they would fail
+        self._cancel_reads(rcv)
+        if not chans:
+            rcv._cc.stop_capture()
+            self._deadline[i] = None
+            return
+        # .tune() stops the ongoing capture first
+        rcv.tune(chans[self._hop[i] % len(chans)])
+        # bulk transfers are submitted again once the capture is restarted
+        rcv._cc.submit_read(rcv.handle_data, self.TRANSFER_NUM)
+        self._hop[i] = (self._hop[i] + 1) % len(chans)
+        if len(chans) > 1:
+            self._deadline[i] = now + rcv.CHAN_PERIOD
+        else:
+            self._deadline[i] = None
+    
+    def _check_reads(self, now):
+        # recovers the receivers whose transfers failed
+        for i in reversed(range(len(self._rcvs))):
+            rcv = self._rcvs[i]
+            status = rcv._cc.read_error
+            if status is None:
+                continue
+            self._log('dongle %s: transfer error %i' % (rcv._dongle, status))
+            if self._error_t[i] is not None \
+            and now - self._error_t[i] < self.RETRY_PERIOD:
+                self._drop(i, Exception('transfer error %i' % status))
+                continue
+            self._error_t[i] = now
+            # the hop goes back to the current channel
+            if self._chans[i]:
+                self._hop[i] = (self._hop[i] - 1) % len(self._chans[i])
+            try:
+                self._hop_receiver(i, now)
+            except Exception as err:
+                self._drop(i, err)
+    
+    def _drop(self, i, err):
+        # the receiver is stopped, its dongle is closed, and left out of
+        # the loop
+        rcv = self._rcvs.pop(i)
+        for l in (self._hop, self._deadline, self._chans, self._error_t):
+            del l[i]
+        self._log('dongle %s dropped: %s' % (rcv._dongle, err))
+        try:
+            self._cancel_reads(rcv)
+        except usb1.USBError:
+            pass
+        if rcv._ring is not None:
+            rcv._stop_forwarder()
+        rcv.flush_batch()
+        rcv.error = err
+        rcv._listening = False
+        rcv.stop()
+        if not self._rcvs:
+            self._log('no dongle left')
+    
+    def _start(self):
+        now = time()
+        for i, rcv in enumerate(self._rcvs):
+            rcv._listening = True
+            if rcv.RING_SIZE:
+                rcv._start_forwarder()
+            self._log('start listening on channel(s): %s' % rcv.CHAN_LIST)
+            # tunes the dongle and submits its bulk transfers
+            self._hop_receiver(i, now)
+    
+    def _stop(self):
+        for rcv in self._rcvs:
+            rcv._cc.cancel_read()
+        # let libusb complete the cancellations, for all dongles at once
+        while any(rcv._cc.reading() for rcv in self._rcvs):
+            self._ctx.handleEventsTimeout(self.POLL_TO)
+        for rcv in self._rcvs:
+            rcv._cc.stop_capture()
+            if rcv._ring is not None:
+                rcv._stop_forwarder()
+            rcv.flush_batch()
+            rcv._listening = False
+    
+    def run(self):
+        self._running = True
+        self._start()
+        while self.looping():
+            now = time()
+            timeout = self.POLL_TO
+            for i, deadline in enumerate(self._deadline):
+                if self._rcvs[i].CHAN_LIST is not self._chans[i]:
+                    deadline = now
+                elif deadline is None:
+                    continue
+                if deadline <= now:
+                    self._hop_receiver(i, now)
+                    deadline = self._deadline[i]
+                    if deadline is None:
+                        continue
+                timeout = min(timeout, deadline - now)
+            # USB events are handled within the poller, only other file 
+            # descriptors are returned
+            for fd, ev in self._poller.poll(max(0, timeout)):
+                if fd == self._gps_fd:
+                    if not self._gps.read_pending():
+                        self._poller.unregister(fd)
+                        self._gps_fd = -1
+            self._check_reads(time())
+            for rcv in self._rcvs:
+                if rcv._ring is None:
+                    rcv.poll_batch()
+        self._stop()
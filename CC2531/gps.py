@@ -25,16 +25,343 @@
 
 import select
 import signal
-import serial
-from time import sleep
+from struct import pack, unpack, unpack_from, calcsize
+from calendar import timegm
+from collections import deque
+from array import array
+from bisect import bisect_left
+import socket
+import errno
+import json
+from time import time, sleep, strptime
 #from binascii import *
+try:
+    import serial
+    _SERIAL_ERR = (serial.SerialException, )
+except ImportError:
+    serial = None
+    _SERIAL_ERR = ()
+from metrics import REGISTRY
+
+# sources are read as bytes, NMEA and gpsd lines are processed as text
+if str is bytes:
+    _text = str
+else:
+    def _text(buf):
+        return buf.decode('ascii', 'replace')
 
 # export filtering
-__all__ = ['GPS_reader']
+__all__ = ['GPS_reader', 'gps_fix', 'gps_track']
 
 def LOG(msg=''):
     print('[GPS_reader]%s' % msg)
 
+# metrics
+M_SENTENCES = REGISTRY.counter('gps_sentences_total',
+              'NMEA sentences (or gpsd reports) processed, by type', ('type', ))
+M_CHECKSUM = REGISTRY.counter('gps_checksum_errors_total',
+             'NMEA sentences with a bad checksum').labels()
+M_FIXES = REGISTRY.counter('gps_fixes_total', 'positions computed').labels()
+M_VALID = REGISTRY.gauge('gps_fix_valid', 'validity of the last position').labels()
+M_AGE = REGISTRY.gauge('gps_fix_age_seconds',
+        'time since the last position was computed').labels()
+
+def nmea_checksum_ok(line):
+    # line is a full NMEA sentence, $...*XX, without line ending
+    i = line.rfind('*')
+    if line[:1] != '$' or i < 0 or len(line) < i+3:
+        return False
+    cs = 0
+    for c in line[1:i]:
+        cs ^= ord(c)
+    try:
+        return cs == int(line[i+1:i+3], 16)
+    except ValueError:
+        return False
+
+def _nmea_deg(val, hemi):
+    # ddmm.mmmm / dddmm.mmmm to signed decimal degrees
+    i = val.find('.') - 2
+    deg = int(val[:i] or 0) + float(val[i:]) / 60.0
+    if hemi in ('S', 'W'):
+        return -deg
+    return deg
+
+class gps_fix(object):
+    '''
+    Immutable GPS fix:
+    .lat, .lon : latitude and longitude, in decimal degrees
+    .alt : altitude, in meters
+    .speed : ground speed, in meters per second
+    .time : fix time, as epoch (UTC)
+    .valid : validity of the fix
+    .packed : the fix packed as forwarded by receivers, see .unpack()
+    '''
+    __slots__ = ('lat', 'lon', 'alt', 'speed', 'time', 'valid', 'packed')
+    # lat, lon, alt, speed, time, valid
+    _FMT = '!ddffdB'
+    LEN = calcsize(_FMT)
+    
+    def __init__(self, lat=0.0, lon=0.0, alt=0.0, speed=0.0, time=0.0,
+                 valid=False):
+        setf = object.__setattr__
+        setf(self, 'lat', lat)
+        setf(self, 'lon', lon)
+        setf(self, 'alt', alt)
+        setf(self, 'speed', speed)
+        setf(self, 'time', time)
+        setf(self, 'valid', bool(valid))
+        setf(self, 'packed', pack(self._FMT, lat, lon, alt, speed, time,
+                                  int(self.valid)))
+    
+    def __setattr__(self, name, value):
+        raise(AttributeError('gps_fix is immutable'))
+    
+    def __repr__(self):
+        return '%.6f, %.6f, alt %.1f m, speed %.1f m/s (%s)' \
+               % (self.lat, self.lon, self.alt, self.speed,
+                  'valid' if self.valid else 'invalid')
+    
+    @classmethod
+    def unpack(cls, buf):
+        return cls(*unpack(cls._FMT, buf[:cls.LEN]))
+    
+    @classmethod
+    def unpack_from(cls, buf, off=0):
+        return cls(*unpack_from(cls._FMT, buf, off))
+
+###
+# GPS information sources, all read in a non-blocking way
+###
+
+class _serial_source(object):
+    
+    def __init__(self, port, baudrate):
+        self._port = port
+        self._ser = serial.Serial(port=port, baudrate=baudrate, timeout=0)
+    
+    def __str__(self):
+        return self._port
+    
+    def fileno(self):
+        return self._ser.fileno()
+    
+    def read(self):
+        return self._ser.read(max(1, self._ser.inWaiting()))
+    
+    def close(self):
+        self._ser.close()
+
+class _tcp_source(object):
+    
+    def __init__(self, addr):
+        host, port = addr.rsplit(':', 1)
+        self._addr = (host, int(port))
+        self._sk = socket.create_connection(self._addr)
+        self._sk.setblocking(False)
+    
+    def __str__(self):
+        return 'tcp://%s:%i' % self._addr
+    
+    def fileno(self):
+        return self._sk.fileno()
+    
+    def read(self):
+        try:
+            buf = self._sk.recv(4096)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return b''
+            raise
+        if not buf:
+            # connection closed
+            return None
+        return buf
+    
+    def close(self):
+        self._sk.close()
+
+class _gpsd_source(_tcp_source):
+    
+    def __init__(self, addr):
+        _tcp_source.__init__(self, addr)
+        self._sk.setblocking(True)
+        self._sk.sendall(b'?WATCH={"enable":true,"json":true};\n')
+        self._sk.setblocking(False)
+    
+    def __str__(self):
+        return 'gpsd://%s:%i' % self._addr
+
+class _replay_source(object):
+    # recorded NMEA file, replayed following the time of its GPRMC sentences
+    
+    def __init__(self, path, speed=1.0):
+        self._path = path
+        self._fd = open(path, 'rb')
+        self._speed = speed
+        # GPRMC time and wall-clock time of the first sentence replayed
+        self._t0 = None
+        self._w0 = None
+        # line waiting for its replay time
+        self._next = None
+    
+    def __str__(self):
+        return 'file://%s (x%s)' % (self._path, self._speed or 'max')
+    
+    def fileno(self):
+        return -1
+    
+    def _line_time(self, line):
+        if line[1:6] != b'GPRMC':
+            return None
+        try:
+            t = line.split(b',', 2)[1]
+            return int(t[0:2])*3600 + int(t[2:4])*60 + float(t[4:])
+        except (IndexError, ValueError):
+            return None
+    
+    def read(self):
+        lines = []
+        while True:
+            if self._next is None:
+                self._next = self._fd.readline()
+                if not self._next:
+                    # end of the replay
+                    return b''.join(lines) or None
+            t = self._line_time(self._next) if self._speed else None
+            if t is not None:
+                if self._t0 is None or t < self._t0:
+                    self._t0, self._w0 = t, time()
+                wait = self._w0 + (t - self._t0) / self._speed - time()
+                if wait > 0:
+                    if lines:
+                        return b''.join(lines)
+                    sleep(min(wait, GPS_reader.SELECT_TO))
+                    return b''
+            lines.append(self._next)
+            self._next = None
+    
+    def close(self):
+        self._fd.close()
+
+
+class gps_track(object):
+    '''
+    Time-sorted store of GPS fixes, in array columns, to geotag frames
+    after their reception, by interpolating between the surrounding fixes.
+    ---
+    .add(fix, ts) : record a valid fix, indexed with the time ts
+    .position(ts) : returns a gps_fix interpolated at time ts, or None
+    ---
+    Fixes are indexed with the host time at their reception, the same clock
+    as receivers' timestamps (or with the GPS fix time when .GPS_TIME is set,
+    for hosts disciplined with the GPS or NTP).
+    When a path is given, the track is loaded from it, and each new fix 
+    is appended to it as a record: index time (double, BE) and packed gps_fix.
+    '''
+    # debug level
+    DEBUG = 1
+    # index fixes with their GPS time instead of their reception time
+    GPS_TIME = False
+    # maximum time (in second) between 2 fixes to interpolate, or after the
+    # last fix to return it
+    MAX_GAP = 5.0
+    
+    def __init__(self, path=None):
+        # index time, fix time, position columns
+        self._ts = array('d')
+        self._ft = array('d')
+        self._lat = array('d')
+        self._lon = array('d')
+        self._alt = array('d')
+        self._speed = array('d')
+        self._fd = None
+        if path:
+            self.load(path)
+            try:
+                self._fd = open(path, 'ab')
+            except IOError:
+                LOG(' cannot record GPS track to %s' % path)
+    
+    def __len__(self):
+        return len(self._ts)
+    
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+    
+    def load(self, path):
+        try:
+            buf = open(path, 'rb').read()
+        except IOError:
+            return
+        l = 8 + gps_fix.LEN
+        for i in range(0, len(buf) - l + 1, l):
+            ts = unpack('!d', buf[i:i+8])[0]
+            self._insert(ts, gps_fix.unpack(buf[i+8:i+l]))
+        if self.DEBUG:
+            LOG(' %i fixes loaded from %s' % (len(self), path))
+    
+    def add(self, fix, ts=None):
+        if not fix.valid:
+            return
+        if self.GPS_TIME or ts is None:
+            ts = fix.time
+        ts = self._insert(ts, fix)
+        if self._fd is not None:
+            self._fd.write(pack('!d', ts))
+            self._fd.write(fix.packed)
+            self._fd.flush()
+    
+    def _insert(self, ts, fix):
+        n = len(self._ts)
+        if n and self._ft[-1] == fix.time:
+            # update of the last fix (e.g. altitude from GPGGA)
+            i, ts = n-1, self._ts[-1]
+            self._lat[i], self._lon[i] = fix.lat, fix.lon
+            self._alt[i], self._speed[i] = fix.alt, fix.speed
+            return ts
+        if n == 0 or ts >= self._ts[-1]:
+            i = n
+        else:
+            i = bisect_left(self._ts, ts)
+        for col, val in ((self._ts, ts), (self._ft, fix.time),
+                         (self._lat, fix.lat), (self._lon, fix.lon),
+                         (self._alt, fix.alt), (self._speed, fix.speed)):
+            col.insert(i, val)
+        return ts
+    
+    def position(self, ts):
+        t = self._ts
+        n = len(t)
+        if n == 0:
+            return None
+        i = bisect_left(t, ts)
+        if i == n:
+            # after the last fix
+            if ts - t[-1] > self.MAX_GAP:
+                return None
+            i = n-1
+            return gps_fix(self._lat[i], self._lon[i], self._alt[i],
+                           self._speed[i], self._ft[i], True)
+        if t[i] == ts or i == 0:
+            if t[i] - ts > self.MAX_GAP:
+                return None
+            return gps_fix(self._lat[i], self._lon[i], self._alt[i],
+                           self._speed[i], self._ft[i], True)
+        j = i-1
+        dt = t[i] - t[j]
+        if dt > self.MAX_GAP:
+            return None
+        r = (ts - t[j]) / dt
+        return gps_fix(self._lat[j] + r*(self._lat[i]-self._lat[j]),
+                       self._lon[j] + r*(self._lon[i]-self._lon[j]),
+                       self._alt[j] + r*(self._alt[i]-self._alt[j]),
+                       self._speed[j] + r*(self._speed[i]-self._speed[j]),
+                       self._ft[j] + r*(self._ft[i]-self._ft[j]), True)
+
+
 class GPS_reader(object):
     # debug level
     DEBUG = 1
@@ -44,42 +371,90 @@ class GPS_reader(object):
     # serial port
     PORT = '/dev/ttyUSB0'
     BAUDRATE = 9600
+    # other source of NMEA information, instead of the serial port:
+    # 'tcp://host:port' : NMEA stream over TCP
+    # 'gpsd://host:port' : gpsd JSON feed
+    # 'file://path' : replay of a recorded NMEA file
+    SOURCE = None
+    # replay speed factor, 0 for as fast as possible
+    REPLAY_SPEED = 1.0
+    # select timeout (in second), to check the stop event
+    SELECT_TO = 0.5
     # number of last NMEA info to store
     NMEA_NUM = 3
+    # file to record the whole track into (see gps_track), or None
+    TRACK_FILE = None
     # type of NMEA info to collect
     NMEA_TYPE = ("GPBOD", "GPBWC", "GPGGA", "GPGLL", "GPGSA", "GPGSV", "GPHDT",
                  "GPR00", "GPRMA", "GPRMB", "GPRMC", "GPRTE", "GPTRF", "GPSTN",
                  "GPVBW", "GPVTG", "GPWPL", "GPXTE", "GPZDA")
     
+    # speed: knots to m/s
+    KNOT = 0.514444
+    
     def __init__(self):
-        try:
-            self._ser = serial.Serial(port=self.PORT, baudrate=self.BAUDRATE)
-        except:
-            LOG('[ERR] cannot open %s' % self.PORT)
-            self._ser = None
+        self._src = self._open_source()
         #
         self.infos = {}
         for nmea_t in self.NMEA_TYPE:
-            self.infos[nmea_t] = []
+            self.infos[nmea_t] = deque(maxlen=self.NMEA_NUM)
+        # last fix, only ever replaced by a new gps_fix instance, so that
+        # readers from other threads always get a consistent one
+        self.fix = None
+        # whole track, for geotagging frames afterwards
+        self.track = gps_track(self.TRACK_FILE)
+        self._fix_t = 0.0
+        M_VALID.set_function(lambda: 1 if self.fix and self.fix.valid else 0)
+        M_AGE.set_function(lambda: time() - self._fix_t if self._fix_t \
+                                   else float('nan'))
         #
         self._listening = False
         self._reading = False
+        # incomplete line
+        self._rbuf = b''
         #
-        if self._ser:
-            LOG(' reading position information over %s' % self.PORT)
+        if self._src:
+            LOG(' reading position information over %s' % self._src)
         #
         if not self._THREADED:
             def handle_int(signum, frame):
                 self.stop()
                 LOG(' SIGINT: quitting')
             signal.signal(signal.SIGINT, handle_int)
-        
+    
+    def _open_source(self):
+        src = self.SOURCE
+        try:
+            if src is None:
+                if serial is None:
+                    LOG('[ERR] pySerial not available')
+                    return None
+                return _serial_source(self.PORT, self.BAUDRATE)
+            elif src.startswith('tcp://'):
+                return _tcp_source(src[6:])
+            elif src.startswith('gpsd://'):
+                return _gpsd_source(src[7:])
+            elif src.startswith('file://'):
+                return _replay_source(src[7:], self.REPLAY_SPEED)
+            else:
+                raise(Exception('bad SOURCE parameter'))
+        except (IOError, OSError, ValueError) + _SERIAL_ERR:
+            if src is None:
+                LOG('[ERR] pySerial not available')
+            else:
+                LOG('[ERR] cannot open %s' % src)
+            return None
+    
+    def _close(self):
+        if self._src:
+            self._src.close()
+        self.track.close()
+    
     def stop(self):
         self._listening = False
-        if self._ser:
-            while self._reading:
-                sleep(0.001)
-            self._ser.close()
+        # the source is closed by .listen() when it is running
+        if not self._reading:
+            self._close()
     
     def looping(self):
         if not self._listening:
@@ -93,20 +468,48 @@ class GPS_reader(object):
             return False
     
     def listen(self):
-        if not self._ser:
+        if not self._src:
             return
         self._listening = True
-        while self.looping():
-            try:
-                self._reading = True
-                l = self._ser.readline()
-                self._reading = False
-            # catch various errors that happen when the serial port is not
-            # available in some way
-            except (OSError, ValueError, serial.SerialException):
-                break
+        self._reading = True
+        fd = self._src.fileno()
+        try:
+            while self.looping():
+                if fd >= 0 and \
+                not select.select([fd], [], [], self.SELECT_TO)[0]:
+                    continue
+                if not self.read_pending():
+                    break
+        finally:
+            self._reading = False
+            self._close()
+    
+    def fileno(self):
+        # source file descriptor, to be polled by an external event loop
+        # (-1 when the source cannot be polled, e.g. a replayed file)
+        if self._src:
+            return self._src.fileno()
+        return -1
+    
+    def read_pending(self):
+        # non-blocking: processes all complete lines available from the
+        # source, returns False when the source is closed
+        try:
+            buf = self._src.read()
+        # catch various errors that happen when the source is not
+        # available in some way
+        except (OSError, ValueError, IOError) + _SERIAL_ERR:
+            return False
+        if buf is None:
+            return False
+        lines = (self._rbuf + buf).split(b'\n')
+        self._rbuf = lines.pop()
+        for l in map(_text, lines):
+            if l[:1] == '{':
+                self.process_gpsd(l)
             else:
-                self.process(l)
+                self.process('%s\n' % l)
+        return True
     
     def process(self, buf='\n'):
         if self.DEBUG > 1:
@@ -114,14 +517,100 @@ class GPS_reader(object):
         # grep NMEA_TYPE we want to get
         nmea_t = buf[1:6]
         if nmea_t in self.NMEA_TYPE:
-            self.infos[nmea_t].append(buf[7:-2])
-            if len(self.infos[nmea_t]) > self.NMEA_NUM:
-                self.infos[nmea_t].remove( self.infos[nmea_t][0] )
+            line = buf.rstrip('\r\n')
+            if not nmea_checksum_ok(line):
+                M_CHECKSUM.inc()
+                if self.DEBUG:
+                    LOG(' bad checksum: %s' % line)
+                return
+            self.infos[nmea_t].append(line[7:])
+            M_SENTENCES.labels(nmea_t).inc()
             if self.DEBUG:
-                LOG(' got %s: %s' % (nmea_t, buf[7:-2]))
+                LOG(' got %s: %s' % (nmea_t, line[7:]))
+            if nmea_t == 'GPRMC':
+                self._parse_rmc(line[7:].split(','))
+            elif nmea_t == 'GPGGA':
+                self._parse_gga(line[7:].split(','))
+    
+    def _parse_rmc(self, f):
+        # hhmmss.ss, A|V, lat, N|S, lon, E|W, speed (knots), course, ddmmyy
+        try:
+            t, d = f[0], f[8]
+            y = int(d[4:6])
+            y += 2000 if y < 80 else 1900
+            ts = timegm((y, int(d[2:4]), int(d[0:2]),
+                         int(t[0:2]), int(t[2:4]), 0)) + float(t[4:])
+            lat = _nmea_deg(f[2], f[3])
+            lon = _nmea_deg(f[4], f[5])
+            speed = float(f[6] or 0) * self.KNOT
+        except (IndexError, ValueError):
+            # no fix (e.g. $GPRMC,,V,,,,,,,,,)
+            self._lost_fix()
+            return
+        if f[1] != 'A':
+            self._lost_fix()
+            return
+        last = self.fix
+        alt = last.alt if last is not None else 0.0
+        self.fix = gps_fix(lat, lon, alt, speed, ts, True)
+        self._new_fix()
+    
+    def _lost_fix(self):
+        # the last position is kept, published as invalid, so that frames
+        # are not tagged with a stale position marked valid
+        last = self.fix
+        if last is not None and last.valid:
+            self.fix = gps_fix(last.lat, last.lon, last.alt, last.speed,
+                               last.time, False)
+            self._new_fix()
+    
+    def _parse_gga(self, f):
+        # hhmmss.ss, lat, N|S, lon, E|W, quality, sats, hdop, alt, M, ...
+        # only the altitude is taken, position and time come from GPRMC
+        last = self.fix
+        if last is None:
+            return
+        try:
+            alt = float(f[8])
+        except (IndexError, ValueError):
+            return
+        self.fix = gps_fix(last.lat, last.lon, alt, last.speed, last.time,
+                           last.valid and f[5] not in ('', '0'))
+        self._new_fix()
+    
+    def _new_fix(self):
+        self._fix_t = time()
+        M_FIXES.inc()
+        self.track.add(self.fix, self._fix_t)
+    
+    def get_fix(self):
+        # last gps_fix, or None
+        return self.fix
+    
+    def process_gpsd(self, buf='{}'):
+        # gpsd JSON object, only TPV reports are used
+        try:
+            obj = json.loads(buf)
+        except ValueError:
+            return
+        if obj.get('class') != 'TPV' or 'lat' not in obj or 'lon' not in obj:
+            return
+        M_SENTENCES.labels('TPV').inc()
+        if self.DEBUG:
+            LOG(' got TPV: %s' % buf)
+        try:
+            t = obj.get('time', '')
+            ts = timegm(strptime(t[:19], '%Y-%m-%dT%H:%M:%S'))
+            if t[19:20] == '.':
+                ts += float('0%s' % t[19:].rstrip('Z'))
+        except ValueError:
+            ts = 0.0
+        self.fix = gps_fix(obj['lat'], obj['lon'], obj.get('alt', 0.0),
+                           obj.get('speed', 0.0), ts, obj.get('mode', 0) >= 2)
+        self._new_fix()
     
     def get_last_info(self, nmea_t='GPRMC'):
-        if not self._ser:
+        if not self._src:
             return ''
         if nmea_t in self.NMEA_TYPE:
             if len(self.infos[nmea_t]):
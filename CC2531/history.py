@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : history.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the in-memory history of the most recent frames, fed by the
+# interpreter, to look at the recent traffic of a device or a PAN.
+#
+# Frames and their metadata are stored in preallocated array columns used as
+# a ring: the memory used is fixed. Source address, destination address and
+# PAN indexes map each key to the sequence numbers of its frames still in the
+# ring, and are updated when a frame is added, and when it is evicted.
+#
+
+from array import array
+from collections import deque
+from time import time
+from mac import *
+
+# export filtering
+__all__ = ['history']
+
+def LOG(msg=''):
+    print('[history] %s' % msg)
+
+# 802.15.4 PSDU maximum length
+FRAME_MAX = 127
+
+
+class history(object):
+    '''
+    Ring of the .SIZE most recent frames, no older than .WINDOW second(s),
+    fed with .add() for each frame received.
+    ---
+    Query API, returning lists of frames as
+    (timestamp, channel, RSSI, FCS OK, frame), oldest first:
+    .last(n) : the n most recent frames
+    .device(mode, addr, pan=None, since=0, src=True, dst=True) : frames sent
+        (src) and / or received (dst) by a device
+    .pan(pan, since=0) : frames of a PAN
+    ---
+    Frames older than .WINDOW are evicted by .poll()
+    '''
+    # debug level
+    DEBUG = 1
+    # number of frames in the ring
+    SIZE = 65536
+    # maximum age of frames (in second), 0 for no limit
+    WINDOW = 600
+
+    def __init__(self):
+        N = self.SIZE
+        # preallocated columns
+        self.ts = array('d', [0.0]) * N
+        self.chan = array('B', [0]) * N
+        self.rssi = array('b', [0]) * N
+        self.fcs_ok = array('B', [0]) * N
+        self.flen = array('B', [0]) * N
+        self.frames = bytearray(N * FRAME_MAX)
+        # index keys of each slot, None when not indexed
+        self._src = [None] * N
+        self._dst = [None] * N
+        self._pan = [None] * N
+        # indexes: key -> deque of sequence numbers
+        self._by_src = {}
+        self._by_dst = {}
+        self._by_pan = {}
+        # sequence numbers of the oldest frame and of the next frame
+        self._tail = 0
+        self._head = 0
+        # counters
+        self.added = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def _evict(self):
+        seq = self._tail
+        i = seq % self.SIZE
+        for idx, keys in ((self._by_src, self._src), (self._by_dst, self._dst),
+                          (self._by_pan, self._pan)):
+            key = keys[i]
+            if key is not None:
+                # the evicted frame is always the oldest one of its key
+                q = idx[key]
+                q.popleft()
+                if not q:
+                    del idx[key]
+                keys[i] = None
+        self._tail += 1
+        self.evicted += 1
+
+    def add(self, ts, chan, rssi, fcs_ok, frame, hdr=None):
+        '''
+        store a frame, indexed with its MAC header as returned by mac_header()
+        (or not indexed, when hdr is None)
+        '''
+        if self._head - self._tail == self.SIZE:
+            self._evict()
+        seq = self._head
+        i = seq % self.SIZE
+        l = min(len(frame), FRAME_MAX)
+        self.ts[i] = ts
+        self.chan[i] = chan
+        self.rssi[i] = max(-128, min(127, rssi or 0))
+        self.fcs_ok[i] = 1 if fcs_ok else 0
+        self.flen[i] = l
+        self.frames[i*FRAME_MAX:i*FRAME_MAX+l] = frame[:l]
+        if hdr is not None:
+            ftype, fseq, dam, dpan, daddr, sam, span, saddr, hdrlen = hdr
+            if saddr is not None:
+                key = self._src[i] = dev_key(sam, span, saddr)
+                self._by_src.setdefault(key, deque()).append(seq)
+            if daddr is not None:
+                key = self._dst[i] = dev_key(dam, dpan, daddr)
+                self._by_dst.setdefault(key, deque()).append(seq)
+            pan = span if span is not None else dpan
+            if pan is not None:
+                self._pan[i] = pan
+                self._by_pan.setdefault(pan, deque()).append(seq)
+        self._head += 1
+        self.added += 1
+
+    def poll(self, now=None):
+        # evict frames older than the time window
+        if not self.WINDOW:
+            return
+        if now is None:
+            now = time()
+        limit = now - self.WINDOW
+        while self._tail < self._head and self.ts[self._tail % self.SIZE] < limit:
+            self._evict()
+
+    # query API
+    def _get(self, seq):
+        i = seq % self.SIZE
+        return (self.ts[i], self.chan[i], self.rssi[i], bool(self.fcs_ok[i]),
+                bytes(self.frames[i*FRAME_MAX:i*FRAME_MAX+self.flen[i]]))
+
+    def _select(self, seqs, since):
+        if since:
+            return [self._get(seq) for seq in seqs \
+                    if self.ts[seq % self.SIZE] >= since]
+        return [self._get(seq) for seq in seqs]
+
+    def last(self, n=100):
+        return [self._get(seq) for seq in \
+                range(max(self._tail, self._head - n), self._head)]
+
+    def device(self, mode, addr, pan=None, since=0, src=True, dst=True):
+        key = dev_key(mode, pan, addr)
+        seqs = []
+        if src:
+            seqs.extend(self._by_src.get(key, ()))
+        if dst:
+            seqs.extend(self._by_dst.get(key, ()))
+        if src and dst:
+            seqs = sorted(set(seqs))
+        return self._select(seqs, since)
+
+    def pan(self, pan, since=0):
+        return self._select(self._by_pan.get(pan, ()), since)
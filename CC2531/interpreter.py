@@ -28,7 +28,10 @@
 #
 # This is the part which will read the feedback from receiver() instances
 # and interpret it for some information gathering / wardriving.
-# It requires libmich and its IEEE802154 format descriptor.
+# It uses libmich and its IEEE802154 format descriptor when available
+# (python 2), imported when the first interpreter() is created; otherwise,
+# frames are decoded with the minimal parsers of tlv.py and mac.py, e.g.
+# with python 3.
 #
 
 import socket
@@ -36,24 +39,80 @@ import os
 import signal
 import select
 import errno
-from struct import unpack
-from time import strftime, localtime, sleep
-from binascii import hexlify
-from CC2531 import CHANNELS
-from libmich.formats.IEEE802154 import TI_USB, TI_CC, IEEE802154
+from struct import unpack_from
+from time import time, sleep
+from timeit import default_timer
+from uplink import TAG_BATCH, unpack_batch
+from gps import gps_fix
+from mac import mac_header, mac_decoder
+from metrics import REGISTRY
+from latency import TAG_TRACE, mono, unpack_trace
+from output import renderer, file_sink, console_sink
+from tlv import TAG_CHANNEL, TAG_TIME, TAG_GPRMC, TAG_POSITION, TAG_TI_PSD, \
+                TAG_MAC, tlv_walk, unpack_ti_psd, frame_record
+from zigbee import zigbee
+from lazy import lazy_module, available
 
 # export filtering
 __all__ = ['interpreter']
 
-# this is to customize another 802.15.4 frame decoder
-DECODER = IEEE802154
-# this is the default CC2531 behavior
-DECODER.PHY_INCL = False
-DECODER.FCS_INCL = False
+# libmich's format descriptors, imported with the first interpreter()
+IEEE802154 = lazy_module('libmich.formats.IEEE802154', 'libmich')
+
+# this is to customize another 802.15.4 frame decoder, libmich's one is set
+# by load_decoder() when left to None, or mac.mac_decoder without libmich
+DECODER = None
+# TI PSD structure parser, returning (dongle timestamp, RSSI, FCS OK, frame),
+# set by load_decoder()
+TI_PSD = None
+
+def _libmich_ti_psd(V):
+    usb = IEEE802154.TI_USB()
+    usb.map(V)
+    return usb.TS(), usb.TI_CC.RSSI(), usb.TI_CC.FCS(), usb.TI_CC.Payload()
+
+def load_decoder():
+    # returns DECODER, set to libmich's 802.15.4 decoder if not customized
+    global DECODER, TI_PSD
+    if TI_PSD is None:
+        # libmich is python 2 only
+        TI_PSD = _libmich_ti_psd if available(IEEE802154) else unpack_ti_psd
+    if DECODER is None:
+        if TI_PSD is _libmich_ti_psd:
+            DECODER = IEEE802154.IEEE802154
+            # this is the default CC2531 behavior
+            DECODER.PHY_INCL = False
+            DECODER.FCS_INCL = False
+        else:
+            DECODER = mac_decoder
+    return DECODER
 
 def LOG(msg=''):
     print('[interpreter] %s' % msg)
 
+# missing from python 2 socket module, Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# metrics
+M_RECV = REGISTRY.counter('interpreter_datagrams_received_total',
+         'datagrams and stream chunks received').labels()
+M_MSGS = REGISTRY.counter('interpreter_messages_total',
+         'messages received (single frames or batches)').labels()
+M_FRAMES = REGISTRY.counter('interpreter_frames_total',
+           'frames decoded, by FCS check result', ('fcs', ))
+M_FRAMES_OK = M_FRAMES.labels('ok')
+M_FRAMES_ERR = M_FRAMES.labels('error')
+M_DECODE_ERRORS = REGISTRY.counter('interpreter_decode_errors_total',
+                  'decoding failures, by stage', ('stage', ))
+M_ERR_TLV = M_DECODE_ERRORS.labels('tlv')
+M_ERR_BATCH = M_DECODE_ERRORS.labels('batch')
+M_ERR_USB = M_DECODE_ERRORS.labels('usb')
+M_ERR_MAC = M_DECODE_ERRORS.labels('mac')
+M_DECODE_TIME = REGISTRY.histogram('interpreter_decode_seconds',
+                'time to decode a message').labels()
+M_CLIENTS = REGISTRY.gauge('interpreter_stream_clients',
+            'stream connections from receivers').labels()
+
 class interpreter(object):
     # debug level
     DEBUG = 1
@@ -63,10 +122,17 @@ class interpreter(object):
     #
     #SOCK_ADDR = '/tmp/cc2531_sniffer'
     SOCK_ADDR = ('127.10.0.1', 2154)
+    # stream (TCP / file) socket instead of datagram (UDP / file) socket
+    SOCK_STREAM = False
+    # maximum number of pending stream connections
+    SOCK_BACKLOG = 16
+    # bind with SO_REUSEPORT (UDP / TCP socket), for several interpreter
+    # processes sharing the same port (see shard.py)
+    REUSE_PORT = False
     #
     # select loop and socket recv settings
     SELECT_TO = 0.5
-    SOCK_BUFLEN = 1024
+    SOCK_BUFLEN = 65536
     #
     # interpreter output (stdout and/or file)
     OUTPUT_STDOUT = True
@@ -74,16 +140,50 @@ class interpreter(object):
     OUTPUT_FILE = '/tmp/cc2531_sniffer'
     # output even when the FCS check fails
     FCS_IGNORE = False
+    # frame rendering: 'full', 'compact' or 'hex' (see output.py)
+    RENDER = 'full'
+    # maximum number of frames printed per second on stdout (0: no limit),
+    # beyond that they are only counted; the file output is complete
+    CONSOLE_RATE = 50
+    # period of the file output flush (in second)
+    FLUSH_PERIOD = 1.0
+    # output only frames on these channels, and from / to these PANs
+    # (sets of integers), None for all
+    OUTPUT_CHANS = None
+    OUTPUT_PANS = None
+    # gps_track to geotag frames received without position, or None
+    TRACK = None
+    # statistics engine fed with every frame (see stats.py), or None
+    STATS = None
+    # topology index fed with every frame with correct FCS (see topology.py),
+    # or None
+    TOPOLOGY = None
+    # ring of recent frames fed with every frame (see history.py), or None
+    HISTORY = None
+    # latency tracer fed with traced frames (see latency.py), or None
+    TRACER = None
+    # Zigbee layers decoding for the output and statistics (see zigbee.py),
+    # or None
+    ZIGBEE = None
+    #
+    # TLV tag -> name of the method decoding its value into the frame record,
+    # resolved once per instance (see .decode())
+    TLV_HANDLERS = {
+        TAG_CHANNEL : '_tlv_channel',
+        TAG_TIME : '_tlv_time',
+        TAG_GPRMC : '_tlv_gprmc',
+        TAG_POSITION : '_tlv_position',
+        TAG_TI_PSD : '_tlv_ti_psd',
+        TAG_MAC : '_tlv_mac',
+        TAG_TRACE : '_tlv_trace',
+        }
     
     def __init__(self):
+        # import the 802.15.4 decoder now, rather than with the first frame
+        if load_decoder() is mac_decoder and self.DEBUG:
+            self._log('libmich not available, decoding MAC headers only')
         # create the socket server
-        if isinstance(self.SOCK_ADDR, str):
-            self._create_file_serv()
-        elif isinstance(self.SOCK_ADDR, tuple) and len(self.SOCK_ADDR) == 2 \
-        and isinstance(self.SOCK_ADDR[0], str) and isinstance(self.SOCK_ADDR[1], int):
-            self._create_udp_serv()
-        else:
-            raise(Exception('bad SOCK_ADDR parameter'))
+        self._init_serv()
         #
         # catch CTRL+C
         if not self._THREADED:
@@ -93,23 +193,37 @@ class interpreter(object):
             signal.signal(signal.SIGINT, serv_int)
         #
         # check output parameters
+        self._renderer = renderer(self.RENDER, self.ZIGBEE)
+        self._sinks = []
+        if self.OUTPUT_STDOUT:
+            self._sinks.append(console_sink(rate=self.CONSOLE_RATE))
         if self.OUTPUT_FILE:
             try:
-                fd = open(self.OUTPUT_FILE, 'a+')
-                fd.write(''.join((20*'#', '\n', '# 802.15.4 interpreter session\n', 
-                                  '# %s\n' % strftime('%Y-%m-%d %H:%M:%S', localtime()), 
-                                  20*'#', '\n')))
+                self._sinks.append(file_sink(self.OUTPUT_FILE))
             except IOError:
                 self._log('cannot write output to %s' % self.OUTPUT_FILE)
                 self.OUTPUT_FILE = None
+        self._flush_t = time()
         #
-        # init empty message struct
-        self._cur_msg = {}
+        # tag -> bound TLV handler
+        self._handlers = dict((T, getattr(self, name)) \
+                              for T, name in self.TLV_HANDLERS.items())
+        # last frame record dispatched
+        self._cur_msg = None
         self._processing = False
     
     def _log(self, msg=''):
         LOG(msg)
     
+    def _init_serv(self):
+        if isinstance(self.SOCK_ADDR, str):
+            self._create_file_serv()
+        elif isinstance(self.SOCK_ADDR, tuple) and len(self.SOCK_ADDR) == 2 \
+        and isinstance(self.SOCK_ADDR[0], str) and isinstance(self.SOCK_ADDR[1], int):
+            self._create_udp_serv()
+        else:
+            raise(Exception('bad SOCK_ADDR parameter'))
+    
     def _create_file_serv(self):
         try:
             os.unlink(self.SOCK_ADDR)
@@ -117,44 +231,73 @@ class interpreter(object):
             if os.path.exists(self.SOCK_ADDR):
                 raise(Exception('cannot clean %s' % self.SOCK_ADDR))
         # serv on the file
-        sk = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sk = socket.socket(socket.AF_UNIX, self._sk_type())
         try:
             sk.bind(self.SOCK_ADDR)
         except socket.error:
-            raise(Exception('cannot clean %s' % addr))
+            raise(Exception('cannot clean %s' % self.SOCK_ADDR))
+        self._listen(sk)
         #
         if self.DEBUG:
             self._log('server listening on %s' % self.SOCK_ADDR)
         self._sk = sk
     
     def _create_udp_serv(self):
-        # serv on UDP port
-        sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # serv on UDP (or TCP) port
+        sk = socket.socket(socket.AF_INET, self._sk_type())
+        if self.SOCK_STREAM:
+            sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.REUSE_PORT:
+            try:
+                sk.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            except socket.error:
+                raise(Exception('SO_REUSEPORT not supported'))
         try:
             sk.bind(self.SOCK_ADDR)
         except socket.error:
-            raise(Exception('cannot bind on UDP port %s' % list(self.SOCK_ADDR)))
+            raise(Exception('cannot bind on %s port %s' \
+                  % ('TCP' if self.SOCK_STREAM else 'UDP', list(self.SOCK_ADDR))))
+        self._listen(sk)
         #
         if self.DEBUG:
             self._log('server listening on %s' % list(self.SOCK_ADDR))
         self._sk = sk
     
+    def _sk_type(self):
+        if self.SOCK_STREAM:
+            return socket.SOCK_STREAM
+        return socket.SOCK_DGRAM
+    
+    def _listen(self, sk):
+        # stream connections and their incomplete message
+        self._clients = {}
+        clients = self._clients
+        M_CLIENTS.set_function(clients.__len__)
+        if self.SOCK_STREAM:
+            sk.listen(self.SOCK_BACKLOG)
+    
     def stop(self):
         self._processing = False
         sleep(0.2)
+        for sk in list(self._clients):
+            sk.close()
+        self._clients = {}
         self._sk.close()
+        self.close_output()
     
     def output(self, line=''):
-        if self.OUTPUT_STDOUT:
-            print(line)
-        if self.OUTPUT_FILE:
-            try:
-                fd = open(self.OUTPUT_FILE, 'a')
-            except IOError:
-                pass
-            else:
-                fd.write('%s\n' % line)
-                fd.close()
+        for sink in self._sinks:
+            sink.write(line)
+    
+    def flush_output(self):
+        for sink in self._sinks:
+            sink.flush()
+        self._flush_t = time()
+    
+    def close_output(self):
+        sinks, self._sinks = self._sinks, []
+        for sink in sinks:
+            sink.close()
     
     def looping(self):
         if not self._processing:
@@ -173,7 +316,8 @@ class interpreter(object):
         #
         while self.looping():
             try:
-                r = select.select([self._sk], [], [], self.SELECT_TO)[0]
+                r = select.select([self._sk] + list(self._clients), [], [],
+                                  self.SELECT_TO)[0]
             except select.error as e:
                 if e.args[0] == errno.EINTR:
                     self._processing = False
@@ -181,93 +325,281 @@ class interpreter(object):
                     pass
             else:
                 for sk in r:
-                    msg = sk.recv(self.SOCK_BUFLEN)
-                    #print('UDP msg: %s' % msg.encode('hex'))
-                    while len(msg) >= 4:
-                        frame_len = unpack('!I', msg[:4])[0]
-                        frame = msg[4:4+frame_len]
-                        self.interpret(frame)
-                        msg = msg[4+frame_len:]
+                    if sk is not self._sk:
+                        self._process_stream(sk)
+                    elif self.SOCK_STREAM:
+                        self._accept()
+                    else:
+                        msg = sk.recv(self.SOCK_BUFLEN)
+                        M_RECV.inc()
+                        #print('UDP msg: %s' % msg.encode('hex'))
+                        i = 0
+                        while len(msg) - i >= 4:
+                            frame_len = unpack_from('!I', msg, i)[0]
+                            self.interpret(msg[i+4:i+4+frame_len])
+                            i += 4+frame_len
+            self.poll()
+        self.close_output()
+    
+    def poll(self):
+        # periodic tasks of the output and the consumers
+        if time() - self._flush_t >= self.FLUSH_PERIOD:
+            self.flush_output()
+        if self.STATS is not None:
+            self.STATS.poll()
+        if self.TOPOLOGY is not None:
+            self.TOPOLOGY.poll()
+        if self.HISTORY is not None:
+            self.HISTORY.poll()
+    
+    def _accept(self):
+        try:
+            sk, addr = self._sk.accept()
+        except socket.error:
+            return
+        if self.DEBUG:
+            self._log('stream connection from %s' % repr(addr))
+        self._clients[sk] = b''
+    
+    def _process_stream(self, sk):
+        try:
+            buf = sk.recv(self.SOCK_BUFLEN)
+        except socket.error:
+            buf = b''
+        if not buf:
+            # connection closed, the incomplete message is discarded
+            if self.DEBUG:
+                self._log('stream connection closed')
+            del self._clients[sk]
+            sk.close()
+            return
+        M_RECV.inc()
+        msg = self._clients[sk] + buf
+        # messages are split over the stream
+        i = 0
+        while len(msg) - i >= 4:
+            frame_len = unpack_from('!I', msg, i)[0]
+            if len(msg) - i < 4+frame_len:
+                break
+            self.interpret(msg[i+4:i+4+frame_len])
+            i += 4+frame_len
+        self._clients[sk] = msg[i:]
     
     def interpret(self, msg=''):
-	    #print('interpret msg: %s' % msg.encode('hex'))
-        # init message structure
-        self._cur_msg = {}
-        # parse it into the structure
-        while len(msg) > 0:
-            msg = self._get_tlv(msg)
-        # output it nicely
-        if 'frame' in self._cur_msg \
-        and 'timestamp' in self._cur_msg \
-        and 'channel' in self._cur_msg:
-            if self._cur_msg['FCS_OK']:
-                fcschk = 'OK'
+        if self.TRACER is not None:
+            recs = self.decode_traced(msg, mono())
+        else:
+            recs = self.decode_all(msg)
+        for rec in recs:
+            self._cur_msg = rec
+            self.dispatch(rec)
+    
+    def dispatch(self, rec):
+        # feed the consumers
+        if rec.complete():
+            if rec.FCS_OK:
+                M_FRAMES_OK.inc()
             else:
-                fcschk = 'error'
-            self.output('[+] frame received (FCS %s): %s' \
-                        %  (fcschk, strftime('%Y-%m-%d %H:%M:%S',
-                                    localtime(self._cur_msg['timestamp']))))
-            if 'position' in self._cur_msg:
-                self.output('position (GPRMC): %s' % self._cur_msg['position'])
-            self.output('channel: %i, %i MHz' % (self._cur_msg['channel'],
-                        CHANNELS[self._cur_msg['channel']]))
-            if 'RSSI' in self._cur_msg:
-                self.output('RSSI: %i' % self._cur_msg['RSSI'])
-            self.output('IEEE 802.15.4 frame: %s' % hexlify(self._cur_msg['frame']))
+                M_FRAMES_ERR.inc()
+            self._index(rec)
+        # output it nicely
+        self.render(rec)
+        if self.TRACER is not None and rec.trace is not None \
+        and len(rec.trace) == 5:
+            self.TRACER.record(rec.trace + (mono(), ))
+    
+    def _index(self, rec):
+        # MAC addressing fields are parsed once for all consumers
+        hdr = None
+        if rec.FCS_OK and (self.STATS is not None \
+        or self.TOPOLOGY is not None or self.HISTORY is not None):
             try:
-                self.output('IEEE 802.15.4 MAC:\n%s\n' % self._cur_msg['MAC'].show())
-            except:
-                self.output('IEEE 802.15.4 MAC: -decoding error-\n')
-    
-    def _get_tlv(self, msg=''):
-        if len(msg) > 2:
-            T, L = unpack('!BH', msg[0:3])
-            if L and len(msg) >= 3+L:
-                V = msg[3:3+L]
-            elif L:
-                if self.DEBUG:
-                    self._log('corrupted message')
-                return ''
-            self._interpret_TV(T, V)
-            return msg[3+L:]
+                hdr = mac_header(rec.frame)
+            except ValueError:
+                pass
+        if self.STATS is not None:
+            aps = None
+            if self.STATS.ZIGBEE and self.ZIGBEE is not None and rec.FCS_OK:
+                aps = self.ZIGBEE.get(rec, 'aps')
+            self.STATS.update(rec.timestamp, rec.channel, rec.RSSI,
+                              rec.FCS_OK, rec.frame, hdr, aps)
+        if self.TOPOLOGY is not None and hdr is not None:
+            self.TOPOLOGY.update(rec.timestamp, rec.channel, rec.RSSI, hdr)
+        if self.HISTORY is not None:
+            self.HISTORY.add(rec.timestamp, rec.channel, rec.RSSI,
+                             rec.FCS_OK, rec.frame, hdr)
+    
+    def decode_all(self, msg=''):
+        # returns the list of frame records from a single message,
+        # which can be a batch of frames (see uplink.py)
+        self._m_update(M_MSGS.inc, 1)
+        t0 = default_timer()
+        if len(msg) > 2 and unpack_from('!B', msg)[0] == TAG_BATCH:
+            recs, trace = [], None
+            try:
+                for T, i, j in tlv_walk(msg):
+                    if T == TAG_BATCH:
+                        recs = self.decode_batch(msg[i:j])
+                    elif T == TAG_TRACE:
+                        # a trace TLV can follow the batch TLV
+                        trace = unpack_trace(msg, i, j)
+            except ValueError as err:
+                self._tlv_error(err)
+            if trace is not None:
+                for rec in recs:
+                    rec.trace = trace
         else:
+            recs = [self.decode(msg)]
+        self._m_update(M_DECODE_TIME.observe, default_timer() - t0)
+        return recs
+    
+    def decode_traced(self, msg, t_recv):
+        # same as .decode_all(), adding the reception and decoding times to
+        # the trace of traced frames
+        recs = self.decode_all(msg)
+        t_dec = mono()
+        for rec in recs:
+            if rec.trace is not None:
+                rec.trace = rec.trace + (t_recv, t_dec)
+        return recs
+    
+    def decode_batch(self, V=''):
+        recs = []
+        try:
+            for chan, ts, pos, data in unpack_batch(V):
+                rec = frame_record(chan, ts)
+                if pos:
+                    rec.position = gps_fix.unpack(pos)
+                self._interpret_TI_USB(data, rec)
+                self._geotag(rec)
+                recs.append(rec)
+        except Exception as err:
+            self._m_update(M_ERR_BATCH.inc, 1)
             if self.DEBUG:
-                self._log('corrupted message')
-            return ''
-    
-    def _interpret_TV(self, T=0, V=''):
-        if T == 1:
-            self._cur_msg['channel'] = ord(V[0])
-        elif T == 2:
-            self._cur_msg['timestamp'] = float(V)
-        elif T == 3:
-            # TODO: check exactly how GPS position is computed
-            self._cur_msg['position'] = V
-        elif T == 0x10:
-            # TI_PSD structure
-            self._interpret_TI_USB(V)
-        elif T == 0x20:
-            self._cur_msg['frame'] = V
-            mac = self.DECODER()
+                self._log('corrupted batch: %s' % err)
+        return recs
+    
+    def decode(self, msg=''):
+        # returns a new frame record, hence it can be called 
+        # concurrently, out of the .interpret() sequence
+        rec = frame_record()
+        handlers = self._handlers
+        try:
+            for T, i, j in tlv_walk(msg):
+                if T in handlers:
+                    handlers[T](msg, i, j, rec)
+        except ValueError as err:
+            self._tlv_error(err)
+        self._geotag(rec)
+        return rec
+    
+    def _m_update(self, fn, v):
+        # metrics updated while decoding, fn being the .inc or .observe method
+        # of a metric: overridden when decoding out of the processing thread
+        # (see aiointerpreter.py)
+        fn(v)
+    
+    def _tlv_error(self, err):
+        self._m_update(M_ERR_TLV.inc, 1)
+        if self.DEBUG:
+            self._log('corrupted message: %s' % err)
+    
+    def _geotag(self, rec):
+        if self.TRACK is not None and rec.position is None \
+        and rec.timestamp is not None:
+            rec.position = self.TRACK.position(rec.timestamp)
+    
+    def render(self, rec):
+        # output only 802.15.4 frames with correct checksum,
+        # or all frames if FCS is ignored
+        if self._sinks and rec.complete() \
+        and (self.FCS_IGNORE or rec.FCS_OK) and self._selected(rec):
+            self.output(self._renderer.render(rec))
+    
+    def _selected(self, rec):
+        # output filters
+        if self.OUTPUT_CHANS is not None and rec.channel not in self.OUTPUT_CHANS:
+            return False
+        if self.OUTPUT_PANS is not None:
+            try:
+                hdr = mac_header(rec.frame)
+            except ValueError:
+                return False
+            if hdr[3] not in self.OUTPUT_PANS and hdr[6] not in self.OUTPUT_PANS:
+                return False
+        return True
+    
+    def set_render(self, mode):
+        # changes the frame rendering, see output.RENDERERS
+        self._renderer = renderer(mode, self.ZIGBEE)
+        self.RENDER = mode
+    
+    def set_zigbee(self, layers):
+        # changes the Zigbee layers rendered, see zigbee.LAYERS (none when
+        # empty)
+        if self.ZIGBEE is None:
+            self.ZIGBEE = zigbee(layers)
+        else:
+            self.ZIGBEE.set_layers(layers)
+        self._renderer = renderer(self.RENDER, self.ZIGBEE)
+    
+    def set_console_rate(self, rate):
+        self.CONSOLE_RATE = rate
+        for sink in self._sinks:
+            if isinstance(sink, console_sink):
+                sink.rate = rate
+    
+    # TLV handlers, called with the message, the offsets of the value and the
+    # frame record to fill in
+    
+    def _tlv_channel(self, msg, i, j, rec):
+        if j > i:
+            rec.channel = unpack_from('!B', msg, i)[0]
+    
+    def _tlv_time(self, msg, i, j, rec):
+        rec.timestamp = float(msg[i:j])
+    
+    def _tlv_gprmc(self, msg, i, j, rec):
+        # GPRMC sentence, from older receivers
+        rec.position = msg[i:j]
+    
+    def _tlv_position(self, msg, i, j, rec):
+        if j - i >= gps_fix.LEN:
+            rec.position = gps_fix.unpack_from(msg, i)
+    
+    def _tlv_ti_psd(self, msg, i, j, rec):
+        # TI_PSD structure
+        self._interpret_TI_USB(msg[i:j], rec)
+    
+    def _tlv_mac(self, msg, i, j, rec):
+        rec.frame = V = msg[i:j]
+        rec.FCS_OK = True
+        mac = DECODER()
+        try:
             mac.parse(V)
-            self._cur_msg['MAC'] = mac
+        except:
+            self._m_update(M_ERR_MAC.inc, 1)
+            mac = ''
+        rec.MAC = mac
+    
+    def _tlv_trace(self, msg, i, j, rec):
+        trace = unpack_trace(msg, i, j)
+        if trace is not None:
+            rec.trace = trace
     
-    def _interpret_TI_USB(self, V=''):
-        usb = TI_USB()
+    def _interpret_TI_USB(self, V, rec):
         try:
-            usb.map(V)
+            rec.dev_ts, rec.RSSI, rec.FCS_OK, rec.frame = TI_PSD(V)
         except:
+            self._m_update(M_ERR_USB.inc, 1)
             return
-        # process only 802.15.4 frames with correct checksum,
-        # or process all frames if FCS is ignored
-        if self.FCS_IGNORE or usb.TI_CC.FCS():
-            self._cur_msg['dev_ts'] = usb.TS()
-            self._cur_msg['RSSI'] = usb.TI_CC.RSSI()
-            self._cur_msg['frame'] = usb.TI_CC.Payload()
-            self._cur_msg['FCS_OK'] = usb.TI_CC.FCS()
+        # decode only 802.15.4 frames with correct checksum,
+        # or all frames if FCS is ignored
+        if self.FCS_IGNORE or rec.FCS_OK:
             mac = DECODER()
             try:
-                mac.parse(self._cur_msg['frame'])
+                mac.parse(rec.frame)
             except:
+                self._m_update(M_ERR_MAC.inc, 1)
                 mac = ''
-            self._cur_msg['MAC'] = mac
+            rec.MAC = mac
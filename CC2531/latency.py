@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : latency.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the per-frame latency tracing, from the USB read to the output.
+#
+# When receiver.TRACE is set, each forwarded message carries a trace TLV,
+# Tag=0x40, whose value is 3 monotonic times (double, BE): USB read, frame
+# split and forward. The interpreter adds the times of reception, decoding and
+# output, and feeds the tracer, which keeps a latency histogram per stage.
+#
+# Monotonic times are only comparable within a single host: the transit stage
+# is meaningless for remote receivers.
+# Python 2 has no monotonic clock in its standard library: CLOCK_MONOTONIC is
+# read through ctypes (Linux), as time.monotonic() on python 3, otherwise
+# os.times() is used, with a resolution of 10 ms only. Negative latencies,
+# from a clock step, are recorded as 0.
+#
+
+import os
+from struct import pack, unpack_from, calcsize
+from time import time
+from metrics import REGISTRY
+
+def _clock_monotonic():
+    # returns CLOCK_MONOTONIC from the C library, or None
+    try:
+        import ctypes
+    except ImportError:
+        return None
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    for lib in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(lib).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        def mono():
+            ts = timespec()
+            # CLOCK_MONOTONIC
+            clock_gettime(1, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return mono
+    return None
+
+try:
+    from time import monotonic as mono
+except ImportError:
+    mono = _clock_monotonic() or (lambda: os.times()[4])
+
+# export filtering
+__all__ = ['TAG_TRACE', 'mono', 'pack_trace', 'unpack_trace', 'tracer']
+
+def LOG(msg=''):
+    print('[tracer] %s' % msg)
+
+TAG_TRACE = 0x40
+
+_FMT = '!ddd'
+_LEN = calcsize(_FMT)
+
+# stages, between each consecutive times, and the whole pipeline
+STAGES = ('split', 'forward', 'transit', 'decode', 'output', 'total')
+# log-spaced buckets, 10 per decade, from 1 us to 100 s
+BUCKETS = tuple(10 ** (e / 10.0) for e in range(-60, 21))
+
+M_STAGE = REGISTRY.histogram('trace_stage_seconds',
+          'latency of each pipeline stage, for traced frames', ('stage', ),
+          BUCKETS)
+
+def pack_trace(t_read, t_split, t_fwd):
+    # returns the trace TLV
+    return b''.join((pack('!B', TAG_TRACE), pack('!H', _LEN),
+                     pack(_FMT, t_read, t_split, t_fwd)))
+
+def unpack_trace(V, off=0, end=None):
+    # returns the times from the value of a trace TLV, V[off:end], or None
+    if (len(V) if end is None else end) - off < _LEN:
+        return None
+    return unpack_from(_FMT, V, off)
+
+
+class tracer(object):
+    '''
+    Per stage latency histograms, fed with .record() for each traced frame
+    with its 6 monotonic times: USB read, split, forward, interpreter
+    reception, decoding and output.
+    ---
+    .dump() logs p50, p99 and max latencies of each stage, and writes them
+    into .DUMP_FILE when set.
+    '''
+    # debug level
+    DEBUG = 1
+    # file to append dumps to, or None
+    DUMP_FILE = None
+
+    def __init__(self):
+        self._hist = [M_STAGE.labels(s) for s in STAGES]
+        self.max = [0.0] * len(STAGES)
+
+    def record(self, times):
+        last = len(times) - 1
+        for i in range(last):
+            d = max(0.0, times[i+1] - times[i])
+            self._hist[i].observe(d)
+            if d > self.max[i]:
+                self.max[i] = d
+        d = max(0.0, times[last] - times[0])
+        self._hist[last].observe(d)
+        if d > self.max[last]:
+            self.max[last] = d
+
+    def percentile(self, stage, q):
+        # upper bound of the bucket holding the q-th percentile, in second
+        i = STAGES.index(stage)
+        h = self._hist[i]
+        if not h.count:
+            return None
+        n, cum = q * h.count / 100.0, 0
+        for b, c in zip(BUCKETS, h.counts):
+            cum += c
+            if cum >= n:
+                return min(b, self.max[i])
+        return self.max[i]
+
+    def summary(self):
+        lines = []
+        for i, s in enumerate(STAGES):
+            n = self._hist[i].count
+            if not n:
+                continue
+            lines.append('%-8s %8i frames, p50 %10.6f s, p99 %10.6f s, '\
+                         'max %10.6f s' % (s, n, self.percentile(s, 50),
+                         self.percentile(s, 99), self.max[i]))
+        if not lines:
+            lines.append('no traced frame')
+        return lines
+
+    def dump(self):
+        lines = self.summary()
+        for line in lines:
+            LOG(line)
+        if self.DUMP_FILE:
+            try:
+                fd = open(self.DUMP_FILE, 'a')
+            except IOError:
+                LOG('cannot write to %s' % self.DUMP_FILE)
+            else:
+                fd.write('# %s\n%s\n' % (time(), '\n'.join(lines)))
+                fd.close()
@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : lazy.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the lazy import of heavy or optional dependencies (python-libusb1,
+# libmich, NumPy): modules get a stand-in at import time, and the actual
+# module is only imported on first attribute access.
+# Offline tools (decoder.py, capring.py, replay.py...) and --help thus run
+# without libusb, and without paying for the import of libraries they do not
+# use.
+#
+# e.g. usb1 = lazy_module('usb1', 'python libusb1 wrapper')
+#      ...
+#      ctx = usb1.USBContext() # imports usb1, or raises ImportError
+#
+
+# export filtering
+__all__ = ['lazy_module', 'available']
+
+
+class lazy_module(object):
+    '''
+    Stand-in for the module name, imported on first attribute access
+    ---
+    desc : dependency described in the ImportError raised when the module is
+           not available
+    Once imported, the module attributes are copied into the stand-in, so that
+    later accesses cost as much as with the module itself.
+    '''
+
+    def __init__(self, name, desc=None):
+        self._lazy_name = name
+        self._lazy_desc = desc or name
+        self._lazy_mod = None
+
+    def _lazy_load(self):
+        if self._lazy_mod is None:
+            try:
+                mod = __import__(self._lazy_name)
+            except ImportError as err:
+                raise(ImportError('cannot import %s (%s)' \
+                                  % (self._lazy_desc, err)))
+            # __import__ returns the top-level package
+            for sub in self._lazy_name.split('.')[1:]:
+                mod = getattr(mod, sub)
+            self._lazy_mod = mod
+            self.__dict__.update(mod.__dict__)
+        return self._lazy_mod
+
+    def __getattr__(self, attr):
+        # only called for attributes not (yet) copied from the module
+        if attr.startswith('_lazy_'):
+            raise(AttributeError(attr))
+        return getattr(self._lazy_load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._lazy_name,
+               ', imported' if self._lazy_mod is not None else '')
+
+
+def available(mod):
+    # imports a lazy_module() and returns True, or False when not available
+    if not isinstance(mod, lazy_module):
+        return mod is not None
+    try:
+        mod._lazy_load()
+    except ImportError:
+        return False
+    return True
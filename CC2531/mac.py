@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : mac.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is a minimal IEEE 802.15.4 MAC header parser, returning only the
+# addressing fields as integers: it is used for indexing frames (statistics,
+# topology, history...) without the cost of a full libmich decoding.
+# It also provides mac_decoder, the interpreter's 802.15.4 decoder when
+# libmich is not available (e.g. with python 3).
+#
+
+from struct import unpack_from, error as struct_error
+
+# export filtering
+__all__ = ['mac_header', 'addr_str', 'dev_key', 'mac_decoder', 'FRAME_TYPES',
+           'FT_BEACON', 'FT_DATA', 'FT_ACK', 'FT_CMD',
+           'ADDR_NONE', 'ADDR_SHORT', 'ADDR_EXT']
+
+# frame types
+FT_BEACON = 0
+FT_DATA = 1
+FT_ACK = 2
+FT_CMD = 3
+FRAME_TYPES = {
+    FT_BEACON : 'beacon',
+    FT_DATA : 'data',
+    FT_ACK : 'ack',
+    FT_CMD : 'command',
+    }
+# addressing modes
+ADDR_NONE = 0
+ADDR_SHORT = 2
+ADDR_EXT = 3
+# device key flag for short addresses, above any extended address
+_SHORT = 1 << 64
+
+def mac_header(frame):
+    '''
+    returns (frame type, sequence number,
+             dest addr mode, dest PAN, dest addr,
+             source addr mode, source PAN, source addr,
+             header length)
+    from an 802.15.4 MAC frame, PANs and addresses are integers, or None
+    when absent; raises ValueError when the frame is too short
+    '''
+    if len(frame) < 3:
+        raise(ValueError('frame too short'))
+    fc, seq = unpack_from('<HB', frame, 0)
+    ftype = fc & 0x7
+    dam = (fc >> 10) & 0x3
+    sam = (fc >> 14) & 0x3
+    off = 3
+    dpan = daddr = span = saddr = None
+    try:
+        if dam:
+            dpan = unpack_from('<H', frame, off)[0]
+            off += 2
+            if dam == ADDR_SHORT:
+                daddr = unpack_from('<H', frame, off)[0]
+                off += 2
+            else:
+                daddr = unpack_from('<Q', frame, off)[0]
+                off += 8
+        if sam:
+            if fc & 0x40 and dam:
+                # PAN ID compression
+                span = dpan
+            else:
+                span = unpack_from('<H', frame, off)[0]
+                off += 2
+            if sam == ADDR_SHORT:
+                saddr = unpack_from('<H', frame, off)[0]
+                off += 2
+            else:
+                saddr = unpack_from('<Q', frame, off)[0]
+                off += 8
+    except struct_error:
+        raise(ValueError('frame too short'))
+    return ftype, seq, dam, dpan, daddr, sam, span, saddr, off
+
+def addr_str(mode, addr):
+    if addr is None:
+        return '-'
+    if mode == ADDR_EXT:
+        return '%016x' % addr
+    return '0x%04x' % addr
+
+def dev_key(mode, pan, addr):
+    # integer key for a device: short addresses are only unique within a PAN,
+    # extended addresses are unique on their own
+    if mode == ADDR_SHORT:
+        return _SHORT | ((pan or 0) << 16) | addr
+    return addr
+
+
+class mac_decoder(object):
+    '''
+    Minimal stand-in for libmich's IEEE802154 decoder: .parse(frame) decodes
+    the MAC header (see mac_header()), and .show() returns it as text
+    '''
+
+    def parse(self, frame):
+        self._hdr = mac_header(frame)
+        self._len = len(frame)
+
+    def show(self):
+        ftype, seq, dam, dpan, daddr, sam, span, saddr, hl = self._hdr
+        lines = ['### MAC header ###',
+                 '<Frame type : %s>' % FRAME_TYPES.get(ftype, ftype),
+                 '<Sequence number : %i>' % seq]
+        if dpan is not None:
+            lines.append('<Destination PAN : 0x%04x>' % dpan)
+            lines.append('<Destination address : %s>' % addr_str(dam, daddr))
+        if span is not None:
+            lines.append('<Source PAN : 0x%04x>' % span)
+            lines.append('<Source address : %s>' % addr_str(sam, saddr))
+        lines.append('<Payload : %i bytes>' % (self._len - hl))
+        return '\n'.join(lines)
@@ -0,0 +1,279 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : metrics.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the metrics registry of the whole pipeline (USB reads, receivers,
+# interpreter, GPS), exposed over HTTP in the Prometheus text format.
+#
+# Metrics are declared once, at module level, in the module they instrument;
+# instances get their labelled child (e.g. for their dongle) at init, and
+# only increment an attribute afterwards. Counters are not locked: each child
+# is expected to be updated from a single thread.
+#
+
+import socket
+from bisect import bisect_left
+from threading import Thread, Lock
+
+# export filtering
+__all__ = ['REGISTRY', 'metrics_server']
+
+def LOG(msg=''):
+    print('[metrics] %s' % msg)
+
+
+class _child(object):
+    '''
+    Value of a metric for a given set of label values
+    '''
+    __slots__ = ('value', '_fn')
+
+    def __init__(self):
+        self.value = 0
+        self._fn = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        # the value is got from fn() when rendered
+        self._fn = fn
+
+    def get(self):
+        if self._fn is not None:
+            try:
+                return self._fn()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class _hist_child(object):
+    '''
+    Histogram of the values observed for a given set of label values
+    '''
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one more bucket for +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        return repr(v) if v == v else 'NaN'
+    return str(v)
+
+
+class _metric(object):
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+
+    def _new_child(self):
+        return _child()
+
+    def labels(self, *values):
+        '''
+        returns the child for the given label values, to be kept by the
+        caller for updating it
+        '''
+        values = tuple(map(str, values))
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                if values not in self._children:
+                    self._children[values] = self._new_child()
+                return self._children[values]
+
+    def _lbl(self, values, extra=()):
+        pairs = ['%s="%s"' % (n, v.replace('\\', '\\\\').replace('"', '\\"')) \
+                 for n, v in zip(self.labelnames, values)]
+        pairs.extend(extra)
+        if pairs:
+            return '{%s}' % ','.join(pairs)
+        return ''
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for values, child in sorted(self._children.items()):
+            lines.append('%s%s %s' % (self.name, self._lbl(values),
+                                      _fmt(child.get())))
+        return lines
+
+
+class counter(_metric):
+    TYPE = 'counter'
+
+
+class gauge(_metric):
+    TYPE = 'gauge'
+
+
+class histogram(_metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=()):
+        _metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _hist_child(self.buckets)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for values, child in sorted(self._children.items()):
+            cum = 0
+            for b, c in zip(self.buckets + (float('inf'), ), child.counts):
+                cum += c
+                le = '+Inf' if b == float('inf') else _fmt(b)
+                lines.append('%s_bucket%s %i' % (self.name,
+                             self._lbl(values, ('le="%s"' % le, )), cum))
+            lines.append('%s_sum%s %s' % (self.name, self._lbl(values),
+                                          _fmt(child.sum)))
+            lines.append('%s_count%s %i' % (self.name, self._lbl(values),
+                                            child.count))
+        return lines
+
+
+class registry(object):
+    '''
+    Set of metrics, rendered together in the Prometheus text format.
+    Declaring a metric twice returns the existing one.
+    '''
+
+    # default histogram buckets, for durations in second
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, doc, labels=()):
+        return self._get(counter, name, doc, labels)
+
+    def gauge(self, name, doc, labels=()):
+        return self._get(gauge, name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), buckets=None):
+        return self._get(histogram, name, doc, labels,
+                         buckets if buckets is not None else self.BUCKETS)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        lines.append('')
+        return '\n'.join(lines)
+
+REGISTRY = registry()
+
+
+# HTTP server class and request handler, see _http()
+_HTTP = None
+
+def _http():
+    # every module imports the registry, few serve it: the HTTP server is
+    # only imported with the first metrics_server()
+    global _HTTP
+    if _HTTP is None:
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        #
+        class _handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = self.server.registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        #
+        _HTTP = (HTTPServer, _handler)
+    return _HTTP
+
+
+class metrics_server(object):
+    '''
+    HTTP server exposing a registry at /metrics, from a daemon thread
+    '''
+    # debug level
+    DEBUG = 1
+
+    def __init__(self, addr=('127.0.0.1', 9154), registry=REGISTRY):
+        self.addr = addr
+        server, handler = _http()
+        try:
+            self._serv = server(addr, handler)
+        except socket.error:
+            raise(Exception('cannot bind metrics server on %s' % list(addr)))
+        self._serv.registry = registry
+        self._th = None
+
+    def start(self):
+        self._th = Thread(target=self._serv.serve_forever, name='metrics')
+        self._th.daemon = True
+        self._th.start()
+        if self.DEBUG:
+            LOG('serving metrics on http://%s:%i/metrics' % self.addr)
+
+    def stop(self):
+        self._serv.shutdown()
+        self._serv.server_close()
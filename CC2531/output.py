@@ -0,0 +1,343 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : output.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the output of the interpreter: the rendering of decoded frames
+# (see tlv.frame_record) into text, and the sinks the text is written to.
+#
+# Renderers:
+# - compact: a single line per frame, with the MAC addressing fields,
+# - full: the frame in hex and libmich's decoded tree (former output),
+# - hex: a single line per frame, with the frame in hex.
+# The templates and per channel strings are built once, at init.
+# With a zigbee() stage, compact and full renderers append the Zigbee layers
+# it requests (NWK / APS / ZCL), decoded for the rendered frames only.
+#
+# The file sink is complete. The console sink never blocks the interpreter:
+# lines are written by a background thread, and beyond .RATE frames per
+# second, or when the terminal does not keep up, frames are suppressed and
+# only counted in a summary line.
+#
+
+import sys
+from time import time, strftime, localtime
+from binascii import hexlify
+from threading import Thread
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+from CC2531 import CHANNELS
+from gps import gps_fix
+from mac import mac_header, addr_str, FRAME_TYPES
+from zigbee import LAYERS
+
+# hex and text of received bytes, as str with python 2 and 3
+if str is bytes:
+    _hex = hexlify
+    _text = str
+else:
+    def _hex(buf):
+        return hexlify(buf).decode('ascii')
+    def _text(buf):
+        return buf.decode('ascii', 'replace')
+
+# export filtering
+__all__ = ['RENDERERS', 'renderer', 'file_sink', 'console_sink']
+
+def LOG(msg=''):
+    print('[output] %s' % msg)
+
+RENDERERS = ('compact', 'full', 'hex')
+
+
+class renderer(object):
+    '''
+    Render frame records into text with .render(rec), according to the
+    mode given at init (see RENDERERS), and the Zigbee layers of the zigbee()
+    stage, if any
+    '''
+    #
+    # templates, one line per frame for compact and hex
+    COMPACT = '%s ch%2i %4s dBm FCS %-5s %-7s seq %3i %s -> %s len %i%s'
+    HEX = '%s ch%2i %4s dBm FCS %-5s %s'
+    FULL_HEAD = '[+] frame received (FCS %s): %s'
+    # Zigbee layers, compact and full
+    ZB_COMPACT = {
+        'nwk' : ' | nwk 0x%04x -> 0x%04x',
+        'aps' : ' | aps 0x%04x/0x%04x ep %s -> %s',
+        'zcl' : ' | zcl cmd 0x%02x',
+        }
+    ZB_FULL = {
+        'nwk' : 'Zigbee NWK: type %i, version %i, 0x%04x -> 0x%04x, radius %i, '\
+                'seq %i',
+        'aps' : 'Zigbee APS: type %i, profile 0x%04x, cluster 0x%04x, '\
+                'endpoint %s -> %s, counter %i',
+        'zcl' : 'Zigbee ZCL: type %i, manufacturer %s, %s, seq %i, command 0x%02x',
+        }
+
+    def __init__(self, mode='full', zigbee=None):
+        if mode not in RENDERERS:
+            raise(Exception('unknown renderer %r' % mode))
+        self.mode = mode
+        self._zb = zigbee
+        self.render = getattr(self, '_render_%s' % mode)
+        # per channel strings
+        self._chan = dict((c, 'channel: %i, %i MHz' % (c, f)) \
+                          for c, f in CHANNELS.items())
+        # the time string is computed once per second
+        self._sec = None
+        self._sec_str = ''
+
+    def _time(self, ts):
+        sec = int(ts)
+        if sec != self._sec:
+            self._sec = sec
+            self._sec_str = strftime('%Y-%m-%d %H:%M:%S', localtime(sec))
+        return self._sec_str
+
+    def _render_compact(self, rec):
+        t = '%s.%03i' % (self._time(rec.timestamp),
+                         int((rec.timestamp % 1) * 1000))
+        try:
+            ftype, seq, dam, dpan, daddr, sam, span, saddr, hl = \
+                mac_header(rec.frame)
+        except ValueError:
+            return self.HEX % (t, rec.channel,
+                               '-' if rec.RSSI is None else rec.RSSI,
+                               'OK' if rec.FCS_OK else 'error',
+                               _hex(rec.frame))
+        if isinstance(rec.position, gps_fix):
+            pos = ' at %.6f, %.6f' % (rec.position.lat, rec.position.lon)
+        else:
+            pos = ''
+        line = self.COMPACT % (t, rec.channel,
+                               '-' if rec.RSSI is None else rec.RSSI,
+                               'OK' if rec.FCS_OK else 'error',
+                               FRAME_TYPES.get(ftype, 'type%i' % ftype), seq,
+                               self._addr(span, sam, saddr),
+                               self._addr(dpan, dam, daddr),
+                               len(rec.frame), pos)
+        if self._zb is None or not self._zb.layers:
+            return line
+        return line + ''.join(self._zigbee(rec, self.ZB_COMPACT))
+
+    def _zigbee(self, rec, tmpl):
+        # Zigbee layers requested, rendered with tmpl
+        zb, res = self._zb, []
+        for layer in LAYERS:
+            if layer not in zb.layers:
+                continue
+            hdr = zb.get(rec, layer)
+            if hdr is None:
+                break
+            if layer == 'nwk':
+                if tmpl is self.ZB_FULL:
+                    args = hdr[0], hdr[1], hdr[3], hdr[2], hdr[4], hdr[5]
+                else:
+                    args = hdr[3], hdr[2]
+            elif layer == 'aps':
+                if hdr[4] is None:
+                    # APS command or acknowledgement
+                    break
+                sep = '-' if hdr[6] is None else hdr[6]
+                dep = 'group 0x%04x' % hdr[3] if hdr[2] is None else hdr[2]
+                if tmpl is self.ZB_FULL:
+                    args = hdr[0], hdr[5], hdr[4], sep, dep, hdr[7]
+                else:
+                    args = hdr[5], hdr[4], sep, dep
+            else:
+                if tmpl is self.ZB_FULL:
+                    args = (hdr[0], '-' if hdr[1] is None else '0x%04x' % hdr[1],
+                            'to client' if hdr[2] else 'to server', hdr[3],
+                            hdr[4])
+                else:
+                    args = (hdr[4], )
+            res.append(tmpl[layer] % args)
+        return res
+
+    @staticmethod
+    def _addr(pan, mode, addr):
+        if pan is None:
+            return addr_str(mode, addr)
+        return '0x%04x/%s' % (pan, addr_str(mode, addr))
+
+    def _render_hex(self, rec):
+        return self.HEX % ('%s.%03i' % (self._time(rec.timestamp),
+                                        int((rec.timestamp % 1) * 1000)),
+                           rec.channel, '-' if rec.RSSI is None else rec.RSSI,
+                           'OK' if rec.FCS_OK else 'error', _hex(rec.frame))
+
+    def _render_full(self, rec):
+        lines = [self.FULL_HEAD % ('OK' if rec.FCS_OK else 'error',
+                                   self._time(rec.timestamp))]
+        if rec.position is not None:
+            if isinstance(rec.position, gps_fix):
+                lines.append('position: %r' % rec.position)
+            else:
+                lines.append('position (GPRMC): %s' % _text(rec.position))
+        lines.append(self._chan[rec.channel])
+        if rec.RSSI is not None:
+            lines.append('RSSI: %i' % rec.RSSI)
+        lines.append('IEEE 802.15.4 frame: %s' % _hex(rec.frame))
+        try:
+            lines.append('IEEE 802.15.4 MAC:\n%s\n' % rec.MAC.show())
+        except:
+            lines.append('IEEE 802.15.4 MAC: -decoding error-\n')
+        if self._zb is not None and self._zb.layers:
+            zb = self._zigbee(rec, self.ZB_FULL)
+            if zb:
+                lines.extend(zb)
+                lines.append('')
+        return '\n'.join(lines)
+
+
+class file_sink(object):
+    '''
+    Append every output to a file, buffered and flushed with .flush();
+    the sink is disabled on the first write error (e.g. disk full)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, 'a')
+        self._fd.write(''.join((20*'#', '\n',
+                                '# 802.15.4 interpreter session\n',
+                                '# %s\n' % strftime('%Y-%m-%d %H:%M:%S',
+                                                    localtime()),
+                                20*'#', '\n')))
+
+    def write(self, text):
+        if self._fd is None:
+            return
+        try:
+            self._fd.write(text)
+            self._fd.write('\n')
+        except IOError as err:
+            self._failed(err)
+
+    def flush(self):
+        if self._fd is None:
+            return
+        try:
+            self._fd.flush()
+        except IOError as err:
+            self._failed(err)
+
+    def _failed(self, err):
+        LOG('cannot write output to %s (%s), file output disabled' \
+            % (self.path, err))
+        fd, self._fd = self._fd, None
+        try:
+            fd.close()
+        except IOError:
+            pass
+
+    def close(self):
+        self.flush()
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class console_sink(object):
+    '''
+    Write outputs to a stream (stdout by default) from a background thread,
+    at most .RATE outputs per second (0: no limit) and .QUEUE pending ones;
+    the outputs beyond are suppressed, and their number reported once per
+    second
+    '''
+    # maximum number of outputs per second, 0 for no limit
+    RATE = 50
+    # maximum number of outputs waiting for a slow terminal
+    QUEUE = 1024
+    # maximum time (in second) to wait for the terminal when closing
+    CLOSE_TO = 2.0
+
+    def __init__(self, stream=None, rate=None):
+        self._stream = stream or sys.stdout
+        self.rate = self.RATE if rate is None else rate
+        self._queue = Queue(self.QUEUE)
+        # current 1 second window
+        self._win = 0
+        self._count = 0
+        self.suppressed = 0
+        self.suppressed_total = 0
+        self._th = Thread(target=self._run, name='console')
+        self._th.daemon = True
+        self._th.start()
+
+    def write(self, text):
+        now = time()
+        if now >= self._win + 1.0:
+            self._report()
+            self._win, self._count = now, 0
+        if self.rate and self._count >= self.rate:
+            self._suppress()
+            return
+        self._count += 1
+        try:
+            self._queue.put_nowait(text)
+        except Full:
+            self._suppress()
+
+    def _suppress(self):
+        self.suppressed += 1
+        self.suppressed_total += 1
+
+    def _report(self):
+        if self.suppressed:
+            try:
+                self._queue.put_nowait('[-] %i frames suppressed on the '\
+                                       'console' % self.suppressed)
+            except Full:
+                return
+            self.suppressed = 0
+
+    def flush(self):
+        # reports the outputs suppressed during the last window
+        if time() >= self._win + 1.0:
+            self._report()
+
+    def close(self):
+        self._report()
+        try:
+            self._queue.put(None, timeout=self.CLOSE_TO)
+        except Full:
+            # the terminal is stalled: the outputs left are dropped with the
+            # daemon thread
+            return
+        self._th.join(self.CLOSE_TO)
+
+    def _run(self):
+        stream, queue = self._stream, self._queue
+        while True:
+            text = queue.get()
+            if text is None:
+                break
+            try:
+                stream.write(text)
+                stream.write('\n')
+                if queue.empty():
+                    stream.flush()
+            except (IOError, ValueError):
+                pass
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : profiler.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the sampling profiler, to see where the CPU goes within a running
+# sniffer, without restarting it.
+#
+# When started, a thread samples the stacks of all other threads of the
+# process (sys._current_frames()) during .DURATION, and writes them in the
+# collapsed stack format (one line per distinct stack: frames separated with
+# ';' and the number of samples), rooted with the thread name (receiver,
+# forwarder, interpreter, GPS...), ready for flame graph tools.
+#
+
+import sys
+import threading
+from time import time, sleep, strftime, localtime
+
+# export filtering
+__all__ = ['profiler']
+
+def LOG(msg=''):
+    print('[profiler] %s' % msg)
+
+
+class profiler(object):
+    '''
+    Sample the stacks of all threads every .INTERVAL second(s) during
+    .DURATION second(s), from a background thread started with .start(),
+    and write them into .OUTPUT_FILE (collapsed stacks format).
+    ---
+    Only a single profiling runs at a time: .start() returns False when one
+    is already running.
+    '''
+    # debug level
+    DEBUG = 1
+    # sampling period and duration (in second)
+    INTERVAL = 0.005
+    DURATION = 10.0
+    # output file, %s is replaced with the start time
+    OUTPUT_FILE = '/tmp/cc2531_profile_%s.txt'
+
+    def __init__(self):
+        self._th = None
+        self.samples = 0
+
+    def running(self):
+        return self._th is not None and self._th.is_alive()
+
+    def start(self, duration=None):
+        if self.running():
+            if self.DEBUG:
+                LOG('already profiling')
+            return False
+        if duration is None:
+            duration = self.DURATION
+        self._th = threading.Thread(target=self._run, args=(duration, ),
+                                    name='profiler')
+        self._th.daemon = True
+        self._th.start()
+        return True
+
+    def _run(self, duration):
+        path = self.OUTPUT_FILE % strftime('%Y%m%d-%H%M%S', localtime())
+        if self.DEBUG:
+            LOG('profiling all threads for %.1fs' % duration)
+        stacks = self.sample(duration)
+        try:
+            self.write(stacks, path)
+        except IOError:
+            LOG('cannot write profile to %s' % path)
+            return
+        if self.DEBUG:
+            LOG('%i samples, %i stacks written to %s' \
+                % (self.samples, len(stacks), path))
+
+    def sample(self, duration):
+        '''
+        returns a dict of collapsed stack -> number of samples
+        '''
+        me = threading.current_thread().ident
+        stacks = {}
+        self.samples = 0
+        # code object -> frame label, as the same code is sampled repeatedly
+        labels = {}
+        end = time() + duration
+        while time() < end:
+            names = dict((th.ident, th.name) for th in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    try:
+                        stack.append(labels[code])
+                    except KeyError:
+                        lbl = labels[code] = '%s (%s)' % (code.co_name,
+                              code.co_filename.rsplit('/', 1)[-1])
+                        stack.append(lbl)
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread %i' % ident))
+                stack.reverse()
+                key = ';'.join(stack)
+                stacks[key] = stacks.get(key, 0) + 1
+            # release the frames before sleeping
+            frame = None
+            self.samples += 1
+            sleep(self.INTERVAL)
+        return stacks
+
+    @staticmethod
+    def write(stacks, path):
+        fd = open(path, 'w')
+        try:
+            for stack in sorted(stacks):
+                fd.write('%s %i\n' % (stack, stacks[stack]))
+        finally:
+            fd.close()
@@ -31,7 +31,14 @@ import socket
 import signal
 from struct import pack, unpack
 from time import time, sleep
+from threading import Thread, Event
 from CC2531 import *
+from spool import *
+from uplink import *
+from gps import gps_fix
+from metrics import REGISTRY
+from latency import mono, pack_trace
+from capring import capture_ring
 
 # export filtering
 __all__ = ['receiver']
@@ -47,6 +54,88 @@ def LOG(msg=''):
 def siesta():
     sleep(T_PAUSE)
 
+# metrics, per dongle (USB bus:address)
+M_FRAMES = REGISTRY.counter('receiver_frames_total',
+           'radio frames split from USB buffers', ('dongle', ))
+M_SENT = REGISTRY.counter('receiver_messages_sent_total',
+         'messages sent to the interpreter', ('dongle', ))
+M_SENT_BYTES = REGISTRY.counter('receiver_sent_bytes_total',
+               'bytes sent to the interpreter', ('dongle', ))
+M_SEND_ERRORS = REGISTRY.counter('receiver_send_errors_total',
+                'failed sends and connections to the interpreter', ('dongle', ))
+M_SPOOLED = REGISTRY.counter('receiver_spooled_total',
+            'messages written into the spool', ('dongle', ))
+M_DROPS = REGISTRY.counter('receiver_dropped_total',
+          'messages dropped (interpreter unreachable, full spool)', ('dongle', ))
+M_BATCHES = REGISTRY.counter('receiver_batches_total',
+            'batches of frames sent', ('dongle', ))
+M_RING_DEPTH = REGISTRY.gauge('receiver_ring_depth',
+               'USB buffers queued for the forwarder thread', ('dongle', ))
+M_RING_OVERFLOW = REGISTRY.gauge('receiver_ring_overflow',
+                  'USB buffers dropped on a full ring', ('dongle', ))
+M_DWELL = REGISTRY.counter('receiver_dwell_seconds_total',
+          'time spent sniffing on each channel', ('dongle', 'channel'))
+
+class frame_ring(object):
+    '''
+    Bounded ring of raw USB buffers, shared between a single producer
+    (the USB read loop) and a single consumer (the forwarder).
+    ---
+    All slots are preallocated at init: .put() only stores references 
+    and moves the head index, it never blocks; when the ring is full, 
+    the buffer is dropped and the .overflow counter is incremented.
+    .hwm keeps the highest number of buffers queued at the same time.
+    '''
+    
+    def __init__(self, size=256):
+        self._size = max(1, int(size))
+        self._data = [None] * self._size
+        self._chan = [0] * self._size
+        self._ts = [0.0] * self._size
+        self._mono = [0.0] * self._size
+        # head and tail are only written by the producer and the consumer
+        # respectively
+        self._head = 0
+        self._tail = 0
+        self._ready = Event()
+        # counters
+        self.cnt = 0
+        self.hwm = 0
+        self.overflow = 0
+    
+    def __len__(self):
+        return self._head - self._tail
+    
+    def put(self, data, chan, ts, t_read=0.0):
+        head = self._head
+        depth = head - self._tail
+        if depth >= self._size:
+            self.overflow += 1
+            return False
+        i = head % self._size
+        self._data[i], self._chan[i], self._ts[i] = data, chan, ts
+        self._mono[i] = t_read
+        self._head = head + 1
+        self.cnt += 1
+        if depth >= self.hwm:
+            self.hwm = depth + 1
+        self._ready.set()
+        return True
+    
+    def get(self, timeout=None):
+        if self._tail == self._head:
+            # clear before checking again, to not miss a .put() wake-up
+            self._ready.clear()
+            if self._tail == self._head:
+                self._ready.wait(timeout)
+            if self._tail == self._head:
+                return None
+        i = self._tail % self._size
+        item = (self._data[i], self._chan[i], self._ts[i], self._mono[i])
+        self._data[i] = None
+        self._tail += 1
+        return item
+
 class receiver(object):
     '''
     Drive a single TI CC2531 802.15.4 dongle.
@@ -62,14 +151,26 @@ class receiver(object):
     Tag : uint8, Length : uint16, Value : char*[Length]
     T=0x01, 802.15.4 channel, uint8
     T=0x02, epoch time at frame reception, ascii encoded
-    T=0x03, position at frame reception (if positionning server -GPS- available)
+    T=0x04, position at frame reception (if positionning server -GPS- available)
+            packed gps_fix: latitude, longitude (double), altitude, speed
+            (float), fix time (double), validity (uint8)
             modify .get_position() method to adapt it to work with your GPS
             current .get_position() method uses the gps.py file to read GPS info
             from a /dev/ttyUSB serial GPS
+    (T=0x03, GPRMC position at frame reception, ascii, is still accepted by
+            the interpreter)
     T=0x10, 802.15.4 frame within TI USB frame structure (default CC2531 behavior)
     T=0x20, 802.15.4 frame
+    T=0x40, monotonic times of USB read, split and forward (when .TRACE is
+            set, see latency.py)
     ---
     Each of this TLV structure is prefixed with a uint32 total length indication
+    ---
+    When .SOCK_STREAM is set, frames are forwarded over a stream connection
+    (TCP or UNIX file socket), reconnected with an exponential backoff when 
+    lost. While the interpreter is unreachable, frames are kept in an
+    on-disk spool (if .SPOOL_FILE is set) and replayed on reconnection.
+    Over datagrams, a message which cannot be sent is dropped alone.
     '''
     # debug level
     DEBUG = 1
@@ -81,26 +182,92 @@ class receiver(object):
     # str -> file socket, tuple -> udp socket
     #SOCK_ADDR = '/tmp/cc2531_sniffer'
     SOCK_ADDR = ('127.10.0.1', 2154)
+    # stream (TCP / file) socket instead of datagram (UDP / file) socket
+    SOCK_STREAM = False
+    # time (in second) for a stream connection or send to complete
+    SEND_TO = 2.0
+    # reconnection backoff (in second), from RECONN_MIN doubling up to 
+    # RECONN_MAX
+    RECONN_MIN = 0.5
+    RECONN_MAX = 30.0
+    #
+    # on-disk spool while the interpreter is unreachable, None to disable
+    # (%s is replaced with the USB bus and address of the dongle); stream
+    # sockets only: datagrams are sent even when no one is listening
+    #SPOOL_FILE = '/tmp/cc2531_spool_%s'
+    SPOOL_FILE = None
+    # maximum spool size, in bytes
+    SPOOL_SIZE = 64*1024*1024
+    # size of the spool chunks read for replay, in bytes
+    SPOOL_CHUNK = 65536
+    #
+    # batched uplink: frames are gathered during UPLINK_BATCH second(s), 
+    # delta-encoded and compressed into a single message (see uplink.py),
+    # 0 to forward each frame in its own message
+    UPLINK_BATCH = 0
+    # compression codec ('zlib', 'lzma' or None) and level
+    UPLINK_CODEC = 'zlib'
+    UPLINK_LEVEL = 6
+    # maximum size of the records gathered in a batch, in bytes (see
+    # uplink.record_len(), at most uplink.BLOCK_MAXLEN)
+    UPLINK_MAXLEN = 32768
     
     # 802.15.4 channels to walk over
     CHAN_LIST = CHANNELS.keys()
     # time (in second) before changing the channel
     CHAN_PERIOD = 1
     
+    # number of USB buffers queued between the USB read loop and the 
+    # forwarder thread, 0 to read and forward within the same thread
+    RING_SIZE = 0
+    
     # GPS service for get_position()
     # check gps.py for dealing with GPS running over serial USB and NMEA infos
     GPS = None
+    # add the position to each frame, or leave it to the interpreter to 
+    # geotag frames afterwards from the GPS track (see gps_track)
+    POSITION = True
+    
+    # add the latency trace TLV to each message
+    TRACE = False
+    
+    # memory-mapped ring file recording every USB buffer as read, whatever
+    # happens to the forwarding (see capring.py), None to disable
+    # (%s is replaced with the USB bus and address of the dongle)
+    #CAPTURE_FILE = '/tmp/cc2531_capture_%s'
+    CAPTURE_FILE = None
+    # capture ring size, in bytes
+    CAPTURE_SIZE = 64*1024*1024
     
     def __init__(self, cc2531):
         self._cc = cc2531
         if not isinstance(self._cc, CC2531):
             raise(Exception('init with a CC2531 instance'))
+        self._dongle = '%i:%i' % (self._cc._usb_bus, self._cc._usb_addr)
         # init socket connectivity
         self._init_sock()
+        # init raw capture ring
+        if self.CAPTURE_FILE:
+            self._capture = capture_ring(self.CAPTURE_FILE % ('%i_%i' \
+                                % (self._cc._usb_bus, self._cc._usb_addr)),
+                                self.CAPTURE_SIZE)
+        else:
+            self._capture = None
         # init dongle
         self._cc.init()
         self._chan = 0
         self._listening = False
+        self._ring = None
+        self._forwarding = False
+        self._batch = []
+        self._batch_len = 0
+        self._batch_trace = None
+        self._tune_t = None
+        # last error which stopped .listen()
+        self.error = None
+        # metrics
+        self._m_frames = M_FRAMES.labels(self._dongle)
+        self._m_batches = M_BATCHES.labels(self._dongle)
         # catch SIGINT
         if not self._THREADED:
             def handle_int(signum, frame):
@@ -114,47 +281,158 @@ class receiver(object):
     
     def _init_sock(self):
         if isinstance(self.SOCK_ADDR, str):
-            self._init_file_sock()
+            self._sk_fam = socket.AF_UNIX
+            info = 'file socket %s' % self.SOCK_ADDR
         elif isinstance(self.SOCK_ADDR, tuple) and len(self.SOCK_ADDR) == 2 \
         and isinstance(self.SOCK_ADDR[0], str) and isinstance(self.SOCK_ADDR[1], int):
-            self._init_udp_sock()
+            self._sk_fam = socket.AF_INET
+            info = '%s socket %s' % ('TCP' if self.SOCK_STREAM else 'UDP',
+                                     list(self.SOCK_ADDR))
         else:
             raise(Exception('bad SOCK_ADDR parameter'))
-    
-    def _init_file_sock(self):
-        # if needed, create file sock
-        if not os.path.exists(self.SOCK_ADDR):
-            raise(Exception('file socket server does not exist yet'))
-        self._sk = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if self.SOCK_STREAM:
+            self._sk_type = socket.SOCK_STREAM
+        else:
+            self._sk_type = socket.SOCK_DGRAM
+        #
+        if self.SPOOL_FILE and not self.SOCK_STREAM:
+            self._log('spool ignored: it requires a stream socket')
+            self._spool = None
+        elif self.SPOOL_FILE:
+            self._spool = spool(self.SPOOL_FILE % ('%i_%i' \
+                                % (self._cc._usb_bus, self._cc._usb_addr)),
+                                self.SPOOL_SIZE)
+        else:
+            self._spool = None
+        #
+        self._m_sent = M_SENT.labels(self._dongle)
+        self._m_sent_bytes = M_SENT_BYTES.labels(self._dongle)
+        self._m_send_errors = M_SEND_ERRORS.labels(self._dongle)
+        self._m_spooled = M_SPOOLED.labels(self._dongle)
+        self._m_drops = M_DROPS.labels(self._dongle)
+        #
+        self._sk = None
+        self._up = False
+        self._reconn_t = 0
+        self._reconn_to = self.RECONN_MIN
+        self._reconnect()
         if self.DEBUG:
-            self._log('forwarding to file socket %s' % self.SOCK_ADDR)
+            self._log('forwarding to %s' % info)
+    
+    def _reconnect(self):
+        if time() < self._reconn_t:
+            return False
+        if self._sk is None:
+            self._sk = socket.socket(self._sk_fam, self._sk_type)
+            if self.SOCK_STREAM:
+                self._sk.settimeout(self.SEND_TO)
+                try:
+                    self._sk.connect(self.SOCK_ADDR)
+                except socket.error as err:
+                    self._m_send_errors.inc()
+                    self._down(err)
+                    return False
+                if self.DEBUG:
+                    self._log('connected to %s' % repr(self.SOCK_ADDR))
+        # datagram sockets are always up: a failed send only drops its message
+        self._up = True
+        return True
+    
+    def _down(self, err):
+        if self._up and self.DEBUG:
+            self._log('interpreter unreachable: %s' % err)
+        self._up = False
+        if self.SOCK_STREAM and self._sk is not None:
+            # a partially sent message is discarded when the stream is closed
+            self._sk.close()
+            self._sk = None
+        self._reconn_t = time() + self._reconn_to
+        self._reconn_to = min(2*self._reconn_to, self.RECONN_MAX)
+    
+    def _sendmsg(self, data):
+        try:
+            if self.SOCK_STREAM:
+                self._sk.sendall(data)
+            else:
+                self._sk.sendto(data, self.SOCK_ADDR)
+        except socket.error as err:
+            self._m_send_errors.inc()
+            if self.SOCK_STREAM:
+                self._down(err)
+            elif self.DEBUG > 1:
+                self._log('datagram dropped: %s' % err)
+            return False
+        self._reconn_to = self.RECONN_MIN
+        self._m_sent.inc()
+        self._m_sent_bytes.inc(len(data))
+        return True
     
-    def _init_udp_sock(self):
-        self._sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def _replay(self):
+        # forward the spooled messages, in order, at full speed, over the
+        # stream socket (the spool requires one)
+        sp = self._spool
+        while len(sp):
+            buf = sp.peek(self.SPOOL_CHUNK)
+            mv, sent = memoryview(buf), 0
+            try:
+                while sent < len(buf):
+                    sent += self._sk.send(mv[sent:])
+            except socket.error as err:
+                sp.consume(sp.boundary(buf, sent))
+                self._m_send_errors.inc()
+                self._down(err)
+                return False
+            sp.consume(sent)
+            self._m_sent_bytes.inc(sent)
         if self.DEBUG:
-            self._log('forwarding to UDP socket %s' % list(self.SOCK_ADDR))
+            self._log('spool replayed')
+        return True
+    
+    def _spoolmsg(self, data):
+        if self._spool is not None and self._spool.push(data):
+            self._m_spooled.inc()
+            return len(data)
+        self._m_drops.inc()
+        return 0
     
-    def send(self, data=''):
-        if not hasattr(self, '_sk') or not isinstance(data, str):
+    def send(self, data=b''):
+        if not isinstance(data, bytes):
             return 0
-        return self._sk.sendto(data, self.SOCK_ADDR)
+        if not self._up and not self._reconnect():
+            return self._spoolmsg(data)
+        # replay spooled messages first, to keep them in order
+        if self._spool is not None and len(self._spool) and not self._replay():
+            return self._spoolmsg(data)
+        if self._sendmsg(data):
+            return len(data)
+        return self._spoolmsg(data)
     
     def get_position(self, *args, **kwargs):
-        #pass
-        if hasattr(self, 'GPS') and hasattr(self.GPS, 'get_last_info'):
-            #print self.GPS.infos
-            return self.GPS.get_last_info('GPRMC')
+        # returns the last gps_fix from the GPS service, or None:
+        # it is a ready-made immutable object, no parsing nor locking here
+        if hasattr(self.GPS, 'get_fix'):
+            return self.GPS.get_fix()
     
     def stop(self):
-        if self._listening:
-            self._listening = False
-            siesta()
-            self._cc.stop_capture()
-        self._cc.init()
-        #siesta()
-        self._cc.close()
+        try:
+            if self._listening:
+                self._listening = False
+                siesta()
+                self._cc.stop_capture()
+            self._cc.init()
+            #siesta()
+            self._cc.close()
+        except Exception as err:
+            # the dongle may be gone already
+            if self.DEBUG:
+                self._log('cannot release the dongle: %r' % err)
         #self.send( '\0' )
-        self._sk.close()
+        if self._sk is not None:
+            self._sk.close()
+        if self._spool is not None:
+            self._spool.close()
+        if self._capture is not None:
+            self._capture.close()
     
     def looping(self):
         if not self._listening:
@@ -169,62 +447,177 @@ class receiver(object):
     
     def listen(self):
         self._listening = True
+        self.error = None
         self._log('start listening on channel(s): %s' % self.CHAN_LIST)
+        if self.RING_SIZE:
+            self._start_forwarder()
         #
-        # multi-channel hopping monitor
-        if len(self.CHAN_LIST) > 1:
-            while self.looping() :
-                for c in self.CHAN_LIST:
-                    if self.looping():
-                        self._chan = c
-                        if self.DEBUG:
-                            self._log('sniffing on channel %i' % self._chan)
-                        self._cc.init()
-                        self._cc.config(c)
-                        self._cc.start_capture()
+        # .CHAN_LIST can be replaced while listening (e.g. by the supervisor):
+        # the new list is taken at the next channel hop
+        try:
+            while self.looping():
+                chans = self.CHAN_LIST
+                # single channel monitor
+                if len(chans) == 1:
+                    self.tune(chans[0])
+                    while self.looping() and self.CHAN_LIST is chans:
+                        self.read_frames()
+                    self._cc.stop_capture()
+                # multi-channel hopping monitor
+                elif len(chans) > 1:
+                    for c in chans:
+                        if not self.looping() or self.CHAN_LIST is not chans:
+                            break
+                        self.tune(c)
                         T0 = time()
                         while self.looping() and (time()-T0 < self.CHAN_PERIOD):
                             self.read_frames()
                         self._cc.stop_capture()
+                # no channel to monitor
+                else:
+                    siesta()
+        except Exception as err:
+            # USB error: the dongle is left to the supervisor, if any
+            self.error = err
+            self._listening = False
+            self._log('stopped on error: %r' % err)
         #
-        # single channel monitor
-        elif len(self.CHAN_LIST) == 1:
-            self._chan = self.CHAN_LIST[0]
-            if self.DEBUG:
-                self._log('sniffing on channel %i' % self._chan)
-            self._cc.init()
-            self._cc.config(self._chan)
-            self._cc.start_capture()
-            while self.looping():
-                self.read_frames()
-            self._cc.stop_capture()
-                
+        if self._ring is not None:
+            self._stop_forwarder()
+        self.flush_batch()
+    
+    def tune(self, chan):
+        # (re)start the capture on the given channel
+        now = time()
+        if self._tune_t is not None:
+            M_DWELL.labels(self._dongle, self._chan).inc(now - self._tune_t)
+        self._tune_t = now
+        self._chan = chan
+        if self.DEBUG:
+            self._log('sniffing on channel %i' % self._chan)
+        self._cc.init()
+        self._cc.config(chan)
+        self._cc.start_capture()
+    
+    def _start_forwarder(self):
+        self._ring = frame_ring(self.RING_SIZE)
+        self._forwarding = True
+        M_RING_DEPTH.labels(self._dongle).set_function(self._ring.__len__)
+        ring = self._ring
+        M_RING_OVERFLOW.labels(self._dongle).set_function(lambda: ring.overflow)
+        self._fwd_th = Thread(target=self._forward_loop,
+                              name='forwarder %s' % self._dongle)
+        self._fwd_th.daemon = True
+        self._fwd_th.start()
+    
+    def _stop_forwarder(self):
+        # the forwarder drains the ring before returning
+        self._forwarding = False
+        self._fwd_th.join()
+        if self.DEBUG:
+            self._log('ring: %i buffers queued, high-water mark %i / %i, '\
+                      '%i overflow(s)' % (self._ring.cnt, self._ring.hwm,
+                      self.RING_SIZE, self._ring.overflow))
+        self._ring = None
+    
+    def _forward_loop(self):
+        ring = self._ring
+        while self._forwarding or len(ring):
+            item = ring.get(T_PAUSE)
+            if item is not None:
+                self.split_frames(*item)
+            else:
+                self.poll_batch()
+    
     def read_frames(self):
         data = self._cc.read_data()
         if len(data) == 0:
+            if self._ring is None:
+                self.poll_batch()
             siesta()
+        else:
+            self.handle_data(data)
+    
+    def handle_data(self, data):
+        t_read = mono() if self.TRACE else 0.0
+        if self._capture is not None:
+            ts = time()
+            self._capture.write(data, self._chan, ts)
+        else:
+            ts = None
+        if self._ring is not None:
+            # only queue the raw buffer, the forwarder thread does the rest
+            self._ring.put(data, self._chan, ts or time(), t_read)
+        else:
+            self.split_frames(data, self._chan, ts, t_read)
+    
+    def split_frames(self, data, chan=None, ts=None, t_read=0.0):
         # multiple radio frames can be concatenated into a single USB bulk 
         # transfer: they are split here
+        t_split = mono() if self.TRACE else 0.0
         while len(data) > 7:
             l = unpack('<H', data[1:3])[0]
-            self.forward(data[:l+3])
+            self._m_frames.inc()
+            self.forward(data[:l+3], chan, ts, (t_read, t_split))
             data = data[l+3:]
     
-    def forward(self, data=5*'\0'):
+    def forward(self, data=5*b'\0', chan=None, ts=None, trace=None):
+        if chan is None:
+            chan = self._chan
+        if ts is None:
+            ts = time()
+        p = self.get_position() if self.POSITION else None
+        if self.UPLINK_BATCH:
+            pos = p.packed if p else None
+            rec_len = record_len(data, pos)
+            if self._batch and (self._batch_len + rec_len > BLOCK_MAXLEN \
+            or ts - self._batch[-1][1] > DT_MAX):
+                # the record would not fit in this batch
+                self.flush_batch()
+            if self.TRACE and not self._batch and trace is not None:
+                # a batch is traced with its first frame
+                self._batch_trace = trace
+            self._batch.append( (chan, ts, pos, data) )
+            self._batch_len += rec_len
+            if self._batch_len >= self.UPLINK_MAXLEN \
+            or ts - self._batch[0][1] >= self.UPLINK_BATCH:
+                self.flush_batch()
+            return
         # add channel TLV
-        dgram = [ '\x01\x00\x01%s' % chr(self._chan) ]
+        dgram = [ b'\x01\x00\x01', pack('!B', chan) ]
         # add time TLV
-        t = str(time())
-        dgram.append( '\x02%s%s' % (pack('!H', len(t)), t) )
+        t = str(ts).encode('ascii')
+        dgram.extend( (b'\x02', pack('!H', len(t)), t) )
         # eventually add position TLV
-        p = self.get_position()
         if p:
-            dgram.append( '\x03%s%s' % (pack('!H', len(p)), str(p)) )
+            dgram.extend( (b'\x04', pack('!H', gps_fix.LEN), p.packed) )
         # add TI USB frame structure
-        dgram.append( '\x10%s%s' % (pack('!H', len(data)), data) )
+        dgram.extend( (b'\x10', pack('!H', len(data)), data) )
+        # eventually add trace TLV
+        if self.TRACE and trace is not None:
+            dgram.append( pack_trace(trace[0], trace[1], mono()) )
         #
         # send dgram frame to the server
-        frame = ''.join(dgram)
+        frame = b''.join(dgram)
         frame_len = pack('!I', len(frame))
-        self.send( ''.join((frame_len, frame)) )
+        self.send( b''.join((frame_len, frame)) )
         #print('forward msg: %s' % frame.encode('hex')) 
+    
+    def poll_batch(self):
+        # forward the current batch if its time window elapsed
+        if self._batch and time() - self._batch[0][1] >= self.UPLINK_BATCH:
+            self.flush_batch()
+    
+    def flush_batch(self):
+        if not self._batch:
+            return
+        v = pack_batch(self._batch, self.UPLINK_CODEC, self.UPLINK_LEVEL)
+        self._batch, self._batch_len = [], 0
+        self._m_batches.inc()
+        frame = b''.join((pack('!B', TAG_BATCH), pack('!H', len(v)), v))
+        if self._batch_trace is not None:
+            # the trace TLV follows the batch TLV
+            frame += pack_trace(self._batch_trace[0], self._batch_trace[1],
+                                mono())
+            self._batch_trace = None
+        self.send( b''.join((pack('!I', len(frame)), frame)) )
@@ -0,0 +1,256 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : replay.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the replay of recorded traffic to an interpreter, for load testing:
+# the datagrams of a pcap file (UDP to port 2154), or the messages of a spool
+# file (see spool.py), are sent again to an interpreter socket, at their
+# original timing, N times faster, at a fixed rate or as fast as possible.
+#
+# With the interpreter metrics endpoint (see metrics.py), the messages
+# actually decoded by the interpreter are counted, to report the loss.
+#
+
+import re
+import sys
+import socket
+import argparse
+from struct import unpack
+from time import time, sleep
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+from capture import read_pcap, UDP_PORT
+
+# export filtering
+__all__ = ['replayer', 'read_spool', 'scrape']
+
+def LOG(msg=''):
+    print('[replay] %s' % msg)
+
+def read_spool(path):
+    '''
+    yields (None, message) for each message, prefixed with its uint32 (BE)
+    length, in a spool file: such files have no timing
+    '''
+    fd = open(path, 'rb')
+    try:
+        while True:
+            hdr = fd.read(4)
+            if len(hdr) < 4:
+                return
+            body = fd.read(unpack('!I', hdr)[0])
+            yield None, hdr + body
+    finally:
+        fd.close()
+
+def scrape(url, name='interpreter_messages_total'):
+    # returns the value of an unlabelled metric from a metrics endpoint,
+    # or None
+    try:
+        body = urlopen(url, timeout=2).read().decode('utf-8')
+    except Exception:
+        return None
+    m = re.search(r'^%s (\S+)$' % re.escape(name), body, re.M)
+    if m is None:
+        return None
+    return float(m.group(1))
+
+
+class replayer(object):
+    '''
+    Send recorded messages to an interpreter at .SOCK_ADDR
+    (str -> file socket, tuple -> udp socket, or stream when .SOCK_STREAM)
+    ---
+    Pacing: .RATE datagrams/s when set, otherwise the original timing divided
+    by .SPEED, or as fast as possible when .SPEED is 0.
+    Each message is sent at its deadline: the sender sleeps until .SPIN
+    second(s) before it, and spins afterwards.
+    '''
+    # debug level
+    DEBUG = 1
+    #
+    SOCK_ADDR = ('127.10.0.1', 2154)
+    SOCK_STREAM = False
+    #
+    # speed factor for the original timing, 0 for as fast as possible
+    SPEED = 1.0
+    # fixed rate (in datagrams/s), overrides SPEED when set
+    RATE = 0
+    # busy wait before each deadline (in second), for accurate pacing
+    SPIN = 0.002
+    # progress report period (in second), 0 to disable
+    REPORT = 5.0
+
+    def __init__(self):
+        if isinstance(self.SOCK_ADDR, str):
+            fam = socket.AF_UNIX
+        else:
+            fam = socket.AF_INET
+        typ = socket.SOCK_STREAM if self.SOCK_STREAM else socket.SOCK_DGRAM
+        self._sk = socket.socket(fam, typ)
+        if self.SOCK_STREAM:
+            self._sk.connect(self.SOCK_ADDR)
+        # counters
+        self.sent = 0
+        self.msgs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.late = 0.0
+        self.duration = 0.0
+
+    def close(self):
+        self._sk.close()
+
+    def _wait(self, deadline):
+        now = time()
+        if deadline - now > self.SPIN:
+            sleep(deadline - now - self.SPIN)
+        while time() < deadline:
+            pass
+
+    def _send(self, data):
+        try:
+            if self.SOCK_STREAM:
+                self._sk.sendall(data)
+            else:
+                self._sk.sendto(data, self.SOCK_ADDR)
+        except socket.error:
+            self.errors += 1
+            return
+        self.sent += 1
+        self.bytes += len(data)
+        # a datagram can hold several messages
+        i = 0
+        while i + 4 <= len(data):
+            i += 4 + unpack('!I', data[i:i+4])[0]
+            self.msgs += 1
+
+    def replay(self, records):
+        '''
+        send each (timestamp, message) record, paced
+        '''
+        t0 = time()
+        first, last, rep = None, None, t0 + self.REPORT
+        n = 0
+        for ts, data in records:
+            if self.RATE:
+                deadline = t0 + n / float(self.RATE)
+            elif self.SPEED and ts is not None:
+                if first is None:
+                    first = ts
+                elif ts < last:
+                    # the file is replayed again: keep going from there
+                    first = ts - (last - first)
+                last = ts
+                deadline = t0 + (ts - first) / self.SPEED
+            else:
+                deadline = None
+            if deadline is not None:
+                self._wait(deadline)
+                late = time() - deadline
+                if late > self.late:
+                    self.late = late
+            self._send(data)
+            n += 1
+            if self.REPORT and self.DEBUG and time() >= rep:
+                rep += self.REPORT
+                LOG('%i datagrams sent, %.0f datagrams/s' \
+                    % (self.sent, self.sent / (time() - t0)))
+        self.duration = time() - t0
+
+    def summary(self):
+        rate = self.sent / self.duration if self.duration else 0.0
+        return '%i datagrams (%i messages, %i bytes) sent in %.3fs: '\
+               '%.0f datagrams/s, %.1f Mb/s, %i send errors, max lateness '\
+               '%.3fms' % (self.sent, self.msgs, self.bytes, self.duration, rate,
+                  8e-6 * self.bytes / self.duration if self.duration else 0.0,
+                  self.errors, 1000 * self.late)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+             description='Replay recorded receivers traffic to an interpreter.')
+    parser.add_argument('file', type=str,
+        help='pcap file of datagrams to the interpreter, or spool file')
+    parser.add_argument('--spool', action='store_true', default=False,
+        help='the file is a spool file (no timing: use --rate or replay as '\
+             'fast as possible)')
+    parser.add_argument('--port', type=int, default=UDP_PORT,
+        help='UDP port of the datagrams to take from the pcap file')
+    parser.add_argument('--ip', type=str, default='127.10.0.1',
+        help='interpreter address')
+    parser.add_argument('--dport', type=int, default=2154,
+        help='interpreter port')
+    parser.add_argument('--filesock', type=str, default=None,
+        help='interpreter UNIX file socket, instead of --ip and --dport')
+    parser.add_argument('--tcp', action='store_true', default=False,
+        help='send over a stream connection')
+    parser.add_argument('-x', '--speed', type=float, default=1.0,
+        help='speed factor of the original timing (0: as fast as possible)')
+    parser.add_argument('-r', '--rate', type=int, default=0,
+        help='send at a fixed rate, in datagrams/s')
+    parser.add_argument('-l', '--loop', type=int, default=1,
+        help='number of times the file is replayed')
+    parser.add_argument('-m', '--metrics', type=str, default=None,
+        help='interpreter metrics URL (e.g. http://127.0.0.1:9154/metrics), '\
+             'to report the messages lost by the interpreter')
+    args = parser.parse_args()
+    #
+    replayer.SOCK_ADDR = args.filesock or (args.ip, args.dport)
+    replayer.SOCK_STREAM = args.tcp
+    replayer.SPEED = max(0, args.speed)
+    replayer.RATE = max(0, args.rate)
+    #
+    def records():
+        for i in range(args.loop):
+            if args.spool:
+                src = read_spool(args.file)
+            else:
+                src = read_pcap(args.file, args.port)
+            for ts, data in src:
+                yield ts, data
+    #
+    if args.metrics:
+        recv0 = scrape(args.metrics)
+        if recv0 is None:
+            LOG('cannot get interpreter metrics from %s' % args.metrics)
+    try:
+        rp = replayer()
+    except socket.error as err:
+        LOG('cannot connect to the interpreter: %s' % err)
+        sys.exit(1)
+    try:
+        rp.replay(records())
+    except KeyboardInterrupt:
+        LOG('interrupted')
+    rp.close()
+    LOG(rp.summary())
+    if args.metrics and recv0 is not None:
+        # let the interpreter drain its socket
+        sleep(1)
+        recv1 = scrape(args.metrics)
+        if recv1 is not None and rp.msgs:
+            recv = recv1 - recv0
+            LOG('%i messages decoded by the interpreter, %.2f%% lost' \
+                % (recv, 100.0 * max(0, rp.msgs - recv) / rp.msgs))
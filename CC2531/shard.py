@@ -0,0 +1,330 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : shard.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the sharding of the interpreter over several processes, for a
+# central collector receiving from many sniffer nodes:
+# - each shard is an interpreter() process bound to the same UDP (and / or
+#   TCP) port with SO_REUSEPORT (Linux): the kernel spreads datagrams by
+#   source address and port, hence each receiver always goes to the same
+#   shard, and its frames stay in order,
+# - shards send their rendered frames to the parent process, which merges
+#   them into a single output ordered by frame time, after a reordering delay,
+# - or each shard writes its own output file (OUTPUT_FILE.<shard>).
+#
+# Statistics, topology, history and metrics are per shard: metrics of shard
+# i are served on the metrics port + i.
+#
+# Shards inherit the interpreter configuration (its class attributes) from
+# the parent process: they are always forked, whatever the default start
+# method of multiprocessing (spawn on macOS, forkserver from python 3.14).
+#
+
+import os
+import signal
+import select
+import argparse
+import multiprocessing
+from heapq import heappush, heappop
+from time import time
+from interpreter import interpreter
+from output import RENDERERS, file_sink, console_sink
+from metrics import metrics_server
+
+# export filtering
+__all__ = ['shard_pool']
+
+def LOG(msg=''):
+    print('[shard] %s' % msg)
+
+if hasattr(multiprocessing, 'get_context'):
+    _MP = multiprocessing.get_context('fork')
+else:
+    # python 2 always forks
+    _MP = multiprocessing
+
+
+class _pipe_sink(object):
+    '''
+    Output sink of a shard, sending (timestamp, text) of the outputs to the
+    parent process, by batches of .BATCH and at each flush
+    '''
+    BATCH = 64
+
+    def __init__(self, conn, interp):
+        self._conn = conn
+        self._interp = interp
+        self._buf = []
+
+    def write(self, text):
+        # the record being output is the interpreter's current one
+        rec = self._interp._cur_msg
+        self._buf.append((rec.timestamp if rec is not None else time(), text))
+        if len(self._buf) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            buf, self._buf = self._buf, []
+            self._conn.send(buf)
+
+    def close(self):
+        self.flush()
+        # end of the shard output
+        self._conn.send(None)
+        self._conn.close()
+
+
+def _run_shard(cls, idx, conn, stop, merge, metrics_port):
+    # runs within the shard process, forked from the parent: cls is
+    # configured as in the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cls._THREADED = True
+    cls._STOP_EVENT = stop
+    cls.REUSE_PORT = True
+    if merge:
+        # the parent does the output
+        cls.OUTPUT_STDOUT = False
+        cls.OUTPUT_FILE = None
+    elif cls.OUTPUT_FILE:
+        cls.OUTPUT_FILE = '%s.%i' % (cls.OUTPUT_FILE, idx)
+    if metrics_port:
+        metrics_server(('127.0.0.1', metrics_port + idx)).start()
+    interp = cls()
+    if merge:
+        interp._sinks.append(_pipe_sink(conn, interp))
+    else:
+        conn.close()
+    interp.process()
+
+
+class shard_pool(object):
+    '''
+    Run .SHARDS processes of .INTERPRETER on its SOCK_ADDR, with SO_REUSEPORT
+    ---
+    With .MERGE, the outputs of all shards are written by the parent process,
+    according to the interpreter OUTPUT_STDOUT, OUTPUT_FILE and CONSOLE_RATE,
+    ordered by frame time: each output is held .MERGE_DELAY second(s) after
+    its reception from a shard, for the outputs of the other shards.
+    Without .MERGE, each shard outputs its frames itself, into its own file.
+    .run() returns when all shards have stopped (see .looping()).
+    '''
+    # debug level
+    DEBUG = 1
+    # for looping control
+    _THREADED = False
+    _STOP_EVENT = None
+    #
+    # interpreter class run by each shard, configured through its class
+    # attributes
+    INTERPRETER = interpreter
+    # number of shard processes
+    SHARDS = multiprocessing.cpu_count()
+    # merge the outputs of the shards into a single ordered stream
+    MERGE = True
+    # reordering delay of the merged output (in second), should be longer
+    # than the interpreter FLUSH_PERIOD
+    MERGE_DELAY = 2.0
+    # metrics port of the first shard, 0 for none
+    METRICS_PORT = 0
+    #
+    # select loop timeout
+    SELECT_TO = 0.2
+
+    def __init__(self):
+        if not isinstance(self.INTERPRETER.SOCK_ADDR, tuple):
+            raise(Exception('sharding requires an UDP / TCP SOCK_ADDR'))
+        self._running = False
+        self._stop = _MP.Event()
+        self._procs = []
+        self._conns = {}
+        # merged output: heap of (frame time, sequence, reception time, text)
+        self._heap = []
+        self._seq = 0
+        self._last = 0.0
+        self._sinks = []
+        # counters
+        self.merged = 0
+        self.late = 0
+
+    def _log(self, msg=''):
+        LOG(msg)
+
+    def looping(self):
+        if not self._running:
+            return False
+        elif not self._THREADED:
+            return True
+        elif hasattr(self._STOP_EVENT, 'is_set') \
+        and not self._STOP_EVENT.is_set():
+            return True
+        return False
+
+    def stop(self):
+        self._running = False
+
+    def start(self):
+        cls = self.INTERPRETER
+        for idx in range(self.SHARDS):
+            rd, wr = _MP.Pipe(False)
+            proc = _MP.Process(target=_run_shard,
+                   args=(cls, idx, wr, self._stop, self.MERGE,
+                         self.METRICS_PORT),
+                   name='interpreter %i' % idx)
+            proc.daemon = True
+            proc.start()
+            # the write end belongs to the shard
+            wr.close()
+            self._procs.append(proc)
+            self._conns[rd.fileno()] = rd
+        # sinks (and the console thread) once the shards are forked
+        if self.MERGE:
+            if cls.OUTPUT_STDOUT:
+                self._sinks.append(console_sink(rate=cls.CONSOLE_RATE))
+            if cls.OUTPUT_FILE:
+                self._sinks.append(file_sink(cls.OUTPUT_FILE))
+        if self.DEBUG:
+            self._log('%i interpreter shards on %s, %s output' % (self.SHARDS,
+                      list(cls.SOCK_ADDR), 'merged' if self.MERGE \
+                      else 'per shard'))
+
+    def run(self):
+        self.start()
+        self._running = True
+        try:
+            while self.looping():
+                self._recv(self.SELECT_TO)
+                self._emit(time() - self.MERGE_DELAY)
+                if not any(proc.is_alive() for proc in self._procs):
+                    break
+        except KeyboardInterrupt:
+            pass
+        # shards stop on their own, and flush their outputs
+        self._stop.set()
+        while self._conns:
+            self._recv(self.SELECT_TO)
+            if not any(proc.is_alive() for proc in self._procs):
+                self._recv(0)
+                break
+        for proc in self._procs:
+            proc.join()
+        self._emit(None)
+        for sink in self._sinks:
+            sink.close()
+        if self.DEBUG and self.MERGE:
+            self._log('%i frames merged from %i shards, %i out of order' \
+                      % (self.merged, self.SHARDS, self.late))
+
+    def _recv(self, timeout):
+        try:
+            r = select.select(list(self._conns), [], [], timeout)[0]
+        except select.error:
+            return
+        now = time()
+        for fd in r:
+            try:
+                buf = self._conns[fd].recv()
+            except (EOFError, IOError):
+                buf = None
+            if buf is None:
+                # end of the shard output
+                self._conns.pop(fd).close()
+                continue
+            for ts, text in buf:
+                heappush(self._heap, (ts, self._seq, now, text))
+                self._seq += 1
+
+    def _emit(self, until):
+        # writes the outputs in frame time order, as long as the oldest one
+        # was received before until (all when None)
+        heap, sinks = self._heap, self._sinks
+        while heap and (until is None or heap[0][2] <= until):
+            ts, seq, recv, text = heappop(heap)
+            if ts < self._last:
+                self.late += 1
+            else:
+                self._last = ts
+            for sink in sinks:
+                sink.write(text)
+            self.merged += 1
+        for sink in sinks:
+            sink.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+             description='Collect and interpret IEEE 802.15.4 frames forwarded '\
+             'by remote receivers, within several interpreter processes.')
+    parser.add_argument('-j', '--shards', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of interpreter processes')
+    parser.add_argument('--ip', type=str, default='0.0.0.0',
+        help='local address to listen on')
+    parser.add_argument('--port', type=int, default=2154,
+        help='UDP port to listen on (TCP with --tcp)')
+    parser.add_argument('--tcp', action='store_true', default=False,
+        help='listen on TCP instead of UDP')
+    parser.add_argument('--aio', action='store_true', default=False,
+        help='run asyncio interpreters, on UDP and TCP (python 3 only)')
+    parser.add_argument('--nomerge', action='store_true', default=False,
+        help='each shard writes its own output file (--file.<shard>), '\
+        'instead of a single output ordered by frame time')
+    parser.add_argument('-d', '--delay', type=float, default=2.0,
+        help='reordering delay of the merged output, in seconds')
+    parser.add_argument('-f', '--file', type=str, default=None,
+        help='output (append) frame information to a file')
+    parser.add_argument('-s', '--silent', action='store_true', default=False,
+        help='do not print frame information on stdout')
+    parser.add_argument('-n', '--nofcschk', action='store_true', default=False,
+        help='displays all frames, even those with failed FCS check')
+    parser.add_argument('-r', '--render', type=str, default='full',
+        choices=RENDERERS, help='frame output: one line summary (compact), '\
+        'decoded tree (full) or hex frame (hex)')
+    parser.add_argument('--rate', type=int, default=50,
+        help='maximum number of frames printed per second on stdout, the '\
+        'others are counted (0: no limit)')
+    parser.add_argument('--metrics', type=int, default=0,
+        help='serve Prometheus metrics over HTTP, from this local port for '\
+        'the first shard, + 1 for the next one... (0: none)')
+    args = parser.parse_args()
+    #
+    if args.aio:
+        from aiointerpreter import aio_interpreter, asyncio
+        if asyncio is None:
+            parser.error('--aio requires python 3 (asyncio)')
+        cls = aio_interpreter
+        cls.STREAM_ADDR = (args.ip, args.port)
+    else:
+        cls = interpreter
+        cls.SOCK_STREAM = args.tcp
+    cls.SOCK_ADDR = (args.ip, args.port)
+    cls.OUTPUT_FILE = args.file
+    cls.OUTPUT_STDOUT = not args.silent
+    cls.FCS_IGNORE = args.nofcschk
+    cls.RENDER = args.render
+    cls.CONSOLE_RATE = max(0, args.rate)
+    shard_pool.INTERPRETER = cls
+    shard_pool.SHARDS = max(1, args.shards)
+    shard_pool.MERGE = not args.nomerge
+    shard_pool.MERGE_DELAY = max(0, args.delay)
+    shard_pool.METRICS_PORT = args.metrics
+    shard_pool().run()
@@ -50,6 +50,19 @@ from CC2531 import *
 from receiver import *
 from interpreter import *
 from gps import *
+from stats import *
+from topology import *
+from history import *
+from metrics import *
+from latency import *
+from output import RENDERERS
+from zigbee import LAYERS, zigbee
+from profiler import *
+from evloop import *
+from supervisor import *
+from control import *
+from CC2531 import usb1
+from lazy import available
 
 def LOG(msg=''):
     print('[sniffer] %s' % msg)
@@ -100,25 +113,20 @@ def threadit(task, *args, **kwargs):
     th.start()
     return th
 
-def prepare_receiver(chans=[0x0f, 0x14, 0x19]):
-    ccs = map(CC2531, get_CC2531())
+def nameit(th, name):
+    # thread name, reported by the profiler
+    th.name = name
+    return th
+
+def prepare_receiver(chans=[0x0f, 0x14, 0x19], ctx=None):
+    ccs = [CC2531(dev) for dev in get_CC2531(ctx)]
     #
     if len(ccs) == 0:
         LOG(' no CC2531 dongles found')
         return []
     #
     # split the chans' list into separate lists for all receivers
-    e, r = len(chans)//len(ccs), len(chans)%len(ccs)
-    cl = []
-    start, stop = 0, 0
-    for i in range(len(ccs)):
-        if stop > 0:
-            start = stop
-        if i < r:
-            stop = start + e + 1
-        else:
-            stop = start + e
-        cl.append(chans[start:stop])
+    cl = share_channels(chans, len(ccs))
     #
     ss = [receiver(cc) for cc in ccs]
     for i in range(len(cl)):
@@ -139,7 +147,7 @@ def prolog():
              '\tTag : uint8, Length : uint8, Value : char*[L]\n'\
              '\tT=0x01, 802.15.4 channel, uint8\n'
              '\tT=0x02, epoch time at frame reception, ascii encoded\n'
-             '\tT=0x03, position at frame reception (if positionning server available)\n'
+             '\tT=0x04, position at frame reception (if positionning server available)\n'
              '\tT=0x10, 802.15.4 frame within TI PSD structure\n'
              '\tT=0x20, 802.15.4 frame\n'\
              'Output 802.15.4 frame information (channel, RSSI, MAC header, ...)')
@@ -150,21 +158,102 @@ def prolog():
         help='list of IEEE 802.15.4 channels to sniff on (between 11 and 26)')
     parser.add_argument('-p', '--period', type=float, default=1.0,
         help='time (in seconds) to sniff on a single channel before hopping')
+    parser.add_argument('-r', '--ring', type=int, default=0,
+        help='number of USB buffers queued between the USB reading and the '\
+             'forwarding thread of each receiver (0: single thread)')
+    parser.add_argument('-e', '--evloop', action='store_true', default=False,
+        help='service all dongles and the GPS from a single event-driven '\
+             'thread, instead of one polling thread each')
+    parser.add_argument('--control', action='store_true', default=False,
+        help='serve control commands on /tmp/cc2531_control, to change '\
+             'channels, dwell time and output while running (see control.py)')
+    parser.add_argument('--health', type=float, default=300,
+        help='period (in seconds) of the dongles health report, when not '\
+             'running the event loop (0: only when quitting)')
     parser.add_argument('-n', '--nofcschk', action='store_true', default=False,
         help='displays all sniffed frames, even those with failed FCS check')
     parser.add_argument('--gps', type=str, default='/dev/ttyUSB0',
-        help='serial port to get NMEA information from GPS')
+        help='serial port to get NMEA information from GPS, or tcp://host:port '\
+             'for an NMEA stream, gpsd://host:port for a gpsd feed, '\
+             'file://path for replaying a recorded NMEA file')
+    parser.add_argument('--gpsspeed', type=float, default=1.0,
+        help='speed factor for replaying a recorded NMEA file (0: as fast '\
+             'as possible)')
+    parser.add_argument('--track', type=str, default=None,
+        help='file to record the GPS track into, for geotagging frames '\
+             'offline with decoder.py')
+    parser.add_argument('--gpstlv', action='store_true', default=False,
+        help='add the position to each forwarded frame (for a remote '\
+             'interpreter), instead of geotagging them from the GPS track '\
+             'within the interpreter')
     parser.add_argument('--ip', type=str, default='localhost',
         help='network destination for forwarding 802.15.4 frames')
     parser.add_argument('--filesock', action='store_true', default=False,
         help='forward 802.15.4 frames to a UNIX file socket /tmp/cc2531_server '\
              'instead of the UDP socket')
+    parser.add_argument('--tcp', action='store_true', default=False,
+        help='forward 802.15.4 frames over a TCP (or UNIX stream, with '\
+             '--filesock) connection, reconnected when lost')
+    parser.add_argument('--spool', type=int, default=0,
+        help='size (in MB) of the on-disk spool /tmp/cc2531_spool_* keeping '\
+             'frames while the interpreter is unreachable, requires --tcp: '\
+             'UDP sends do not fail without interpreter (0: no spool)')
+    parser.add_argument('--capture', type=int, default=0,
+        help='size (in MB) of the ring files /tmp/cc2531_capture_* recording '\
+             'every USB buffer of each dongle, see capring.py (0: none)')
+    parser.add_argument('-b', '--batch', type=float, default=0,
+        help='gather frames during this time window (in seconds) and '\
+             'forward them compressed in a single message (0: no batch)')
+    parser.add_argument('--codec', type=str, default='zlib',
+        choices=['zlib', 'lzma', 'none'],
+        help='compression codec for batches')
+    parser.add_argument('--level', type=int, default=6,
+        help='compression level for batches')
+    parser.add_argument('--stats', type=int, default=0,
+        help='compute RF statistics per channel, PAN and source address, '\
+             'and print a summary every STATS seconds (0: no statistics)')
+    parser.add_argument('--statsfile', type=str, default=None,
+        help='also write statistics snapshots into STATSFILE (NumPy .npz, '\
+             '%%s being replaced with the time of the snapshot)')
+    parser.add_argument('--topo', type=int, default=0,
+        help='build the inventory of PANs, devices and links, and print a '\
+             'summary every TOPO seconds (0: no inventory)')
+    parser.add_argument('--topofile', type=str, default=None,
+        help='also write inventory snapshots into TOPOFILE (JSON, %%s being '\
+             'replaced with the time of the snapshot)')
+    parser.add_argument('--history', type=int, default=0,
+        help='keep the HISTORY most recent frames in memory, indexed by '\
+             'address and PAN (0: no history)')
+    parser.add_argument('--historywin', type=int, default=600,
+        help='maximum age (in seconds) of frames kept in memory')
+    parser.add_argument('--metrics', type=int, default=0,
+        help='serve Prometheus metrics over HTTP on this local port (0: none)')
+    parser.add_argument('--trace', action='store_true', default=False,
+        help='trace the latency of each frame from USB read to output, and '\
+             'print per stage latencies on SIGUSR1 and when quitting')
+    parser.add_argument('--tracefile', type=str, default=None,
+        help='also append per stage latencies to TRACEFILE')
+    parser.add_argument('--profile', type=float, default=0,
+        help='sample all threads during PROFILE seconds on SIGUSR2, and '\
+             'write their stacks to /tmp/cc2531_profile_* for flame graphs '\
+             '(0: no profiling)')
     parser.add_argument('-f', '--file', action='store_true', default=False,
         help='output (append) frame information to file /tmp/cc2531_sniffer')
     parser.add_argument('-s', '--silent', action='store_true', default=False,
         help='do not print frame information on stdout')
+    parser.add_argument('--render', type=str, default='full',
+        choices=RENDERERS, help='frame output: one line summary (compact), '\
+        'decoded tree (full) or hex frame (hex)')
+    parser.add_argument('--rate', type=int, default=50,
+        help='maximum number of frames printed per second on stdout, the '\
+        'others are counted (0: no limit, the file output is complete)')
+    parser.add_argument('--zigbee', type=str, nargs='*', default=None,
+        choices=LAYERS, help='decode and output these Zigbee layers (all when '\
+        'none given), and count frames per Zigbee cluster with --stats')
     #
     args = parser.parse_args()
+    if args.spool > 0 and not args.tcp:
+        parser.error('--spool requires --tcp')
     #
     if args.debug:
         LOG(' command line arguments:\n%s' % repr(args))
@@ -172,29 +261,68 @@ def prolog():
     GPS_reader.DEBUG = max(0, args.debug-2)
     receiver.DEBUG = max(0, args.debug-1)
     interpreter.DEBUG = args.debug
+    supervisor.DEBUG = args.debug
     #
     receiver.CHAN_PERIOD = args.period
+    receiver.RING_SIZE = max(0, args.ring)
+    receiver.SOCK_STREAM = args.tcp
+    receiver.UPLINK_BATCH = max(0, args.batch)
+    receiver.UPLINK_CODEC = args.codec
+    receiver.UPLINK_LEVEL = args.level
+    if args.spool > 0:
+        receiver.SPOOL_FILE = '/tmp/cc2531_spool_%s'
+        receiver.SPOOL_SIZE = args.spool*1024*1024
+    if args.capture > 0:
+        receiver.CAPTURE_FILE = '/tmp/cc2531_capture_%s'
+        receiver.CAPTURE_SIZE = args.capture*1024*1024
     if args.filesock:
         receiver.SOCK_ADDR = '/tmp/cc2531_server'
     else:
         receiver.SOCK_ADDR = (args.ip, 2154)
-    if os.path.exists(args.gps):
+    if '://' in args.gps:
+        GPS_reader.SOURCE = args.gps
+        GPS_reader.REPLAY_SPEED = max(0, args.gpsspeed)
+    elif os.path.exists(args.gps):
         GPS_reader.PORT = args.gps
+    GPS_reader.TRACK_FILE = args.track
+    receiver.POSITION = args.gpstlv
     #
     chans = [c for c in args.chans if 11 <= c <= 26]
     if chans == []:
         chans = CHANNELS.keys()
     #
     interpreter.SOCK_ADDR = receiver.SOCK_ADDR
+    interpreter.SOCK_STREAM = receiver.SOCK_STREAM
     if args.file:
         interpreter.OUTPUT_FILE = '/tmp/cc2531_sniffer'
     else:
         interpreter.OUTPUT_FILE = None
     interpreter.OUTPUT_STDOUT = not args.silent
+    interpreter.RENDER = args.render
+    interpreter.CONSOLE_RATE = max(0, args.rate)
     #
     interpreter.FCS_IGNORE = args.nofcschk
+    if args.zigbee is not None:
+        interpreter.ZIGBEE = zigbee(args.zigbee or LAYERS)
+        stats.ZIGBEE = True
+    if args.stats > 0:
+        stats.EMIT_PERIOD = args.stats
+        stats.SNAPSHOT_FILE = args.statsfile
+        interpreter.STATS = stats()
+    if args.topo > 0:
+        topology.EMIT_PERIOD = args.topo
+        topology.SNAPSHOT_FILE = args.topofile
+        interpreter.TOPOLOGY = topology()
+    if args.history > 0:
+        history.SIZE = args.history
+        history.WINDOW = max(0, args.historywin)
+        interpreter.HISTORY = history()
+    if args.trace:
+        receiver.TRACE = True
+        tracer.DUMP_FILE = args.tracefile
+        interpreter.TRACER = tracer()
     #
-    return chans
+    return chans, args
     
 
 def main():
@@ -202,7 +330,10 @@ def main():
     global running
     running = False
     #
-    chans = prolog()
+    chans, args = prolog()
+    if not available(usb1):
+        print('ERROR: cannot import python libusb1 wrapper.')
+        exit()
     #
     # init threads' list and CTRL+C handler
     # threaded parts are not getting signals:
@@ -216,6 +347,11 @@ def main():
     GPS_reader._STOP_EVENT = stop_event
     receiver._THREADED = True
     receiver._STOP_EVENT = stop_event
+    event_loop._THREADED = True
+    event_loop._STOP_EVENT = stop_event
+    supervisor._THREADED = True
+    supervisor._STOP_EVENT = stop_event
+    supervisor.HEALTH_PERIOD = max(0, args.health)
     #
     def int_handler(signum, frame):
         print('SIGINT: quitting')
@@ -225,31 +361,74 @@ def main():
         global running
         running = False
     signal.signal(signal.SIGINT, int_handler)
+    if interpreter.TRACER is not None:
+        def usr1_handler(signum, frame):
+            interpreter.TRACER.dump()
+        signal.signal(signal.SIGUSR1, usr1_handler)
+    if args.profile > 0:
+        profiler.DURATION = args.profile
+        prof = profiler()
+        def usr2_handler(signum, frame):
+            prof.start()
+        signal.signal(signal.SIGUSR2, usr2_handler)
+    elif args.control:
+        prof = profiler()
+    else:
+        prof = None
     #
     running = True
+    if args.metrics:
+        metrics_server(('127.0.0.1', args.metrics)).start()
     # start interpreter (/server)
     interp = interpreter()
-    threads.append( (interp, threadit(interp.process)) )
+    threads.append( (interp, nameit(threadit(interp.process), 'interpreter')) )
     #
     # start gps reader
     gps = GPS_reader()
     receiver.GPS = gps
-    threads.append( (gps, threadit(gps.listen)) )
+    if not args.gpstlv:
+        # geotag frames from the GPS track, within the interpreter
+        interp.TRACK = gps.track
     #
-    # start CC2531 receivers
-    ccs = prepare_receiver(chans)
-    for cc in ccs:
-        threads.append( (cc, threadit(cc.listen)) )
+    if args.evloop:
+        # start CC2531 receivers and gps reader within a single event loop
+        ctx = usb1.USBContext()
+        ccs = prepare_receiver(chans, ctx)
+        if gps.fileno() >= 0:
+            loop = event_loop(ctx, ccs, gps)
+        else:
+            # no file descriptor to poll (e.g. a replayed NMEA file): the GPS
+            # keeps its own thread
+            loop = event_loop(ctx, ccs)
+            threads.append( (gps, nameit(threadit(gps.listen), 'GPS')) )
+        threads.append( (loop, nameit(threadit(loop.run), 'event_loop')) )
+        sup = None
+    else:
+        threads.append( (gps, nameit(threadit(gps.listen), 'GPS')) )
+        #
+        # CC2531 receivers are started (and restarted) by the supervisor
+        sup = supervisor(chans)
     #
-    # loop infinitely until SIGINT is caught
-    # this loop lets all daemonized threads running
-    while running:
-        sleep(1)
+    if args.control:
+        ctrl = control_server(sup.receivers if sup is not None else \
+                              lambda: ccs, interp, sup, prof)
+        ctrl.start()
+    #
+    if sup is not None:
+        # supervise receivers until SIGINT is caught
+        sup.run()
+    else:
+        # loop infinitely until SIGINT is caught
+        # this loop lets all daemonized threads running
+        while running:
+            sleep(1)
     #
     # finally, wait for each thread to stop properly after they received
     # the stop_event signal
     for c, t in threads:
         t.join()
+    if interpreter.TRACER is not None:
+        interpreter.TRACER.dump()
 
 if __name__ == '__main__':
     main()
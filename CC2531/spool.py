@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : spool.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the on-disk buffer used by receiver() instances to keep the
+# messages they cannot forward while the interpreter is unreachable.
+#
+
+import os
+from struct import unpack
+
+# export filtering
+__all__ = ['spool']
+
+def LOG(msg=''):
+    print('[spool] %s' % msg)
+
+class spool(object):
+    '''
+    Bounded on-disk FIFO of messages prefixed with their uint32 (BE) length,
+    as sent by receiver() instances: the file content is hence the same as
+    what is sent over a stream socket.
+    ---
+    .push(msg) : append a message, or drop it when the spool is full
+    .peek(n) : returns complete messages from the head, about n bytes
+    .consume(n) : remove n bytes from the head
+    ---
+    The file is truncated each time it is emptied. Messages still in the
+    file when the spool is opened are kept, and replayed first.
+    '''
+    # debug level
+    DEBUG = 1
+
+    def __init__(self, path, maxlen=64*1024*1024):
+        self.path = path
+        self.maxlen = maxlen
+        self._fd = open(self.path, 'a+b')
+        self._fd.seek(0, 2)
+        self._wr = self._fd.tell()
+        self._rd = 0
+        # counters
+        self.pushed = 0
+        self.drops = 0
+        if self._wr and self.DEBUG:
+            LOG('%i bytes pending in %s' % (self._wr, self.path))
+
+    def __len__(self):
+        return self._wr - self._rd
+
+    def close(self):
+        self._fd.close()
+
+    def push(self, msg):
+        if self._wr + len(msg) > self.maxlen:
+            if self.DEBUG and not self.drops:
+                LOG('%s full, dropping messages' % self.path)
+            self.drops += 1
+            return False
+        # append mode: always writes at the end of the file
+        self._fd.write(msg)
+        self._wr += len(msg)
+        self.pushed += 1
+        return True
+
+    def peek(self, n=65536):
+        if self._wr == self._rd:
+            return ''
+        self._fd.flush()
+        self._fd.seek(self._rd)
+        buf = self._fd.read(max(n, 4))
+        l = self.boundary(buf, len(buf))
+        if l == 0:
+            # a single message larger than n
+            l = 4 + unpack('!I', buf[:4])[0]
+            self._fd.seek(self._rd)
+            buf = self._fd.read(l)
+        return buf[:l]
+
+    def consume(self, n):
+        self._rd = min(self._wr, self._rd + n)
+        if self._rd == self._wr:
+            self._fd.truncate(0)
+            self._rd, self._wr = 0, 0
+
+    @staticmethod
+    def boundary(buf, n):
+        # returns the length of the complete messages within the first n
+        # bytes of buf
+        l = 0
+        while l + 4 <= n:
+            ml = 4 + unpack('!I', buf[l:l+4])[0]
+            if l + ml > n:
+                break
+            l += ml
+        return l
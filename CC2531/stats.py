@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : stats.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the RF statistics engine for site surveys, fed by the interpreter
+# with every frame received: per channel occupancy, frame rate, RSSI
+# distribution and FCS error rate, and per PAN / per source address frame
+# rate and RSSI, all over a rolling time window.
+# With ZIGBEE, the frame rate and RSSI are also counted per Zigbee profile and
+# cluster, from the APS headers decoded by the interpreter (see zigbee.py).
+# It requires NumPy.
+#
+
+from time import time, strftime, localtime
+from CC2531 import CHANNELS
+from mac import *
+from lazy import lazy_module, available
+
+# imported with the first stats() instance
+np = lazy_module('numpy', 'NumPy')
+
+# export filtering
+__all__ = ['stats']
+
+def LOG(msg=''):
+    print('[stats] %s' % msg)
+
+# 802.15.4 2.4GHz PHY: 32 us per byte, 6 bytes of preamble, SFD and length,
+# 2 bytes of FCS (not included in frames from the CC2531)
+BYTE_US = 32
+PHY_OVERHEAD = 8
+
+CHAN_MIN = min(CHANNELS)
+CHAN_NUM = len(CHANNELS)
+# RSSI histograms bins: -128 to 127 dBm
+RSSI_BINS = 256
+RSSI_OFF = 128
+
+
+class _keyed(object):
+    '''
+    Rolling frame counters and RSSI sums for a growing set of keys
+    (PAN IDs, addresses, Zigbee clusters), stored in rows of 2D arrays
+    '''
+
+    def __init__(self, window, rows=64):
+        self._idx = {}
+        self.keys = []
+        self.frames = np.zeros((rows, window), np.uint32)
+        self.rssi = np.zeros((rows, window), np.int32)
+        self.last = np.zeros(rows, np.float64)
+
+    def row(self, key):
+        try:
+            return self._idx[key]
+        except KeyError:
+            r = self._idx[key] = len(self.keys)
+            self.keys.append(key)
+            if r >= self.frames.shape[0]:
+                # double the capacity
+                for name in ('frames', 'rssi', 'last'):
+                    arr = getattr(self, name)
+                    setattr(self, name, np.concatenate((arr, np.zeros_like(arr))))
+            return r
+
+    def clear(self, cols):
+        self.frames[:, cols] = 0
+        self.rssi[:, cols] = 0
+
+    def top(self, n=10):
+        # keys with the most frames within the window
+        tot = self.frames[:len(self.keys)].sum(axis=1)
+        rows = np.argsort(tot)[::-1][:n]
+        res = []
+        for r in rows:
+            if tot[r] == 0:
+                break
+            res.append((self.keys[r], int(tot[r]),
+                        self.rssi[r].sum() / float(tot[r]), self.last[r]))
+        return res
+
+
+class stats(object):
+    '''
+    RF statistics over a rolling window of .WINDOW buckets of .BUCKET
+    second(s) each, fed with .update() for each frame received.
+    ---
+    Each expired bucket is subtracted from the window totals (frame counts,
+    FCS errors, airtime, RSSI histograms), so that percentiles are computed
+    from up-to-date histograms without going through the whole window.
+    ---
+    .poll() emits a summary every .EMIT_PERIOD second(s), and writes a
+    snapshot of all arrays into .SNAPSHOT_FILE (NumPy .npz) when set.
+    Without frames, buckets keep expiring with the host time elapsed since
+    the current one was opened (frame times may be on another clock, e.g.
+    when replayed).
+    '''
+    # debug level
+    DEBUG = 1
+    # rolling window: bucket duration (in second) and number of buckets
+    BUCKET = 1.0
+    WINDOW = 300
+    # summary period (in second), 0 to disable
+    EMIT_PERIOD = 60
+    # snapshot file, %s is replaced with the snapshot time, or None
+    #SNAPSHOT_FILE = '/tmp/cc2531_stats_%s.npz'
+    SNAPSHOT_FILE = None
+    # RSSI percentiles in summaries
+    PERCENTILES = (10, 50, 90)
+    # per Zigbee profile / cluster statistics, the interpreter then gives the
+    # APS header of each frame to .update()
+    ZIGBEE = False
+
+    def __init__(self):
+        if not available(np):
+            raise(Exception('NumPy not available'))
+        W = self.WINDOW
+        # per channel and bucket
+        self.frames = np.zeros((CHAN_NUM, W), np.uint32)
+        self.fcs_err = np.zeros((CHAN_NUM, W), np.uint32)
+        self.airtime = np.zeros((CHAN_NUM, W), np.float64)
+        self.rssi_hist = np.zeros((W, CHAN_NUM, RSSI_BINS), np.uint32)
+        # window totals, per channel
+        self.rssi_win = np.zeros((CHAN_NUM, RSSI_BINS), np.int64)
+        # per PAN ID and per source address
+        self.pans = _keyed(W)
+        self.srcs = _keyed(W)
+        # per Zigbee (profile, cluster)
+        self.clusters = _keyed(W)
+        # index of the current bucket, and host time of its opening
+        self._cur = None
+        self._cur_t = None
+        self._emit_t = time()
+
+    def _advance(self, b):
+        # expire buckets up to the bucket index b
+        W = self.WINDOW
+        if self._cur is None or b - self._cur >= W:
+            cols = np.arange(W)
+        else:
+            cols = np.arange(self._cur+1, b+1) % W
+        self.rssi_win -= self.rssi_hist[cols].sum(axis=0, dtype=np.int64)
+        self.frames[:, cols] = 0
+        self.fcs_err[:, cols] = 0
+        self.airtime[:, cols] = 0
+        self.rssi_hist[cols] = 0
+        self.pans.clear(cols)
+        self.srcs.clear(cols)
+        self.clusters.clear(cols)
+        self._cur = b
+
+    def _expire(self, now=None):
+        # advances the current bucket with the host time
+        if self._cur is None:
+            return
+        if now is None:
+            now = time()
+        n = int((now - self._cur_t) // self.BUCKET)
+        if n >= self.WINDOW:
+            # the whole window expired: the next frame opens a new one,
+            # whatever its time
+            self._advance(self._cur + n)
+            self._cur = None
+        elif n > 0:
+            self._advance(self._cur + n)
+            self._cur_t += n * self.BUCKET
+
+    def update(self, ts, chan, rssi=None, fcs_ok=True, frame='', hdr=None,
+               aps=None):
+        b = int(ts // self.BUCKET)
+        if self._cur is None or b > self._cur:
+            self._advance(b)
+            self._cur_t = time()
+        elif b <= self._cur - self.WINDOW:
+            # too old for the window
+            return
+        col = b % self.WINDOW
+        c = chan - CHAN_MIN
+        if not 0 <= c < CHAN_NUM:
+            return
+        self.frames[c, col] += 1
+        self.airtime[c, col] += (len(frame) + PHY_OVERHEAD) * BYTE_US
+        if not fcs_ok:
+            self.fcs_err[c, col] += 1
+            return
+        if rssi is not None:
+            r = min(RSSI_BINS-1, max(0, rssi + RSSI_OFF))
+            self.rssi_hist[col, c, r] += 1
+            self.rssi_win[c, r] += 1
+        else:
+            rssi = 0
+        if hdr is None:
+            # MAC header not already parsed by the caller
+            try:
+                hdr = mac_header(frame)
+            except ValueError:
+                return
+        pan, sam, saddr = hdr[6], hdr[5], hdr[7]
+        if pan is None:
+            pan = hdr[3]
+        if pan is not None:
+            r = self.pans.row(pan)
+            self.pans.frames[r, col] += 1
+            self.pans.rssi[r, col] += rssi
+            self.pans.last[r] = ts
+        if saddr is not None:
+            r = self.srcs.row((sam, saddr))
+            self.srcs.frames[r, col] += 1
+            self.srcs.rssi[r, col] += rssi
+            self.srcs.last[r] = ts
+        if aps is not None and aps[4] is not None:
+            r = self.clusters.row((aps[5], aps[4]))
+            self.clusters.frames[r, col] += 1
+            self.clusters.rssi[r, col] += rssi
+            self.clusters.last[r] = ts
+
+    def percentiles(self, chan, q=None):
+        # RSSI percentiles over the window, for a channel
+        if q is None:
+            q = self.PERCENTILES
+        cum = np.cumsum(self.rssi_win[chan - CHAN_MIN])
+        if cum[-1] == 0:
+            return [None for p in q]
+        idx = np.searchsorted(cum, [p * cum[-1] / 100.0 for p in q])
+        return [int(i) - RSSI_OFF for i in idx]
+
+    def summary(self, now=None):
+        self._expire(now)
+        span = self.WINDOW * self.BUCKET
+        lines = ['statistics over the last %is:' % span]
+        frames = self.frames.sum(axis=1)
+        fcs_err = self.fcs_err.sum(axis=1)
+        occup = self.airtime.sum(axis=1) / (span * 1e6)
+        for c in range(CHAN_NUM):
+            if frames[c] == 0:
+                continue
+            pct = self.percentiles(CHAN_MIN+c)
+            lines.append('channel %i: %.2f frames/s, occupancy %.3f%%, FCS errors '\
+                         '%.1f%%, RSSI p%s: %s' % (CHAN_MIN+c, frames[c] / span,
+                         100*occup[c], 100.0*fcs_err[c] / frames[c],
+                         '/p'.join(map(str, self.PERCENTILES)),
+                         '/'.join(map(str, pct))))
+        for pan, n, rssi, last in self.pans.top():
+            lines.append('PAN 0x%04x: %.2f frames/s, mean RSSI %.1f' \
+                         % (pan, n / span, rssi))
+        for (mode, addr), n, rssi, last in self.srcs.top():
+            lines.append('source %s: %.2f frames/s, mean RSSI %.1f' \
+                         % (addr_str(mode, addr), n / span, rssi))
+        for (profile, cluster), n, rssi, last in self.clusters.top():
+            lines.append('cluster 0x%04x/0x%04x: %.2f frames/s, mean RSSI %.1f' \
+                         % (profile, cluster, n / span, rssi))
+        return lines
+
+    def snapshot(self, path):
+        np.savez_compressed(path, bucket=self.BUCKET, cur=self._cur or 0,
+                            frames=self.frames, fcs_err=self.fcs_err,
+                            airtime=self.airtime, rssi_win=self.rssi_win,
+                            pan_keys=np.array(self.pans.keys, np.uint16),
+                            pan_frames=self.pans.frames[:len(self.pans.keys)],
+                            src_keys=np.array([a for m, a in self.srcs.keys],
+                                              np.uint64),
+                            src_frames=self.srcs.frames[:len(self.srcs.keys)],
+                            cluster_keys=np.array(self.clusters.keys,
+                                                  np.uint16).reshape(-1, 2),
+                            cluster_frames=self.clusters.frames[
+                                           :len(self.clusters.keys)])
+
+    def poll(self, now=None):
+        if not self.EMIT_PERIOD:
+            return
+        if now is None:
+            now = time()
+        if now - self._emit_t < self.EMIT_PERIOD:
+            return
+        self._emit_t = now
+        self._expire(now)
+        if self.DEBUG:
+            for line in self.summary(now):
+                LOG(line)
+        if self.SNAPSHOT_FILE:
+            path = self.SNAPSHOT_FILE % strftime('%Y%m%d-%H%M%S', localtime(now))
+            try:
+                self.snapshot(path)
+            except IOError:
+                LOG('cannot write snapshot to %s' % path)
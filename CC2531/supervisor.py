@@ -0,0 +1,425 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : supervisor.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+#
+# uses libusb1
+# http://www.libusb.org/
+# and python-libusb1
+# https://github.com/vpelletier/python-libusb1/
+###
+#
+# This is the supervisor of the receiver() threads, for unattended sniffers:
+# - a receiver is started for each CC2531 dongle plugged in, when plugged in
+#   (libusb hotplug events, or a periodic rescan when not supported),
+# - a receiver stopped on a USB error is restarted with an exponential
+#   backoff, and forgotten when its dongle is unplugged,
+# - the channels to monitor are shared again between the running receivers
+#   each time one starts or stops, except for dongles given their own
+#   channels (e.g. from the control socket),
+# - per dongle channels and dwell time are kept across receiver restarts,
+# - the state of each dongle is reported periodically, and as metrics,
+# - on quit, each receiver is joined, then its dongle is returned to idle and
+#   closed, with its socket, spool and capture ring.
+#
+
+from time import time
+from threading import Thread, Event
+from CC2531 import CHANNELS, CC2531, VID, PID, usb1
+from receiver import receiver
+from metrics import REGISTRY
+
+# export filtering
+__all__ = ['supervisor', 'share_channels']
+
+def LOG(msg=''):
+    print('[supervisor] %s' % msg)
+
+# metrics
+M_RESTARTS = REGISTRY.counter('supervisor_restarts_total',
+             'receivers restarted after a failure', ('dongle', ))
+M_DONGLES = REGISTRY.gauge('supervisor_dongles',
+            'dongles plugged in, by receiver state', ('state', ))
+
+def share_channels(chans, n):
+    '''
+    returns n lists of consecutive channels from chans, sharing them as
+    evenly as possible
+    '''
+    e, r = len(chans)//n, len(chans)%n
+    cl, start = [], 0
+    for i in range(n):
+        stop = start + e + (1 if i < r else 0)
+        cl.append(list(chans[start:stop]))
+        start = stop
+    return cl
+
+
+class _dongle(object):
+    '''
+    State of a dongle plugged in, and of its receiver
+    '''
+
+    def __init__(self, key, dev):
+        self.key = key
+        self.name = '%i:%i' % key
+        self.dev = dev
+        self.rcv = None
+        self.th = None
+        # restarts and backoff
+        self.failures = 0
+        self.starts = 0
+        self.next_start = 0.0
+        self.started = None
+        self.error = None
+        self._m_restarts = M_RESTARTS.labels(self.name)
+
+    def running(self):
+        return self.th is not None and self.th.is_alive()
+
+
+class supervisor(object):
+    '''
+    Keep a receiver() thread running for each CC2531 dongle plugged in,
+    sharing .CHAN_LIST between them
+    ---
+    .run() supervises until stopped (see .looping()), and returns when all
+    receivers have stopped.
+    A failed receiver is restarted after .RESTART_MIN second(s), doubling
+    up to .RESTART_MAX for each new failure, unless it ran for .STABLE
+    second(s) before failing.
+    .set_channels() and .set_period() change the channels and dwell time of
+    all receivers, or of a single dongle: these are kept for the dongle
+    across restarts and channels sharing.
+    '''
+    # debug level
+    DEBUG = 1
+    # for looping control
+    _THREADED = False
+    _STOP_EVENT = None
+    #
+    # 802.15.4 channels to share between the receivers
+    CHAN_LIST = CHANNELS.keys()
+    # time spent on each channel by the receivers (in second), None for the
+    # RECEIVER default
+    CHAN_PERIOD = None
+    # receiver class to start for each dongle
+    RECEIVER = receiver
+    #
+    # restart backoff (in second)
+    RESTART_MIN = 1.0
+    RESTART_MAX = 300.0
+    # running time (in second) after which a receiver failure is not counted
+    # in the backoff
+    STABLE = 60.0
+    # supervision period, and USB rescan period without hotplug support
+    # (in second)
+    CHECK_PERIOD = 1.0
+    SCAN_PERIOD = 5.0
+    # health report period (in second), 0 to disable
+    HEALTH_PERIOD = 300.0
+    # maximum time (in second) for a receiver thread to stop, before its
+    # dongle is closed
+    STOP_TO = 10.0
+
+    def __init__(self, chans=None):
+        if chans is not None:
+            self.CHAN_LIST = list(chans)
+        # a single USB context for all dongles, and hotplug events
+        self._ctx = usb1.USBContext()
+        self._dongles = {}
+        self._wake = Event()
+        self._supervising = False
+        self._hotplug = False
+        self._scan_t = 0.0
+        self._reshare = False
+        # per dongle channels and dwell time, by dongle name (bus:address)
+        self._chans = {}
+        self._periods = {}
+        self._health_t = time()
+        M_DONGLES.labels('running').set_function(
+            lambda: sum(1 for d in list(self._dongles.values()) if d.running()))
+        M_DONGLES.labels('stopped').set_function(
+            lambda: sum(1 for d in list(self._dongles.values()) \
+                        if not d.running()))
+
+    def _log(self, msg=''):
+        LOG(msg)
+
+    def looping(self):
+        if not self._supervising:
+            return False
+        elif not self._THREADED:
+            return True
+        elif hasattr(self._STOP_EVENT, 'is_set') \
+        and not self._STOP_EVENT.is_set():
+            return True
+        return False
+
+    def stop(self):
+        self._supervising = False
+        self._wake.set()
+
+    ###
+    # USB hotplug
+    ###
+
+    def _init_hotplug(self):
+        try:
+            if not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+                return False
+            self._ctx.hotplugRegisterCallback(self._hotplug_event,
+                                              vendor_id=VID, product_id=PID)
+        except (AttributeError, usb1.USBError):
+            # libusb or python-libusb1 without hotplug support
+            return False
+        th = Thread(target=self._handle_events, name='hotplug')
+        th.daemon = True
+        th.start()
+        return True
+
+    def _hotplug_event(self, ctx, dev, event):
+        # no USB I/O within libusb callbacks: the supervisor rescans
+        self._wake.set()
+        return False
+
+    def _handle_events(self):
+        while self._supervising:
+            try:
+                self._ctx.handleEventsTimeout(0.5)
+            except usb1.USBError:
+                pass
+
+    ###
+    # supervision
+    ###
+
+    def run(self):
+        self._supervising = True
+        self._hotplug = self._init_hotplug()
+        if self.DEBUG:
+            self._log('supervising CC2531 dongles (%s), channels %s' \
+                      % ('hotplug' if self._hotplug else 'rescan every %.1fs' \
+                         % self.SCAN_PERIOD, self.CHAN_LIST))
+        self._wake.set()
+        while self.looping():
+            if self._wake.is_set() or (not self._hotplug \
+            and time() - self._scan_t >= self.SCAN_PERIOD):
+                self._wake.clear()
+                self._scan()
+            self.check()
+            if self._reshare:
+                self._reshare = False
+                self.share()
+            self._wake.wait(self.CHECK_PERIOD)
+        self._supervising = False
+        # receivers stop on their own with the stop event, then their
+        # dongles, sockets, spools and capture rings are released
+        for d in list(self._dongles.values()):
+            if d.rcv is not None:
+                self._release(d)
+        if self.DEBUG:
+            self.report()
+
+    def _scan(self):
+        # reconciles the dongles with those plugged in: they are only
+        # enumerated (no USB I/O, unlike get_CC2531()), so that a glitch on
+        # a dongle is not taken for all of them being unplugged
+        self._scan_t = time()
+        devs = {}
+        try:
+            for dev in self._ctx.getDeviceList(skip_on_error=True):
+                if dev.getVendorID() == VID and dev.getProductID() == PID:
+                    devs[(dev.getBusNumber(), dev.getDeviceAddress())] = dev
+        except usb1.USBError as err:
+            if self.DEBUG:
+                self._log('USB enumeration failed: %r' % err)
+            return
+        changed = False
+        for key in list(self._dongles):
+            if key not in devs:
+                d = self._dongles.pop(key)
+                if self.DEBUG:
+                    self._log('dongle %s unplugged' % d.name)
+                if d.rcv is not None:
+                    self._release(d)
+                changed = True
+        for key, dev in devs.items():
+            if key not in self._dongles:
+                self._dongles[key] = _dongle(key, dev)
+                if self.DEBUG:
+                    self._log('dongle %s plugged in' % self._dongles[key].name)
+        if changed:
+            self.share()
+
+    def check(self):
+        # restarts failed receivers when their backoff elapsed
+        now, changed = time(), False
+        for d in list(self._dongles.values()):
+            if d.rcv is not None and not d.running():
+                self._failed(d, d.rcv.error or 'receiver stopped', now)
+                self._release(d)
+                changed = True
+            if d.rcv is None and now >= d.next_start:
+                changed |= self._start(d, now)
+        if changed:
+            self.share()
+        if self.HEALTH_PERIOD and now - self._health_t >= self.HEALTH_PERIOD:
+            self._health_t = now
+            self.report()
+
+    def _start(self, d, now):
+        try:
+            rcv = self.RECEIVER(CC2531(d.dev))
+        except Exception as err:
+            self._failed(d, err, now)
+            return False
+        # channels are given by .share(), once started
+        rcv.CHAN_LIST = []
+        period = self._periods.get(d.name, self.CHAN_PERIOD)
+        if period is not None:
+            rcv.CHAN_PERIOD = period
+        d.rcv, d.started = rcv, now
+        if d.starts:
+            d._m_restarts.inc()
+        d.starts += 1
+        d.th = Thread(target=rcv.listen, name='receiver %s' % d.name)
+        d.th.daemon = True
+        d.th.start()
+        return True
+
+    def _failed(self, d, err, now):
+        d.error = err
+        if d.started is not None and now - d.started >= self.STABLE:
+            d.failures = 0
+        d.failures += 1
+        backoff = min(self.RESTART_MAX,
+                      self.RESTART_MIN * 2 ** (d.failures - 1))
+        d.next_start = now + backoff
+        d.started = None
+        if self.DEBUG:
+            self._log('dongle %s failed (%r), restart in %.1fs' \
+                      % (d.name, err, backoff))
+
+    def _release(self, d):
+        # the receiver stops listening, its thread is joined, then its dongle
+        # is closed: never while the thread may still be reading from it
+        rcv, th, d.rcv, d.th = d.rcv, d.th, None, None
+        rcv._listening = False
+        if th is not None:
+            th.join(self.STOP_TO)
+            if th.is_alive():
+                self._log('dongle %s: receiver not stopped after %.1fs, left '\
+                          'open' % (d.name, self.STOP_TO))
+                return
+        rcv.stop()
+
+    def share(self):
+        # shares the channels between the running receivers without channels
+        # of their own, a receiver gets a new list only when its channels
+        # change
+        running = [d for d in sorted(self._dongles.values(),
+                                     key=lambda d: d.key) if d.running()]
+        if not running:
+            if self.DEBUG and self._dongles:
+                self._log('no receiver running')
+            return
+        own = [(d, self._chans[d.name]) for d in running if d.name in self._chans]
+        shared = [d for d in running if d.name not in self._chans]
+        if shared:
+            own.extend(zip(shared, share_channels(self.CHAN_LIST, len(shared))))
+        for d, chans in own:
+            if d.rcv.CHAN_LIST != chans:
+                d.rcv.CHAN_LIST = chans
+                if self.DEBUG:
+                    self._log('dongle %s on channel(s) %s' % (d.name, chans))
+
+    def receivers(self):
+        # returns the running receivers
+        return [d.rcv for d in sorted(self._dongles.values(),
+                                      key=lambda d: d.key) if d.running()]
+
+    def _dongle_name(self, dongle):
+        if dongle not in [d.name for d in list(self._dongles.values())]:
+            raise(Exception('no dongle %s plugged in' % dongle))
+        return dongle
+
+    def set_channels(self, chans, dongle=None):
+        # changes the channels to share, or the own channels of a dongle,
+        # from another thread: they are shared by the supervision loop;
+        # all dongles share the channels again when dongle is None
+        if dongle is None:
+            self.CHAN_LIST = list(chans)
+            self._chans.clear()
+        else:
+            self._chans[self._dongle_name(dongle)] = list(chans)
+        self._reshare = True
+        self._wake.set()
+
+    def set_period(self, period, dongle=None):
+        # changes the dwell time of all receivers, or of a dongle, returns
+        # the names of the dongles whose receiver got it
+        if dongle is None:
+            self.CHAN_PERIOD = period
+            self._periods.clear()
+        else:
+            self._periods[self._dongle_name(dongle)] = period
+        names = []
+        for d in list(self._dongles.values()):
+            rcv = d.rcv
+            if rcv is not None and (dongle is None or d.name == dongle):
+                rcv.CHAN_PERIOD = period
+                names.append(d.name)
+        return sorted(names)
+
+    def overrides(self):
+        # per dongle channels and dwell time
+        return {'chans': dict(self._chans), 'period': dict(self._periods)}
+
+    def health(self):
+        '''
+        returns a list of (dongle, state, channels, uptime, restarts, frames,
+                           last error) for each dongle plugged in
+        '''
+        now, h = time(), []
+        for key in sorted(self._dongles):
+            d = self._dongles[key]
+            if d.running():
+                h.append((d.name, 'running', d.rcv.CHAN_LIST,
+                          now - d.started, max(0, d.starts - 1),
+                          d.rcv._m_frames.value, d.error))
+            elif d.rcv is not None:
+                h.append((d.name, 'stopped', [], 0.0,
+                          max(0, d.starts - 1), d.rcv._m_frames.value,
+                          d.error))
+            else:
+                h.append((d.name, 'restart in %.1fs' \
+                          % max(0, d.next_start - now), [], 0.0,
+                          max(0, d.starts - 1), 0, d.error))
+        return h
+
+    def report(self):
+        h = self.health()
+        if not h:
+            self._log('health: no dongle plugged in')
+        for name, state, chans, up, restarts, frames, err in h:
+            self._log('health: dongle %s %s, channels %s, up %.0fs, %i '\
+                      'restart(s), %i frames%s' % (name, state, chans, up,
+                      restarts, frames, ', last error %r' % err if err else ''))
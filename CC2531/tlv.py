@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : tlv.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the parsing of the TLV messages sent by receiver() instances,
+# shared by the interpreter and decoder.py.
+#
+# Messages are walked with offsets within the received buffer: the values
+# are not copied until a handler needs them, and the decoded fields of a
+# frame are stored in a frame_record with fixed slots instead of a dict.
+#
+# TI PSD structures (the frames read from the CC2531) can be parsed here
+# without libmich, see unpack_ti_psd().
+#
+
+from struct import unpack_from, error as struct_error
+
+# export filtering
+__all__ = ['TAG_CHANNEL', 'TAG_TIME', 'TAG_GPRMC', 'TAG_POSITION',
+           'TAG_TI_PSD', 'TAG_MAC', 'tlv_walk', 'unpack_ti_psd',
+           'frame_record']
+
+TAG_CHANNEL = 0x01
+TAG_TIME = 0x02
+TAG_GPRMC = 0x03
+TAG_POSITION = 0x04
+TAG_TI_PSD = 0x10
+TAG_MAC = 0x20
+
+def tlv_walk(buf, off=0, end=None):
+    '''
+    yields (tag, start, stop) for each TLV of buf[off:end], the value being
+    buf[start:stop]; raises ValueError on a truncated TLV, after the
+    complete ones
+    '''
+    if end is None:
+        end = len(buf)
+    while off < end:
+        if off + 3 > end:
+            raise(ValueError('truncated TLV header at offset %i' % off))
+        T, L = unpack_from('!BH', buf, off)
+        off += 3
+        if off + L > end:
+            raise(ValueError('truncated TLV value at offset %i' % off))
+        yield T, off, off + L
+        off += L
+
+def unpack_ti_psd(V):
+    '''
+    returns (dongle timestamp, RSSI, FCS OK, 802.15.4 frame) from a TI PSD
+    structure: info (uint8), length (uint16 LE), timestamp (uint32 LE), frame
+    length (uint8, including 2 bytes of RSSI and FCS / correlation), frame,
+    RSSI (int8), FCS OK (1 bit) and correlation (7 bits);
+    raises ValueError when truncated
+    '''
+    try:
+        ts, l = unpack_from('<IB', V, 3)
+        if l < 2 or 8 + l > len(V):
+            raise(ValueError('truncated TI PSD frame'))
+        rssi, fcs = unpack_from('<bB', V, 6 + l)
+    except struct_error:
+        raise(ValueError('truncated TI PSD frame'))
+    return ts, rssi, bool(fcs & 0x80), V[8:6+l]
+
+
+class frame_record(object):
+    '''
+    Fields decoded from a message, None when not received:
+    .channel, .timestamp, .position (gps_fix or GPRMC sentence),
+    .frame (802.15.4 frame), .FCS_OK, .RSSI, .dev_ts (dongle timestamp),
+    .MAC (decoded frame), .trace (tuple of monotonic times),
+    .zigbee (Zigbee layers decoded on request, see zigbee.py)
+    ---
+    The dict-like access (rec['frame'], 'RSSI' in rec, rec.get()) of the
+    former message structure is kept for custom interpreters.
+    '''
+    __slots__ = ('channel', 'timestamp', 'position', 'frame', 'FCS_OK',
+                 'RSSI', 'dev_ts', 'MAC', 'trace', 'zigbee')
+
+    def __init__(self, channel=None, timestamp=None):
+        self.channel = channel
+        self.timestamp = timestamp
+        self.position = None
+        self.frame = None
+        self.FCS_OK = None
+        self.RSSI = None
+        self.dev_ts = None
+        self.MAC = None
+        self.trace = None
+        self.zigbee = None
+
+    def complete(self):
+        # a frame is processed only with its channel and reception time
+        return self.frame is not None and self.timestamp is not None \
+               and self.channel is not None
+
+    def __repr__(self):
+        return 'frame_record(%s)' % ', '.join('%s=%r' % (k, getattr(self, k)) \
+               for k in self.__slots__ if getattr(self, k) is not None)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def __getitem__(self, key):
+        val = getattr(self, key, None)
+        if val is None:
+            raise(KeyError(key))
+        return val
+
+    def __setitem__(self, key, val):
+        setattr(self, key, val)
+
+    def get(self, key, default=None):
+        val = getattr(self, key, None)
+        return default if val is None else val
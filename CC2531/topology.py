@@ -0,0 +1,285 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : topology.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the live inventory of PANs, devices and links (who talks to whom),
+# fed by the interpreter with the MAC header of each frame received.
+#
+# Each PAN, device and link gets a row number when first seen, and its
+# attributes are stored in array columns at this row: the dictionaries only
+# map integer keys to row numbers.
+# Short addresses are only unique within a PAN, hence short address devices
+# are keyed with their PAN ID, and extended address devices with their
+# address only.
+#
+
+import json
+from array import array
+from time import time, strftime, localtime
+from mac import *
+
+# export filtering
+__all__ = ['topology']
+
+def LOG(msg=''):
+    print('[topology] %s' % msg)
+
+BROADCAST = 0xffff
+
+
+class topology(object):
+    '''
+    Incremental index of PANs, devices and links, fed with .update() for each
+    frame received with a correct FCS.
+    ---
+    Query API:
+    .pans() : list of PANs, as dict
+    .devices(pan=None, since=0) : list of devices, as dict
+    .device(mode, addr, pan=None) : a single device, as dict, or None
+    .links(mode=None, addr=None, pan=None) : list of links, as dict,
+        all of them or only those of a given device
+    ---
+    .poll() emits a summary every .EMIT_PERIOD second(s), and writes a
+    snapshot of the whole index into .SNAPSHOT_FILE (JSON) when set.
+    '''
+    # debug level
+    DEBUG = 1
+    # summary period (in second), 0 to disable
+    EMIT_PERIOD = 60
+    # snapshot file, %s is replaced with the snapshot time, or None
+    #SNAPSHOT_FILE = '/tmp/cc2531_topology_%s.json'
+    SNAPSHOT_FILE = None
+
+    def __init__(self):
+        # PANs
+        self._pan_idx = {}
+        self.pan_id = array('H')
+        self.pan_first = array('d')
+        self.pan_last = array('d')
+        self.pan_frames = array('L')
+        self.pan_beacons = array('L')
+        self.pan_chan = array('B')
+        # row of the beacon source device, -1 when unknown
+        self.pan_coord = array('l')
+        # devices
+        self._dev_idx = {}
+        self.dev_keys = []
+        self.dev_mode = array('B')
+        self.dev_pan = array('l')
+        self.dev_first = array('d')
+        self.dev_last = array('d')
+        self.dev_tx = array('L')
+        self.dev_rx = array('L')
+        self.dev_rssi = array('d')
+        self.dev_chan = array('B')
+        # bit mask of the types of frame sent
+        self.dev_ftypes = array('B')
+        # links, keyed with (source row << 32 | destination row)
+        self._link_idx = {}
+        self.link_src = array('L')
+        self.link_dst = array('L')
+        self.link_first = array('d')
+        self.link_last = array('d')
+        self.link_frames = array('L')
+        self.link_rssi = array('d')
+        # links per device row, both ways
+        self._dev_links = {}
+        #
+        self._emit_t = time()
+
+    def _pan_row(self, pan, ts, chan):
+        try:
+            return self._pan_idx[pan]
+        except KeyError:
+            r = self._pan_idx[pan] = len(self.pan_id)
+            self.pan_id.append(pan)
+            self.pan_first.append(ts)
+            self.pan_last.append(ts)
+            self.pan_frames.append(0)
+            self.pan_beacons.append(0)
+            self.pan_chan.append(chan)
+            self.pan_coord.append(-1)
+            return r
+
+    def _dev_row(self, mode, pan, addr, ts, chan):
+        key = dev_key(mode, pan, addr)
+        try:
+            return self._dev_idx[key]
+        except KeyError:
+            r = self._dev_idx[key] = len(self.dev_keys)
+            self.dev_keys.append(key)
+            self.dev_mode.append(mode)
+            self.dev_pan.append(-1 if pan is None else pan)
+            self.dev_first.append(ts)
+            self.dev_last.append(ts)
+            self.dev_tx.append(0)
+            self.dev_rx.append(0)
+            self.dev_rssi.append(0)
+            self.dev_chan.append(chan)
+            self.dev_ftypes.append(0)
+            return r
+
+    def _link_row(self, src, dst, ts):
+        key = (src << 32) | dst
+        try:
+            return self._link_idx[key]
+        except KeyError:
+            r = self._link_idx[key] = len(self.link_src)
+            self.link_src.append(src)
+            self.link_dst.append(dst)
+            self.link_first.append(ts)
+            self.link_last.append(ts)
+            self.link_frames.append(0)
+            self.link_rssi.append(0)
+            self._dev_links.setdefault(src, []).append(r)
+            self._dev_links.setdefault(dst, []).append(r)
+            return r
+
+    def update(self, ts, chan, rssi, hdr):
+        '''
+        index a frame, given its MAC header as returned by mac_header()
+        '''
+        ftype, seq, dam, dpan, daddr, sam, span, saddr, hdrlen = hdr
+        if rssi is None:
+            rssi = 0
+        pan = span if span is not None else dpan
+        if pan is not None and pan != BROADCAST:
+            p = self._pan_row(pan, ts, chan)
+            self.pan_last[p] = ts
+            self.pan_frames[p] += 1
+            self.pan_chan[p] = chan
+        else:
+            p = None
+        #
+        s = d = None
+        if saddr is not None:
+            s = self._dev_row(sam, span, saddr, ts, chan)
+            self.dev_last[s] = ts
+            self.dev_tx[s] += 1
+            self.dev_rssi[s] += rssi
+            self.dev_chan[s] = chan
+            self.dev_ftypes[s] |= 1 << ftype
+            if ftype == FT_BEACON and p is not None:
+                self.pan_beacons[p] += 1
+                self.pan_coord[p] = s
+        if daddr is not None and not (dam == ADDR_SHORT and daddr == BROADCAST):
+            d = self._dev_row(dam, dpan, daddr, ts, chan)
+            self.dev_rx[d] += 1
+        if s is not None and d is not None:
+            l = self._link_row(s, d, ts)
+            self.link_last[l] = ts
+            self.link_frames[l] += 1
+            self.link_rssi[l] += rssi
+
+    # query API
+    def _dev_dict(self, r):
+        mode, pan = self.dev_mode[r], self.dev_pan[r]
+        key = self.dev_keys[r]
+        addr = key & 0xffff if mode == ADDR_SHORT else key
+        tx = self.dev_tx[r]
+        return {'addr': addr_str(mode, addr),
+                'pan': pan if pan >= 0 else None,
+                'first': self.dev_first[r], 'last': self.dev_last[r],
+                'tx': tx, 'rx': self.dev_rx[r],
+                'rssi': self.dev_rssi[r] / tx if tx else None,
+                'channel': self.dev_chan[r],
+                'types': [FRAME_TYPES[t] for t in sorted(FRAME_TYPES) \
+                          if self.dev_ftypes[r] & (1 << t)]}
+
+    def _link_dict(self, r):
+        n = self.link_frames[r]
+        return {'src': self._dev_dict(self.link_src[r])['addr'],
+                'dst': self._dev_dict(self.link_dst[r])['addr'],
+                'first': self.link_first[r], 'last': self.link_last[r],
+                'frames': n, 'rssi': self.link_rssi[r] / n if n else None}
+
+    def pans(self):
+        res = []
+        for p in range(len(self.pan_id)):
+            c = self.pan_coord[p]
+            res.append({'pan': self.pan_id[p],
+                        'first': self.pan_first[p], 'last': self.pan_last[p],
+                        'frames': self.pan_frames[p],
+                        'beacons': self.pan_beacons[p],
+                        'channel': self.pan_chan[p],
+                        'coordinator': self._dev_dict(c)['addr'] if c >= 0 \
+                                       else None})
+        return res
+
+    def devices(self, pan=None, since=0):
+        return [self._dev_dict(r) for r in range(len(self.dev_keys)) \
+                if (pan is None or self.dev_pan[r] == pan) \
+                and self.dev_last[r] >= since]
+
+    def device(self, mode, addr, pan=None):
+        try:
+            r = self._dev_idx[dev_key(mode, pan, addr)]
+        except KeyError:
+            return None
+        return self._dev_dict(r)
+
+    def links(self, mode=None, addr=None, pan=None):
+        if addr is None:
+            rows = range(len(self.link_src))
+        else:
+            try:
+                rows = self._dev_links.get(self._dev_idx[dev_key(mode, pan, addr)],
+                                           [])
+            except KeyError:
+                rows = []
+        return [self._link_dict(r) for r in rows]
+
+    def summary(self):
+        lines = ['%i PAN(s), %i device(s), %i link(s)' \
+                 % (len(self.pan_id), len(self.dev_keys), len(self.link_src))]
+        for pan in self.pans():
+            lines.append('PAN 0x%04x, channel %i: %i device(s), coordinator %s, '\
+                         'last seen %s' % (pan['pan'], pan['channel'],
+                         self.dev_pan.count(pan['pan']), pan['coordinator'],
+                         strftime('%H:%M:%S', localtime(pan['last']))))
+        return lines
+
+    def snapshot(self, path):
+        fd = open(path, 'w')
+        try:
+            json.dump({'time': time(), 'pans': self.pans(),
+                       'devices': self.devices(), 'links': self.links()}, fd)
+        finally:
+            fd.close()
+
+    def poll(self, now=None):
+        if not self.EMIT_PERIOD:
+            return
+        if now is None:
+            now = time()
+        if now - self._emit_t < self.EMIT_PERIOD:
+            return
+        self._emit_t = now
+        if self.DEBUG:
+            for line in self.summary():
+                LOG(line)
+        if self.SNAPSHOT_FILE:
+            path = self.SNAPSHOT_FILE % strftime('%Y%m%d-%H%M%S', localtime(now))
+            try:
+                self.snapshot(path)
+            except IOError:
+                LOG('cannot write snapshot to %s' % path)
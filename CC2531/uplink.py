@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : uplink.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the compact encoding of batches of frames, used by receiver()
+# instances forwarding over low-bandwidth links.
+#
+# A batch is sent as a single TLV, Tag=0x30, whose value is:
+# codec : uint8 (0: none, 1: zlib, 2: lzma), followed by the block,
+# compressed with the given codec.
+#
+# The uncompressed block is:
+# base timestamp : double (BE), number of records : uint16 (BE),
+# and then, for each record:
+# flags : uint8 (0x01: channel follows, 0x02: position follows),
+# time delta with the previous record, in microseconds : uint32 (BE),
+# frame length : uint16 (BE),
+# [channel : uint8], only when it changed since the previous record,
+# [position length : uint16 (BE), position : char*], only when it changed,
+# position being a packed gps_fix (as the value of Tag=0x04), or empty when
+# the position was lost,
+# 802.15.4 frame within TI PSD structure : char*[frame length]
+#
+# Time deltas are limited to DT_MAX second(s), and the records of the
+# uncompressed block to BLOCK_MAXLEN bytes, so that the compressed block fits
+# in the TLV length: batches are to be flushed before (see record_len()).
+#
+
+import zlib
+from struct import pack, unpack, calcsize
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# export filtering
+__all__ = ['TAG_BATCH', 'CODECS', 'DT_MAX', 'BLOCK_MAXLEN', 'record_len',
+           'pack_batch', 'unpack_batch']
+
+TAG_BATCH = 0x30
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {
+    None : CODEC_NONE,
+    'none' : CODEC_NONE,
+    'zlib' : CODEC_ZLIB,
+    'lzma' : CODEC_LZMA,
+    }
+
+_HDR = '!dH'
+_HDR_LEN = calcsize(_HDR)
+_REC = '!BIH'
+_REC_LEN = calcsize(_REC)
+
+F_CHAN = 0x01
+F_POS = 0x02
+
+# largest time delta between 2 records, in second
+DT_MAX = 0xffffffff / 1000000.0
+# largest size of the records of a block, leaving room for its header and
+# the expansion of incompressible data by zlib or lzma within the TLV length
+# (uint16)
+BLOCK_MAXLEN = 0xffff - 1024
+
+def record_len(data, pos=None):
+    '''
+    returns the largest size of a record within the uncompressed block,
+    channel and position included
+    '''
+    return _REC_LEN + 3 + len(pos or b'') + len(data)
+
+def pack_batch(records, codec='zlib', level=6):
+    '''
+    returns the value of the batch TLV, from a list of records
+    (channel, timestamp, position, TI PSD frame);
+    raises ValueError when the records exceed BLOCK_MAXLEN
+    '''
+    if not records:
+        return b''
+    t0 = prev_t = records[0][1]
+    prev_chan, prev_pos = None, None
+    block = [pack(_HDR, t0, len(records))]
+    for chan, ts, pos, data in records:
+        flags, opt, pos = 0, [], pos or None
+        if chan != prev_chan:
+            flags |= F_CHAN
+            opt.append(pack('!B', chan))
+            prev_chan = chan
+        if pos != prev_pos:
+            # an empty position when lost
+            flags |= F_POS
+            opt.append(pack('!H', len(pos) if pos else 0))
+            if pos:
+                opt.append(pos)
+            prev_pos = pos
+        # clamped within the uint32
+        dt = min(0xffffffff, max(0, int(round((ts - prev_t) * 1000000))))
+        prev_t += dt / 1000000.0
+        block.append(pack(_REC, flags, dt, len(data)))
+        block.extend(opt)
+        block.append(data)
+    block = b''.join(block)
+    if len(block) - _HDR_LEN > BLOCK_MAXLEN:
+        raise(ValueError('batch records of %i bytes' % (len(block) - _HDR_LEN)))
+    #
+    c = CODECS[codec]
+    if c == CODEC_ZLIB:
+        block = zlib.compress(block, level)
+    elif c == CODEC_LZMA:
+        if lzma is None:
+            raise(Exception('lzma not available'))
+        block = lzma.compress(block, preset=level)
+    return b''.join((pack('!B', c), block))
+
+def unpack_batch(V):
+    '''
+    yields each record (channel, timestamp, position, TI PSD frame)
+    from the value of a batch TLV
+    '''
+    c, block = unpack('!B', V[0:1])[0], V[1:]
+    if c == CODEC_ZLIB:
+        block = zlib.decompress(block)
+    elif c == CODEC_LZMA:
+        if lzma is None:
+            raise(Exception('lzma not available'))
+        block = lzma.decompress(block)
+    elif c != CODEC_NONE:
+        raise(Exception('unknown batch codec %i' % c))
+    #
+    ts, num = unpack(_HDR, block[:_HDR_LEN])
+    i = _HDR_LEN
+    chan, pos = None, None
+    for n in range(num):
+        flags, dt, l = unpack(_REC, block[i:i+_REC_LEN])
+        i += _REC_LEN
+        if flags & F_CHAN:
+            chan = unpack('!B', block[i:i+1])[0]
+            i += 1
+        if flags & F_POS:
+            pl = unpack('!H', block[i:i+2])[0]
+            pos = block[i+2:i+2+pl] or None
+            i += 2+pl
+        ts += dt / 1000000.0
+        yield chan, ts, pos, block[i:i+l]
+        i += l
@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : zigbee.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# This is the decoding of the Zigbee layers above the 802.15.4 MAC: NWK, APS
+# and ZCL headers, as integers (see mac.py), for the consumers of the
+# interpreter (output, statistics).
+#
+# It is lazy: nothing is decoded when frames are received, a consumer asks
+# for a layer of a frame record, and only the layers up to it are decoded,
+# once per frame, then cached within the record. Frames can be restricted to
+# some channels and PANs. Encrypted payloads (MAC, NWK or APS security) are
+# not decoded.
+#
+
+from struct import unpack_from, error as struct_error
+from mac import mac_header, FT_DATA
+
+# export filtering
+__all__ = ['LAYERS', 'nwk_header', 'aps_header', 'zcl_header', 'zigbee']
+
+LAYERS = ('nwk', 'aps', 'zcl')
+_DEPTH = dict((l, i) for i, l in enumerate(LAYERS))
+
+# NWK frame types
+NWK_DATA = 0
+NWK_CMD = 1
+# APS frame types and delivery modes
+APS_DATA = 0
+APS_CMD = 1
+APS_ACK = 2
+APS_GROUP = 3
+# Zigbee Device Profile, not carrying ZCL
+PROFILE_ZDP = 0x0000
+
+def nwk_header(frame, off=0):
+    '''
+    returns (frame type, protocol version, dest addr, source addr, radius,
+             sequence number, dest IEEE addr, source IEEE addr, security,
+             header length)
+    from a Zigbee NWK frame at frame[off:], IEEE addresses are None when
+    absent; raises ValueError when the frame is too short or not Zigbee
+    (2006 / PRO)
+    '''
+    try:
+        fc, dst, src, radius, seq = unpack_from('<HHHBB', frame, off)
+        ver = (fc >> 2) & 0xf
+        if ver not in (2, 3):
+            raise(ValueError('not a Zigbee NWK frame'))
+        i = off + 8
+        dext = sext = None
+        if fc & 0x0800:
+            dext = unpack_from('<Q', frame, i)[0]
+            i += 8
+        if fc & 0x1000:
+            sext = unpack_from('<Q', frame, i)[0]
+            i += 8
+        if fc & 0x0100:
+            # multicast control
+            i += 1
+        if fc & 0x0400:
+            # source route: relay count, relay index, relay list
+            i += 2 + 2 * unpack_from('<B', frame, i)[0]
+    except struct_error:
+        raise(ValueError('frame too short'))
+    if i > len(frame):
+        raise(ValueError('frame too short'))
+    return fc & 0x3, ver, dst, src, radius, seq, dext, sext, \
+           bool(fc & 0x0200), i - off
+
+def aps_header(frame, off=0):
+    '''
+    returns (frame type, delivery mode, dest endpoint, group addr, cluster,
+             profile, source endpoint, APS counter, security, header length)
+    from a Zigbee APS frame at frame[off:], absent fields are None; raises
+    ValueError when the frame is too short
+    '''
+    dep = group = cluster = profile = sep = None
+    try:
+        fc = unpack_from('<B', frame, off)[0]
+        ftype, mode = fc & 0x3, (fc >> 2) & 0x3
+        i = off + 1
+        if ftype == APS_DATA or (ftype == APS_ACK and not fc & 0x10):
+            if mode == APS_GROUP:
+                group = unpack_from('<H', frame, i)[0]
+                i += 2
+            else:
+                dep = unpack_from('<B', frame, i)[0]
+                i += 1
+            cluster, profile, sep = unpack_from('<HHB', frame, i)
+            i += 5
+        counter = unpack_from('<B', frame, i)[0]
+        i += 1
+        if fc & 0x80:
+            # extended header, with the block number when fragmented
+            i += 2 if unpack_from('<B', frame, i)[0] & 0x3 else 1
+    except struct_error:
+        raise(ValueError('frame too short'))
+    if i > len(frame):
+        raise(ValueError('frame too short'))
+    return ftype, mode, dep, group, cluster, profile, sep, counter, \
+           bool(fc & 0x20), i - off
+
+def zcl_header(frame, off=0):
+    '''
+    returns (frame type, manufacturer code, direction, sequence number,
+             command, header length)
+    from a ZCL frame at frame[off:], the manufacturer code is None when
+    absent; raises ValueError when the frame is too short
+    '''
+    try:
+        fc = unpack_from('<B', frame, off)[0]
+        i = off + 1
+        manuf = None
+        if fc & 0x04:
+            manuf = unpack_from('<H', frame, i)[0]
+            i += 2
+        seq, cmd = unpack_from('<BB', frame, i)
+    except struct_error:
+        raise(ValueError('frame too short'))
+    return fc & 0x3, manuf, (fc >> 3) & 0x1, seq, cmd, i + 2 - off
+
+
+class zigbee(object):
+    '''
+    Lazy decoding of the Zigbee layers of frame records
+    ---
+    .get(rec, layer) returns the header of layer (see LAYERS) within the
+    frame of rec, or None: layers are decoded up to it on the first request
+    for the frame, and cached within rec.zigbee.
+    Only frames on .CHANS, from / to .PANS (sets of integers, None for all)
+    are decoded.
+    .layers are the layers requested for the output (see output.renderer).
+    '''
+    # frames to decode, by channel and PAN, None for all
+    CHANS = None
+    PANS = None
+
+    def __init__(self, layers=LAYERS):
+        self.set_layers(layers)
+        # counters
+        self.decoded = 0
+        self.skipped = 0
+
+    def set_layers(self, layers):
+        for l in layers:
+            if l not in _DEPTH:
+                raise(Exception('unknown Zigbee layer %r' % l))
+        self.layers = frozenset(layers)
+
+    def get(self, rec, layer):
+        # rec.zigbee: [number of layers decoded, offset of the next layer
+        #              or None, NWK header, APS header, ZCL header]
+        cache = rec.zigbee
+        if cache is None:
+            rec.zigbee = cache = self._start(rec)
+        d = _DEPTH[layer]
+        while cache[0] <= d and cache[1] is not None:
+            self._next(rec.frame, cache)
+        return cache[2+d] if cache[0] > d else None
+
+    def _start(self, rec):
+        # MAC data frames without security, within the filters
+        if not rec.frame or not rec.FCS_OK \
+        or (self.CHANS is not None and rec.channel not in self.CHANS):
+            self.skipped += 1
+            return [0, None, None, None, None]
+        try:
+            ftype, seq, dam, dpan, daddr, sam, span, saddr, hl = \
+                mac_header(rec.frame)
+        except ValueError:
+            self.skipped += 1
+            return [0, None, None, None, None]
+        if ftype != FT_DATA or unpack_from('<B', rec.frame)[0] & 0x08 \
+        or (self.PANS is not None and dpan not in self.PANS \
+            and span not in self.PANS):
+            self.skipped += 1
+            return [0, None, None, None, None]
+        self.decoded += 1
+        return [0, hl, None, None, None]
+
+    def _next(self, frame, cache):
+        # decodes the next layer at cache[1]
+        d, off = cache[0], cache[1]
+        cache[0], cache[1] = d + 1, None
+        try:
+            if d == 0:
+                hdr = nwk_header(frame, off)
+                if hdr[0] == NWK_DATA and not hdr[8]:
+                    cache[1] = off + hdr[9]
+            elif d == 1:
+                hdr = aps_header(frame, off)
+                if hdr[0] == APS_DATA and not hdr[8] \
+                and hdr[5] != PROFILE_ZDP:
+                    cache[1] = off + hdr[9]
+            else:
+                hdr = zcl_header(frame, off)
+        except ValueError:
+            return
+        cache[2+d] = hdr
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : test_capture.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# Tests of the pcap readers (capture.read_pcap() and capture.scan_pcap()):
+# the NumPy scan, when available, must select the same datagrams as
+# read_pcap().
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from struct import pack
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'CC2531'))
+from capture import UDP_PORT, pcap_writer, read_pcap, scan_pcap
+
+T0 = 1384300800.0
+
+
+def _msg(seq, chan):
+    # message on a channel, with its length prefix
+    m = b''.join((b'\x01\x00\x01', pack('!B', chan),
+                  b'\x10', pack('!H', seq), b'x' * seq))
+    return pack('!I', len(m)) + m
+
+
+class test_pcap(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.pcap')
+        wr = pcap_writer(self.path)
+        for i in range(8):
+            wr.write(_msg(i, 11 + i % 4), T0 + i)
+        # a batch, not selected by channel
+        wr.write(b'\x00\x00\x00\x03\x30\x00\x00', T0 + 8)
+        wr.close()
+        # to another port
+        wr = pcap_writer(os.path.join(self.dir, 'other.pcap'),
+                         dst=('127.0.0.1', UDP_PORT + 1))
+        wr.write(_msg(0, 11), T0)
+        wr.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        dgrams = list(read_pcap(self.path))
+        self.assertEqual(len(dgrams), 9)
+        self.assertEqual(dgrams[3], (T0 + 3, _msg(3, 14)))
+        other = os.path.join(self.dir, 'other.pcap')
+        self.assertEqual(list(read_pcap(other)), [])
+        self.assertEqual(len(list(read_pcap(other, None))), 1)
+
+    def test_scan_all(self):
+        self.assertEqual(list(scan_pcap(self.path)),
+                         list(read_pcap(self.path)))
+
+    def test_scan_selection(self):
+        dgrams = list(read_pcap(self.path))
+        self.assertEqual(list(scan_pcap(self.path, chans=(12,))),
+                         [dgrams[1], dgrams[5], dgrams[8]])
+        self.assertEqual(list(scan_pcap(self.path, start=T0 + 2,
+                                        end=T0 + 4)), dgrams[2:5])
+        self.assertEqual(list(scan_pcap(self.path, lmin=12, lmax=13)),
+                         dgrams[1:3])
+        self.assertEqual(list(scan_pcap(self.path, UDP_PORT + 1)), [])
+
+    def test_truncated(self):
+        # the last record is cut anywhere
+        buf = open(self.path, 'rb').read()
+        for cut in range(1, 60):
+            fd = open(self.path, 'wb')
+            fd.write(buf[:-cut])
+            fd.close()
+            self.assertEqual(list(scan_pcap(self.path)),
+                             list(read_pcap(self.path)))
+
+    def test_not_pcap(self):
+        fd = open(self.path, 'wb')
+        fd.write(b'\0' * 40)
+        fd.close()
+        self.assertRaises(ValueError, list, read_pcap(self.path))
+        self.assertRaises(ValueError, list, scan_pcap(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
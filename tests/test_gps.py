@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : test_gps.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# Tests of the NMEA sentences parsing of the GPS reader (gps.GPS_reader).
+#
+
+import os
+import sys
+import unittest
+from calendar import timegm
+from functools import reduce
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'CC2531'))
+from gps import GPS_reader, gps_track
+
+RMC = '123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W'
+RMC_NOFIX = ',V,,,,,,,,,'
+RMC_VOID = '123520,V,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W'
+GGA = '123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,'
+GGA_NOFIX = '123520,4807.038,N,01131.000,E,0,00,,545.4,M,46.9,M,,'
+
+
+class _reader(GPS_reader):
+    # without GPS source, nor track file
+    DEBUG = 0
+
+    def __init__(self):
+        self.fix = None
+        self.track = gps_track()
+        self._fix_t = 0.0
+        self.infos = dict((t, []) for t in self.NMEA_TYPE)
+        self._rbuf = b''
+
+
+def _sentence(nmea_t, body):
+    line = '%s,%s' % (nmea_t, body)
+    cs = reduce(lambda a, c: a ^ ord(c), line, 0)
+    return ('$%s*%02X\r\n' % (line, cs)).encode('ascii')
+
+
+class _chunks(object):
+    # source returning its buffer in fixed-size bytes chunks
+
+    def __init__(self, buf, size):
+        self._buf = buf
+        self._size = size
+
+    def read(self):
+        if not self._buf:
+            return None
+        buf, self._buf = self._buf[:self._size], self._buf[self._size:]
+        return buf
+
+
+class test_nmea(unittest.TestCase):
+
+    def setUp(self):
+        self.gps = _reader()
+
+    def test_rmc(self):
+        self.gps._parse_rmc(RMC.split(','))
+        fix = self.gps.get_fix()
+        self.assertTrue(fix.valid)
+        self.assertAlmostEqual(fix.lat, 48 + 7.038 / 60)
+        self.assertAlmostEqual(fix.lon, 11 + 31.0 / 60)
+        self.assertAlmostEqual(fix.speed, 22.4 * GPS_reader.KNOT)
+        self.assertEqual(fix.time, timegm((1994, 3, 23, 12, 35, 19)))
+        self.assertEqual(len(self.gps.track), 1)
+
+    def test_southern_western(self):
+        rmc = RMC.replace(',N,', ',S,').replace(',E,', ',W,', 1)
+        self.gps._parse_rmc(rmc.split(','))
+        fix = self.gps.get_fix()
+        self.assertAlmostEqual(fix.lat, -(48 + 7.038 / 60))
+        self.assertAlmostEqual(fix.lon, -(11 + 31.0 / 60))
+
+    def test_rmc_lost_fix(self):
+        # the last position is kept, as invalid, and not tracked
+        self.gps._parse_rmc(RMC.split(','))
+        for rmc in (RMC_NOFIX, RMC_VOID):
+            self.gps._parse_rmc(rmc.split(','))
+            fix = self.gps.get_fix()
+            self.assertFalse(fix.valid)
+            self.assertAlmostEqual(fix.lat, 48 + 7.038 / 60)
+        self.assertEqual(len(self.gps.track), 1)
+
+    def test_rmc_no_fix_first(self):
+        self.gps._parse_rmc(RMC_NOFIX.split(','))
+        self.assertEqual(self.gps.get_fix(), None)
+
+    def test_gga(self):
+        # altitude only, once a position is known
+        self.gps._parse_gga(GGA.split(','))
+        self.assertEqual(self.gps.get_fix(), None)
+        self.gps._parse_rmc(RMC.split(','))
+        self.gps._parse_gga(GGA.split(','))
+        fix = self.gps.get_fix()
+        self.assertTrue(fix.valid)
+        self.assertAlmostEqual(fix.alt, 545.4, 3)
+        self.assertAlmostEqual(fix.lat, 48 + 7.038 / 60)
+        # the altitude is kept by the next GPRMC
+        self.gps._parse_rmc(RMC.split(','))
+        self.assertAlmostEqual(self.gps.get_fix().alt, 545.4, 3)
+
+    def test_gga_no_fix(self):
+        self.gps._parse_rmc(RMC.split(','))
+        self.gps._parse_gga(GGA_NOFIX.split(','))
+        self.assertFalse(self.gps.get_fix().valid)
+        # no altitude: ignored
+        self.gps._parse_gga(GGA.replace('545.4', '').split(','))
+        self.assertFalse(self.gps.get_fix().valid)
+
+
+
+class test_read(unittest.TestCase):
+
+    def test_chunked_bytes(self):
+        gps = _reader()
+        buf = _sentence('GPRMC', RMC) + _sentence('GPGGA', GGA)
+        gps._src = _chunks(buf, 7)
+        while gps.read_pending():
+            pass
+        self.assertEqual([l[:-3] for l in gps.infos['GPRMC']], [RMC])
+        self.assertEqual([l[:-3] for l in gps.infos['GPGGA']], [GGA])
+        fix = gps.get_fix()
+        self.assertTrue(fix.valid)
+        self.assertAlmostEqual(fix.alt, 545.4, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
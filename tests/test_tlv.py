@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : test_tlv.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# Tests of the TLV walker of the interpreter (tlv.tlv_walk()).
+#
+
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'CC2531'))
+from tlv import tlv_walk
+
+# channel 11, time '1.5', empty position
+MSG = b'\x01\x00\x01\x0b' + b'\x02\x00\x031.5' + b'\x04\x00\x00'
+
+
+class test_tlv_walk(unittest.TestCase):
+
+    def test_walk(self):
+        self.assertEqual(list(tlv_walk(MSG)),
+                         [(1, 3, 4), (2, 7, 10), (4, 13, 13)])
+        self.assertEqual(MSG[7:10], b'1.5')
+
+    def test_window(self):
+        # offsets stay relative to the whole buffer
+        buf = b'\x00\x00\x00\x0a' + MSG
+        self.assertEqual(list(tlv_walk(buf, 4, 4 + 10)),
+                         [(1, 7, 8), (2, 11, 14)])
+        self.assertEqual(list(tlv_walk(MSG, 4, 4)), [])
+
+    def test_truncated_value(self):
+        # complete TLVs are yielded before the error
+        walk = tlv_walk(MSG[:9])
+        self.assertEqual(next(walk), (1, 3, 4))
+        self.assertRaises(ValueError, next, walk)
+
+    def test_truncated_header(self):
+        walk = tlv_walk(MSG[:6])
+        self.assertEqual(next(walk), (1, 3, 4))
+        self.assertRaises(ValueError, next, walk)
+
+
+if __name__ == '__main__':
+    unittest.main()
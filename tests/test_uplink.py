@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : test_uplink.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# Tests of the batch encoding of the uplink (uplink.py), and of its limits
+# within receiver() batches.
+#
+
+import os
+import sys
+import unittest
+from struct import pack, unpack
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'CC2531'))
+from uplink import *
+from gps import gps_fix
+try:
+    from receiver import receiver
+except ImportError:
+    # python-libusb1 not available
+    receiver = None
+
+T0 = 1384300800.0
+FIX = gps_fix(48.1173, 11.5166, 545.4, 1.5, T0, True).packed
+
+
+def _psd(seq, payload=20):
+    return pack('<BHIB', 0, payload + 7, seq, payload + 2) + \
+           os.urandom(payload) + b'\xd8\x80'
+
+def _records(batch):
+    return [(c, round(t, 6), p, d) for c, t, p, d in unpack_batch(batch)]
+
+
+class test_batch(unittest.TestCase):
+
+    def test_round_trip(self):
+        recs = [(11, T0, None, _psd(0)), (11, T0 + 0.25, FIX, _psd(1)),
+                (15, T0 + 0.5, FIX, _psd(2)), (15, T0 + 1.0, None, _psd(3))]
+        for codec in ('none', 'zlib'):
+            self.assertEqual(_records(pack_batch(recs, codec)), recs)
+        self.assertEqual(pack_batch([]), b'')
+
+    def test_lost_position(self):
+        # a lost position is not replaced with the previous one
+        recs = [(11, T0 + i, pos, _psd(i))
+                for i, pos in enumerate((None, FIX, None, None, FIX))]
+        self.assertEqual([r[2] for r in unpack_batch(pack_batch(recs))],
+                         [None, FIX, None, None, FIX])
+
+    def test_time_gap(self):
+        # gaps beyond DT_MAX are clamped
+        recs = [(11, T0, None, _psd(0)), (11, T0 + 5000, None, _psd(1))]
+        ts = [r[1] for r in unpack_batch(pack_batch(recs, 'none'))]
+        self.assertEqual(ts[0], T0)
+        self.assertAlmostEqual(ts[1], T0 + DT_MAX, 5)
+
+    def test_maxlen(self):
+        # incompressible records up to BLOCK_MAXLEN fit in the TLV length
+        recs, size, i = [], 0, 0
+        while True:
+            pos = FIX if i % 2 else None
+            data = _psd(i, 100)
+            if size + record_len(data, pos) > BLOCK_MAXLEN:
+                break
+            recs.append((11 + i % 16, T0 + i, pos, data))
+            size += record_len(data, pos)
+            i += 1
+        for codec in CODECS:
+            try:
+                self.assertLessEqual(len(pack_batch(recs, codec)), 0xffff)
+            except Exception as err:
+                if 'lzma' not in str(err):
+                    raise
+        self.assertRaises(ValueError, pack_batch,
+                          recs + [(11, T0 + i, FIX, data)], 'none')
+
+
+class _counter(object):
+    def inc(self):
+        pass
+
+if receiver is not None:
+
+    class _receiver(receiver):
+        # batches without dongle, nor socket
+        DEBUG = 0
+        UPLINK_BATCH = 10000.0
+        UPLINK_CODEC = None
+        TRACE = False
+
+        def __init__(self):
+            self._dongle = 'test'
+            self._chan = 11
+            self._batch = []
+            self._batch_len = 0
+            self._batch_trace = None
+            self._m_batches = _counter()
+            self.fix = None
+            self.sent = []
+
+        def get_position(self):
+            return self.fix
+
+        def send(self, data=b''):
+            self.sent.append(data)
+            return len(data)
+
+
+@unittest.skipIf(receiver is None, 'python-libusb1 not available')
+class test_receiver_batch(unittest.TestCase):
+
+    def _batches(self, rcv):
+        recs = []
+        for msg in rcv.sent:
+            l, T, L = unpack('!IBH', msg[:7])
+            self.assertEqual((l, T, L), (len(msg) - 4, TAG_BATCH, l - 3))
+            recs.extend(unpack_batch(msg[7:]))
+        return recs
+
+    def test_maxlen(self):
+        # small geotagged frames, without compression
+        rcv = _receiver()
+        rcv.UPLINK_MAXLEN = 0xffff
+        rcv.fix = gps_fix(48.1173, 11.5166, 545.4, 1.5, T0, True)
+        for i in range(5000):
+            rcv.forward(_psd(i, 5), ts=T0 + i / 1000.0)
+        rcv.flush_batch()
+        self.assertTrue(len(rcv.sent) > 1)
+        recs = self._batches(rcv)
+        self.assertEqual(len(recs), 5000)
+        self.assertEqual(set(r[2] for r in recs), set([rcv.fix.packed]))
+
+    def test_time_gap(self):
+        # a new batch after DT_MAX
+        rcv = _receiver()
+        rcv.forward(_psd(0), ts=T0)
+        rcv.forward(_psd(1), ts=T0 + 5000)
+        rcv.flush_batch()
+        self.assertEqual(len(rcv.sent), 2)
+        self.assertEqual([round(r[1], 6) for r in self._batches(rcv)],
+                         [T0, T0 + 5000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+#/**
+# * Software name: CC2531
+# * Version: 0.1.0
+# * Library to drive TI CC2531 802.15.4 dongle to monitor channels
+# * Copyright (C) 2013 Benoit Michau, ANSSI.
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the CeCILL-B license as published here:
+# * http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# *
+# *--------------------------------------------------------
+# * File Name : test_zigbee.py
+# * Created : 2013-11-13
+# * Authors : Benoit Michau, ANSSI
+# *--------------------------------------------------------
+# */
+#!/usr/bin/python2
+#
+###
+# 802.15.4 monitor based on Texas Instruments CC2531 USB dongle
+###
+#
+# Tests of the Zigbee NWK, APS and ZCL header parsers (zigbee.py).
+#
+
+import os
+import sys
+import unittest
+from struct import pack
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'CC2531'))
+from zigbee import nwk_header, aps_header, zcl_header
+
+
+class test_nwk(unittest.TestCase):
+
+    def test_data(self):
+        # data frame, version 2, to the coordinator
+        frame = pack('<HHHBB', 0x0008, 0x0000, 0x1234, 30, 7) + b'payload'
+        self.assertEqual(nwk_header(frame),
+                         (0, 2, 0x0000, 0x1234, 30, 7, None, None, False, 8))
+
+    def test_ieee_security(self):
+        # command frame, version 2, with source IEEE address and security
+        frame = pack('<HHHBBQ', 0x1209, 0xfffd, 0x1234, 1, 200,
+                     0x0011223344556677)
+        self.assertEqual(nwk_header(b'\xff' + frame, 1),
+                         (1, 2, 0xfffd, 0x1234, 1, 200, None,
+                          0x0011223344556677, True, 16))
+
+    def test_source_route(self):
+        # 2 relays
+        frame = pack('<HHHBBBBHH', 0x0408, 0, 0x1234, 30, 7, 2, 0, 1, 2)
+        self.assertEqual(nwk_header(frame)[-1], 14)
+        self.assertRaises(ValueError, nwk_header, frame[:-1])
+
+    def test_errors(self):
+        # version 1, and too short
+        self.assertRaises(ValueError, nwk_header,
+                          pack('<HHHBB', 0x0004, 0, 0x1234, 30, 7))
+        self.assertRaises(ValueError, nwk_header, b'\x08\x00\x00\x00')
+        self.assertRaises(ValueError, nwk_header,
+                          pack('<HHHBB', 0x0808, 0, 0x1234, 30, 7) + b'\0')
+
+
+class test_aps(unittest.TestCase):
+
+    def test_unicast(self):
+        frame = pack('<BBHHBB', 0x00, 1, 0x0006, 0x0104, 1, 5)
+        self.assertEqual(aps_header(frame),
+                         (0, 0, 1, None, 0x0006, 0x0104, 1, 5, False, 8))
+
+    def test_group(self):
+        frame = pack('<BHHHBB', 0x0c, 0x0001, 0x0006, 0x0104, 1, 5)
+        self.assertEqual(aps_header(frame),
+                         (0, 3, None, 0x0001, 0x0006, 0x0104, 1, 5, False, 9))
+
+    def test_command_ack(self):
+        # acknowledgement of an APS command, without addressing
+        self.assertEqual(aps_header(b'\x12\x09'),
+                         (2, 0, None, None, None, None, None, 9, False, 2))
+
+    def test_extended_security(self):
+        # fragmented: extended frame control and block number
+        frame = pack('<BBHHBBBB', 0xa0, 1, 0x0006, 0x0104, 1, 5, 0x01, 3)
+        res = aps_header(frame)
+        self.assertTrue(res[8])
+        self.assertEqual(res[9], 10)
+        self.assertRaises(ValueError, aps_header, frame[:-1])
+
+    def test_short(self):
+        self.assertRaises(ValueError, aps_header, b'')
+        self.assertRaises(ValueError, aps_header, b'\x00\x01\x06\x00')
+
+
+class test_zcl(unittest.TestCase):
+
+    def test_cluster_command(self):
+        self.assertEqual(zcl_header(b'\x01\x03\x01'),
+                         (1, None, 0, 3, 1, 3))
+
+    def test_manufacturer(self):
+        # from the server, manufacturer specific
+        frame = pack('<BHBB', 0x0d, 0x115f, 3, 0x0a)
+        self.assertEqual(zcl_header(b'\0\0' + frame, 2),
+                         (1, 0x115f, 1, 3, 0x0a, 5))
+
+    def test_short(self):
+        self.assertRaises(ValueError, zcl_header, b'\x01\x03')
+        self.assertRaises(ValueError, zcl_header, b'\x04\x5f\x11\x03')
+
+
+if __name__ == '__main__':
+    unittest.main()